@@ -4,9 +4,8 @@ import asyncio
 from dataclasses import dataclass
 import logging
 import os
-from typing import Dict, Optional, Tuple
+from typing import Dict, Optional
 import signal
-import cv2
 import pyaudio
 from aiortc.contrib.media import MediaPlayer, MediaRecorder
 from aiortc.mediastreams import MediaStreamTrack
@@ -16,7 +15,11 @@ from prefix_logger import PrefixLogger
 
 from aiortc.mediastreams import AudioStreamTrack, VideoStreamTrack, MediaStreamTrack
 from dotenv import load_dotenv
-from tracks import BeepTrack, CustomMediaRecorder, MediaSourceNotFoundException, RecorderConfig, TestVideoStreamTrack
+from tracks import SEGMENT_FORMATS, BeepTrack, CustomMediaRecorder, MediaSourceNotFoundException, RecorderConfig, SegmentConfig, TestVideoStreamTrack
+from passthrough import PassthroughRecorder
+from audio_output import AudioOutput
+from video_display import VideoDisplay
+from receive_metrics import ReceiveMetrics, TrackMetrics
 from websocket_network import ConnectionId
 
 
@@ -33,6 +36,10 @@ class TracksProcessor(ABC):
     def on_track(self, track: MediaStreamTrack) -> None:
         pass
 
+    def on_track_update(self, args: TrackUpdateEventArgs) -> None:
+        #override to access more than just the track e.g. the receiver
+        self.on_track(args.track)
+
 class LocalPlayback(TracksProcessor):
     _counter = 0  
 
@@ -40,8 +47,7 @@ class LocalPlayback(TracksProcessor):
         self.logger = logger.get_child("LocalPlayback")
         self._name: str = name
         self._audio_player: pyaudio.PyAudio = pyaudio.PyAudio()
-        self._stream: Optional[pyaudio.Stream] = None
-        self._current_audio_format: Optional[Tuple[int, int, int]] = None
+        self._audio_output: Optional[AudioOutput] = None
         self._stop_flag: bool = False
         self._video_task: Optional[asyncio.Task] = None
         self._audio_task: Optional[asyncio.Task] = None
@@ -59,10 +65,9 @@ class LocalPlayback(TracksProcessor):
         if self._audio_task:
             self._audio_task.cancel()
             await asyncio.sleep(0.1)  # Give a short time for the task to cancel
-        if self._stream:
-            self._stream.stop_stream()
-            self._stream.close()
-        
+        if self._audio_output:
+            self._audio_output.close()
+
         self.logger.info("Playback stopped")
 
     def on_track(self, track: MediaStreamTrack) -> None:
@@ -81,47 +86,31 @@ class LocalPlayback(TracksProcessor):
             # if this is the last message you see before stalling you run into
             # a bug. See the pitfalls section of the readme!
             self.logger.info("Opening window " + window_name)
+            #conversion and drawing happen on the render thread. Only the newest frame is shown
+            window = VideoDisplay.get().open_window(window_name)
             try:
-                while not self._stop_flag:
+                while not self._stop_flag and not window.closed:
                     frame = await track.recv()
-                    img = frame.to_ndarray(format="bgr24")
-                    cv2.imshow(window_name, img)
-                    if cv2.waitKey(1) & 0xFF == ord('q'):
-                        break
+                    window.show(frame)
                 # This does not yet trigger. recv above usually triggers an exception on exit
                 self.logger.info("_process_video completed")
             except Exception as e:
                 self.logger.error(f"Exception during _process_video: {e}")
             finally:
-                cv2.destroyWindow(window_name)
-                self.logger.info("_process_video shut down")
+                window.close()
+                self.logger.info(f"_process_video shut down. {window.stats}")
 
         self._video_task = asyncio.ensure_future(video_worker())
 
     def _process_audio(self, track: MediaStreamTrack) -> None:
         async def audio_worker() -> None:
+            #the device is fed from its own thread. Writing only copies into the buffer and never blocks the loop
+            output = AudioOutput(self._audio_player, self.logger)
+            self._audio_output = output
             try:
                 while not self._stop_flag:
                     frame = await track.recv()
-                    sample_rate: int = frame.sample_rate
-                    channels: int = len(frame.layout.channels)
-                    sample_format: int = pyaudio.paInt16
-
-                    if self._stream is None or self._current_audio_format != (sample_rate, channels, sample_format):
-                        if self._stream:
-                            self._stream.stop_stream()
-                            self._stream.close()
-
-                        self._stream = self._audio_player.open(
-                            format=sample_format,
-                            channels=channels,
-                            rate=sample_rate,
-                            output=True
-                        )
-                        self._current_audio_format = (sample_rate, channels, sample_format)
-
-                    #self._stream.write(frame.planes[0].to_bytes())                    
-                    self._stream.write(bytes(frame.planes[0]))
+                    output.write(frame)
                 #This does not yet trigger. recv above usually triggers an exception on exit
                 self.logger.info("_process_audio completed")
             except Exception as e:
@@ -133,10 +122,16 @@ class LocalPlayback(TracksProcessor):
 
 class FileStreaming(TracksProcessor):
 
-    def __init__(self, filename: str, logger: PrefixLogger):
+    def __init__(self, filename: str, logger: PrefixLogger, segment_duration: Optional[float] = None):
         self.logger = logger.get_child("FileStreaming")      
         config = CustomMediaRecorder.get_default_config()
-        self._recorder: CustomMediaRecorder = CustomMediaRecorder(filename, config)
+        if segment_duration is not None:
+            #e.g. out.mp4 is written as out_00000.mp4, out_00001.mp4, ... plus the playlist out.m3u8
+            name, ext = os.path.splitext(filename)
+            segment_format = SEGMENT_FORMATS.get(ext.lower(), "mp4")
+            config.segment = SegmentConfig(segment_duration, segment_format, playlist=f"{name}.m3u8")
+            filename = f"{name}_%05d{ext}"
+        self._recorder: CustomMediaRecorder = CustomMediaRecorder(filename, config, on_segment=self.on_segment)
         #uncomment below and remove above line to use the original aiortc recorder
         #self._recorder: MediaRecorder = MediaRecorder(filename)
 
@@ -147,13 +142,100 @@ class FileStreaming(TracksProcessor):
     async def on_stop(self) -> None:
         self.logger.info("Stopping recording")
         await self._recorder.stop()
-        self.logger.info("Recording stopped")
+        self.logger.info(f"Recording stopped. {self._recorder.stats}")
+
+    def on_segment(self, path: str) -> None:
+        #called for each completed segment. e.g. start an upload here
+        self.logger.info(f"Segment completed: {path}")
 
     def on_track(self, track: MediaStreamTrack) -> None:
         self.logger.info(f"Add track: {track.id}")
         self._recorder.addTrack(track)
 
 
+class PassthroughFileStreaming(TracksProcessor):
+    '''
+    Records the received VP8 / H264 / Opus frames without decoding or encoding them.
+    '''
+
+    def __init__(self, filename: str, logger: PrefixLogger):
+        self.logger = logger.get_child("PassthroughFileStreaming")
+        self._recorder = PassthroughRecorder(filename)
+
+    async def on_start(self) -> None:
+        self.logger.info("Starting passthrough recording ...")
+        await self._recorder.start()
+
+    async def on_stop(self) -> None:
+        self.logger.info("Stopping passthrough recording")
+        await self._recorder.stop()
+        self.logger.info("Recording stopped")
+
+    def on_track(self, track: MediaStreamTrack) -> None:
+        self.logger.warning(f"Track {track.id} can not be recorded without its receiver")
+
+    def on_track_update(self, args: TrackUpdateEventArgs) -> None:
+        if args.receiver is None:
+            self.on_track(args.track)
+            return
+        self.logger.info(f"Add receiver of track: {args.track.id}")
+        self._recorder.addReceiver(args.receiver)
+
+
+class MetricsSink(TracksProcessor):
+    '''
+    Receives the tracks without playing or recording them and logs their metrics.
+    Needs no display or audio device. Used for load tests with many receivers.
+    '''
+
+    #seconds between two log messages
+    LOG_INTERVAL = 5.0
+
+    def __init__(self, name: str, logger: PrefixLogger):
+        self.logger = logger.get_child(f"MetricsSink.{name}")
+        self._metrics = ReceiveMetrics()
+        self._log_task: Optional[asyncio.Task] = None
+
+    @property
+    def stats(self) -> Dict[str, TrackMetrics]:
+        return self._metrics.stats
+
+    async def on_start(self) -> None:
+        self._log_task = asyncio.ensure_future(self._log_worker())
+
+    async def on_stop(self) -> None:
+        if self._log_task:
+            self._log_task.cancel()
+        await self._metrics.stop()
+        self._log_stats()
+
+    def on_track(self, track: MediaStreamTrack) -> None:
+        self.logger.info(f"Measure track: {track.id}")
+        self._metrics.add_track(track)
+
+    def on_track_update(self, args: TrackUpdateEventArgs) -> None:
+        if args.receiver is None:
+            self.on_track(args.track)
+            return
+        #skips decoding entirely
+        self.logger.info(f"Measure encoded frames of track: {args.track.id}")
+        self._metrics.add_receiver(args.receiver)
+
+    async def _log_worker(self) -> None:
+        while True:
+            await asyncio.sleep(MetricsSink.LOG_INTERVAL)
+            self._log_stats()
+
+    def _log_stats(self) -> None:
+        for track_id, m in self.stats.items():
+            if m.kind == "video":
+                self.logger.info(f"{track_id} video {m.width}x{m.height} fps {m.fps:.1f} jitter {m.jitter_ms:.1f}ms "
+                                 f"lag {m.lag_ms:.0f}ms (max {m.max_lag_ms:.0f}ms) resolution changes {m.resolution_changes}")
+            else:
+                self.logger.info(f"{track_id} audio fps {m.fps:.1f} jitter {m.jitter_ms:.1f}ms "
+                                 f"lag {m.lag_ms:.0f}ms (max {m.max_lag_ms:.0f}ms) gaps {m.gaps} ({m.gap_ms:.0f}ms)")
+
+
 def setup_app_logger(): 
     logger = PrefixLogger("app")
     logger.info("app logger started")
@@ -161,16 +243,25 @@ def setup_app_logger():
 
 
 class CallAppEventHandler(CallEventHandler):
-    def __init__(self, filename: Optional[str] = None):
+    def __init__(self, filename: Optional[str] = None, passthrough: bool = False, segment_duration: Optional[float] = None,
+                 metrics: bool = False):
         self.logger = setup_app_logger()
         self.filename: Optional[str] = filename
+        #record the received frames without transcoding
+        self.passthrough = passthrough
+        #split the recording into segments of this length in seconds
+        self.segment_duration = segment_duration
+        #only measure the received tracks. No playback or recording
+        self.metrics = metrics
         self._connections: Dict[ConnectionId, TracksProcessor] = {}
         self.counter = 0
     
     def _get_or_create_processor(self, connection_id: ConnectionId) -> TracksProcessor:
         if connection_id not in self._connections:
             processor: TracksProcessor 
-            if self.filename:
+            if self.metrics:
+                processor = MetricsSink(str(connection_id), self.logger)
+            elif self.filename:
                 if self.counter == 0: 
                     filename = self.filename
                 else:
@@ -178,12 +269,22 @@ class CallAppEventHandler(CallEventHandler):
                     filename = f"{name}_{self.counter}.{ext}"
                 
                 self.counter += 1
-                processor = FileStreaming(filename, self.logger)
+                if self.passthrough:
+                    processor = PassthroughFileStreaming(filename, self.logger)
+                else:
+                    processor = FileStreaming(filename, self.logger, self.segment_duration)
             else:
                 processor = LocalPlayback(str(connection_id), self.logger)
             self._connections[connection_id] = processor
         return self._connections[connection_id]
 
+    def get_metrics(self) -> Dict[ConnectionId, Dict[str, TrackMetrics]]:
+        """
+        Metrics of each track per connection. Only available if metrics was set.
+        """
+        return {connection_id: processor.stats for connection_id, processor in self._connections.items()
+                if isinstance(processor, MetricsSink)}
+
     async def on_call_event(self, args: CallEventArgs) -> None:
         
         if isinstance(args, CallAcceptedEventArgs):
@@ -203,7 +304,7 @@ class CallAppEventHandler(CallEventHandler):
             connection_id = args.connection_id
             processor = self._get_or_create_processor(connection_id)
             self.logger.info(f"Track update for connection {connection_id}")
-            processor.on_track(args.track)
+            processor.on_track_update(args)
 
         if isinstance(args, DataMessageEventArgs):
             print(f"Received data message: {args.content}")
@@ -240,6 +341,16 @@ def parse_args():
                         help='Specify a file to send audio and video from. A path must be provided.')
     parser.add_argument('--to-file', metavar='PATH', 
                         help='Specify a file to store video at')
+    parser.add_argument('--passthrough', action='store_true',
+                        help='Use with --to-file to store the received VP8/H264/Opus data without transcoding. Use .mkv or .webm')
+    parser.add_argument('--segment', metavar='SECONDS', type=float, default=None,
+                        help='Use with --to-file to split the recording into segments of the given length. Use .mp4, .webm or .ts')
+    parser.add_argument('--metrics', action='store_true',
+                        help='Only measure the received tracks (fps, jitter, lag, ...) and log them. Needs no display or audio device')
+    parser.add_argument('--loop-monitor', action='store_true',
+                        help='Log when something blocks the event loop and which component it was')
+    parser.add_argument('--trace', metavar='PATH',
+                        help='Record a timeline of signaling, SDP / ICE steps and media work. Written as Chrome trace JSON on exit and on SIGUSR1')
     
             
     args = parser.parse_args()
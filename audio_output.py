@@ -0,0 +1,119 @@
+from typing import Any, Dict, Optional, Tuple
+
+import av
+import numpy as np
+from av import AudioFrame
+
+from prefix_logger import PrefixLogger
+from ring_buffer import JitterBuffer, JitterBufferStats
+
+'''
+Plays received audio on a local device without blocking the event loop.
+
+The output stream runs in callback mode: PortAudio asks for audio on its own thread and the callback
+takes it from a JitterBuffer. write only copies the samples of a frame into the buffer so the
+event loop never waits for the device.
+
+The PyAudio instance is passed in. Anything with the same open / get_format_from_width methods
+works, which allows testing without an audio device.
+
+Example:
+    output = AudioOutput(pyaudio.PyAudio(), logger)
+    while True:
+        output.write(await track.recv())
+'''
+
+#pyaudio.paContinue. Returned by the callback to keep the stream running
+PA_CONTINUE = 0
+
+
+class AudioOutput:
+    '''
+    The device is opened with the format of the first frame. Frames in a different format
+    (e.g. after the remote side changed its codec settings) are resampled to it instead of
+    reopening the device, which would cause an audible gap for each glitch.
+    '''
+
+    #samples per channel requested per callback. 10ms at 48kHz
+    FRAMES_PER_BUFFER = 480
+
+    def __init__(self, audio: Any, logger: PrefixLogger, target_latency: float = 0.06,
+                 max_latency: float = 0.3, buffer_duration: float = 1.0):
+        self._audio = audio
+        self.logger = logger.get_child("AudioOutput")
+        self.target_latency = target_latency
+        self.max_latency = max_latency
+        self.buffer_duration = buffer_duration
+        self.stream: Any = None
+        #(sample rate, channels, layout name) the device was opened with
+        self.format: Optional[Tuple[int, int, str]] = None
+        self.jitter: Optional[JitterBuffer] = None
+        #(format, layout, sample rate) of the input -> resampler to the device format
+        self._resamplers: Dict[Tuple[str, str, int], av.AudioResampler] = {}
+        self._out: Optional[np.ndarray] = None
+
+    @property
+    def stats(self) -> JitterBufferStats:
+        return self.jitter.stats if self.jitter is not None else JitterBufferStats()
+
+    def write(self, frame: AudioFrame) -> None:
+        '''
+        Queues the frame for playback. Never blocks. Call from a single thread (usually the event loop).
+        '''
+        if self.stream is None:
+            self._open(frame)
+        assert self.format is not None and self.jitter is not None
+
+        sample_rate, channels, layout = self.format
+        if frame.format.name == "s16" and frame.sample_rate == sample_rate and len(frame.layout.channels) == channels:
+            #s16 is interleaved. Copied straight from the plane into the buffer
+            self.jitter.write(np.frombuffer(memoryview(frame.planes[0]), dtype=np.int16)[:frame.samples * channels])
+            return
+
+        key = (frame.format.name, frame.layout.name, frame.sample_rate)
+        resampler = self._resamplers.get(key)
+        if resampler is None:
+            self.logger.info(f"Resampling {key} to the output format {self.format}")
+            resampler = av.AudioResampler(format="s16", layout=layout, rate=sample_rate)
+            self._resamplers[key] = resampler
+        if frame.pts is not None:
+            #received frames can jump in time which the resampler doesn't accept. A copy without pts
+            #is resampled as the frame may still be used by others e.g. a recorder
+            copy = AudioFrame.from_ndarray(frame.to_ndarray(), format=frame.format.name, layout=frame.layout.name)
+            copy.sample_rate = frame.sample_rate
+            frame = copy
+        for resampled in resampler.resample(frame):
+            self.jitter.write(resampled.to_ndarray())
+
+    def close(self) -> None:
+        if self.stream is not None:
+            self.stream.stop_stream()
+            self.stream.close()
+            self.stream = None
+            self.logger.info(f"Output closed. {self.stats}")
+
+    def _open(self, frame: AudioFrame) -> None:
+        sample_rate = frame.sample_rate
+        channels = len(frame.layout.channels)
+        self.format = (sample_rate, channels, frame.layout.name)
+        self.jitter = JitterBuffer(int(self.buffer_duration * sample_rate), channels,
+                                   int(self.target_latency * sample_rate), int(self.max_latency * sample_rate))
+        self._out = np.zeros((AudioOutput.FRAMES_PER_BUFFER, channels), dtype=np.int16)
+        self.stream = self._audio.open(
+            format=self._audio.get_format_from_width(2),
+            channels=channels,
+            rate=sample_rate,
+            output=True,
+            frames_per_buffer=AudioOutput.FRAMES_PER_BUFFER,
+            stream_callback=self._callback,
+        )
+        self.logger.info(f"Output opened with {sample_rate}Hz {channels} channels")
+
+    def _callback(self, in_data, frame_count: int, time_info, status) -> Tuple[bytes, int]:
+        #runs on the PortAudio thread
+        assert self.jitter is not None and self._out is not None
+        if frame_count != len(self._out):
+            self._out = np.zeros((frame_count, self._out.shape[1]), dtype=np.int16)
+        self.jitter.read(self._out)
+        #PyAudio needs a bytes-like object without a release function. bytes is the safe choice
+        return self._out.tobytes(), PA_CONTINUE
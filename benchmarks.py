@@ -0,0 +1,339 @@
+import argparse
+import asyncio
+from dataclasses import asdict, dataclass, field
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import av
+from aiortc.mediastreams import MediaStreamError, MediaStreamTrack
+
+from call import Call
+from call_events import CallAcceptedEventArgs, CallEventArgs, DataMessageEventArgs
+from call_peer import CallEventHandler
+from loopback_network import LoopbackSignalingServer
+from prefix_logger import PrefixLogger
+from tracks import BeepTrack, ColorVideoStreamTrack, CustomMediaRecorder, SineWaveTrack, TestVideoStreamTrack
+from websocket_network import ConnectionId, NetEventType, NetworkEvent
+
+'''
+Benchmarks of the hot paths: signaling events, data channels, synthetic tracks, recording and call setup.
+
+Results are written as JSON and can be compared with a stored baseline. Each result has a value, a unit and
+whether higher values are better. A result is a regression if it is worse than the baseline by more than
+the tolerance (default 25%). Baselines depend on the machine so compare runs on the same machine only.
+
+Usage:
+    python benchmarks.py                               #run all and print the results
+    python benchmarks.py --quick                       #fewer iterations. Used by the tests
+    python benchmarks.py --only track,recorder         #only some of the benchmarks
+    python benchmarks.py --output results.json --baseline benchmark_baseline.json
+    python benchmarks.py --save-baseline benchmark_baseline.json
+'''
+
+DEFAULT_TOLERANCE = 0.25
+
+
+@dataclass
+class BenchmarkResult:
+    name: str
+    value: float
+    unit: str
+    higher_is_better: bool = True
+    details: dict = field(default_factory=dict)
+
+
+BenchmarkFunction = Callable[[bool], Awaitable[List[BenchmarkResult]]]
+#name prefix -> benchmark. Each returns one or more results
+BENCHMARKS: Dict[str, BenchmarkFunction] = {}
+
+
+def benchmark(name: str):
+    def register(function: BenchmarkFunction) -> BenchmarkFunction:
+        BENCHMARKS[name] = function
+        return function
+    return register
+
+
+def _rate(name: str, count: int, seconds: float, unit: str = "ops/s", **details) -> BenchmarkResult:
+    return BenchmarkResult(name, count / seconds if seconds > 0 else 0.0, unit, True, details)
+
+
+@benchmark("network_event")
+async def bench_network_event(quick: bool) -> List[BenchmarkResult]:
+    #a typical signaling message: an SDP of a few KB sent as utf-16 text
+    text = "v=0\r\na=candidate:1 1 udp 2130706431 192.0.2.2 47489 typ host\r\n" * 40
+    evt = NetworkEvent(NetEventType.ReliableMessageReceived, ConnectionId(16384), text)
+    count = 2000 if quick else 20000
+
+    start = time.perf_counter()
+    for _ in range(count):
+        data = NetworkEvent.to_byte_array(evt)
+    encode = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(count):
+        NetworkEvent.from_byte_array(data)
+    decode = time.perf_counter() - start
+    return [_rate("network_event.encode", count, encode, bytes=len(data)),
+            _rate("network_event.decode", count, decode, bytes=len(data))]
+
+
+class _Unpaced:
+    #replaces a track's Pacer so frames are generated as fast as possible
+    def __init__(self, period_samples: int = 1):
+        self.index = -1
+        self.period_samples = period_samples
+
+    async def next_frame(self) -> int:
+        self.index += 1
+        return self.index
+
+    def pts(self, clock_rate: int) -> int:
+        return self.index * self.period_samples
+
+
+@benchmark("track")
+async def bench_tracks(quick: bool) -> List[BenchmarkResult]:
+    count = 200 if quick else 3000
+    results = []
+    for name, track in (("track.test_video", TestVideoStreamTrack()), ("track.color_video", ColorVideoStreamTrack()),
+                        ("track.beep", BeepTrack()), ("track.sine", SineWaveTrack())):
+        track.pacer = _Unpaced()  # type: ignore
+        start = time.perf_counter()
+        for _ in range(count):
+            await track.recv()
+        results.append(_rate(name, count, time.perf_counter() - start, "frames/s"))
+        track.stop()
+    return results
+
+
+class _FrameSource(MediaStreamTrack):
+    '''
+    Returns count frames without pacing and then ends.
+    '''
+
+    kind = "video"
+
+    def __init__(self, count: int, width: int, height: int):
+        super().__init__()
+        self._count = count
+        self._index = 0
+        self._track = TestVideoStreamTrack(width=width, height=height, fps=30)
+        self._track.pacer = _Unpaced(3000)  # type: ignore
+
+    async def recv(self):
+        if self._index >= self._count:
+            raise MediaStreamError
+        self._index += 1
+        #yield so the recorder's other tasks run like with a real track
+        await asyncio.sleep(0)
+        return await self._track.recv()
+
+
+@benchmark("recorder")
+async def bench_recorder(quick: bool) -> List[BenchmarkResult]:
+    count = 30 if quick else 300
+    results = []
+    with tempfile.TemporaryDirectory() as folder:
+        for name, ext in (("recorder.libx264", "mp4"), ("recorder.vp8", "webm")):
+            config = CustomMediaRecorder.get_default_config()
+            #nothing is dropped. Every frame is encoded
+            config.queue_size = count + 1
+            recorder = CustomMediaRecorder(os.path.join(folder, f"bench.{ext}"), config)
+            recorder.addTrack(_FrameSource(count, config.width or 1280, config.height or 720))
+            start = time.perf_counter()
+            await recorder.start()
+            while recorder.stats.encoded_frames + recorder.stats.dropped_frames < count:
+                await asyncio.sleep(0.01)
+            #stop flushes the encoder. Frames buffered by the encoder are only done after that
+            await recorder.stop()
+            stats = recorder.stats
+            results.append(_rate(name, stats.encoded_frames, time.perf_counter() - start, "frames/s",
+                                 width=config.width, height=config.height, dropped=stats.dropped_frames,
+                                 encode_ms=stats.average_encode_time * 1000))
+    return results
+
+
+class _BenchmarkHandler(CallEventHandler):
+    def __init__(self):
+        self.accepted = asyncio.Event()
+        self.connection_id: Optional[ConnectionId] = None
+        self.received = {True: 0, False: 0}
+        self.received_bytes = {True: 0, False: 0}
+        self.changed = asyncio.Event()
+
+    async def on_call_event(self, args: CallEventArgs) -> None:
+        if isinstance(args, CallAcceptedEventArgs):
+            self.connection_id = args.connection_id
+            self.accepted.set()
+        elif isinstance(args, DataMessageEventArgs):
+            self.received[args.reliable] += 1
+            self.received_bytes[args.reliable] += len(args.content)
+            self.changed.set()
+
+
+async def _connect_pair(server: LoopbackSignalingServer, address: str):
+    logger = PrefixLogger("bench")
+    listener_handler, caller_handler = _BenchmarkHandler(), _BenchmarkHandler()
+    listener = Call(None, listener_handler, network=server.create_network(logger))
+    caller = Call(None, caller_handler, network=server.create_network(logger))
+    start = time.perf_counter()
+    tasks = [asyncio.create_task(listener.listen(address))]
+    await server.wait_listening(address)
+    tasks.append(asyncio.create_task(caller.call(address)))
+    await asyncio.wait_for(asyncio.gather(listener_handler.accepted.wait(), caller_handler.accepted.wait()), 30)
+    setup = time.perf_counter() - start
+    return listener, caller, listener_handler, caller_handler, tasks, setup
+
+
+async def _dispose(calls: List[Call], tasks: List[asyncio.Task]) -> None:
+    for call in calls:
+        await call.dispose(1.0)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+@benchmark("call_setup")
+async def bench_call_setup(quick: bool) -> List[BenchmarkResult]:
+    rounds = 2 if quick else 10
+    times = []
+    for i in range(rounds):
+        server = LoopbackSignalingServer()
+        listener, caller, _, _, tasks, setup = await _connect_pair(server, f"setup{i}")
+        times.append(setup)
+        await _dispose([caller, listener], tasks)
+    return [BenchmarkResult("call_setup.loopback", statistics.median(times) * 1000, "ms", False,
+                            {"rounds": rounds, "max_ms": max(times) * 1000})]
+
+
+#bytes waiting in a data channel before the sender waits
+BUFFER_LIMIT = 256 * 1024
+
+
+@benchmark("data_channel")
+async def bench_data_channel(quick: bool) -> List[BenchmarkResult]:
+    count = 500 if quick else 10000
+    message = bytes(1024)
+    server = LoopbackSignalingServer()
+    listener, caller, listener_handler, caller_handler, tasks, _ = await _connect_pair(server, "data")
+    results = []
+    try:
+        assert caller_handler.connection_id is not None
+        peer = caller.getPeer(caller_handler.connection_id)
+        for reliable in (True, False):
+            channel = peer.dc_reliable if reliable else peer.dc_unreliable
+            #the channel opens shortly after the call is accepted
+            while channel is None or channel.readyState != "open":
+                await asyncio.sleep(0.01)
+                channel = peer.dc_reliable if reliable else peer.dc_unreliable
+            before = listener_handler.received[reliable]
+            start = time.perf_counter()
+            for i in range(count):
+                peer.send(message, reliable)
+                #keep the send buffer small like a real sender would
+                if channel.bufferedAmount > BUFFER_LIMIT:
+                    await asyncio.sleep(0.001)
+            send_time = time.perf_counter() - start
+            #wait for the receiver. Unreliable messages can get lost so stop once nothing arrives anymore
+            while listener_handler.received[reliable] - before < count:
+                listener_handler.changed.clear()
+                try:
+                    await asyncio.wait_for(listener_handler.changed.wait(), 2.0)
+                except asyncio.TimeoutError:
+                    break
+            total = time.perf_counter() - start
+            received = listener_handler.received[reliable] - before
+            kind = "reliable" if reliable else "unreliable"
+            results.append(_rate(f"data_channel.{kind}", received, total, "msgs/s", message_bytes=len(message),
+                                 mbytes_per_s=received * len(message) / total / 1_000_000,
+                                 send_ms=send_time * 1000, lost=count - received))
+    finally:
+        await _dispose([caller, listener], tasks)
+    return results
+
+
+async def run_benchmarks(quick: bool = False, only: Optional[List[str]] = None) -> List[BenchmarkResult]:
+    '''
+    Runs the benchmarks in BENCHMARKS. only is a list of their names e.g. ["track", "recorder"].
+    '''
+    results: List[BenchmarkResult] = []
+    for name, function in BENCHMARKS.items():
+        if only is None or name in only:
+            results.extend(await function(quick))
+    return results
+
+
+def to_json(results: List[BenchmarkResult], quick: bool = False) -> dict:
+    return {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "quick": quick,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "av": av.__version__,
+        "results": {r.name: asdict(r) for r in results},
+    }
+
+
+def compare(results: List[BenchmarkResult], baseline: dict, tolerance: float = DEFAULT_TOLERANCE) -> List[str]:
+    '''
+    Returns a message for each result that is worse than the baseline by more than tolerance.
+    '''
+    regressions = []
+    for result in results:
+        base = baseline.get("results", {}).get(result.name)
+        if base is None or base["value"] == 0:
+            continue
+        change = (result.value - base["value"]) / base["value"]
+        if not result.higher_is_better:
+            change = -change
+        if change < -tolerance:
+            regressions.append(f"{result.name}: {result.value:.1f} {result.unit} vs baseline {base['value']:.1f} ({change:+.0%})")
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Run the performance benchmarks.")
+    parser.add_argument('--quick', action='store_true', help='Fewer iterations. Faster but less precise')
+    parser.add_argument('--only', metavar='NAMES', help=f'Comma separated benchmarks to run. Any of {", ".join(BENCHMARKS)}')
+    parser.add_argument('--output', metavar='PATH', help='Write the results as JSON')
+    parser.add_argument('--baseline', metavar='PATH', help='Compare with a baseline. Exit code 1 on regressions')
+    parser.add_argument('--save-baseline', metavar='PATH', help='Store the results as new baseline')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='Allowed slowdown compared to the baseline (default: %(default)s)')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    only = args.only.split(",") if args.only else None
+    results = asyncio.run(run_benchmarks(args.quick, only))
+    for r in results:
+        print(f"{r.name:40} {r.value:12.1f} {r.unit}")
+    data = to_json(results, args.quick)
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, "w") as f:
+                json.dump(data, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("quick", False) != args.quick:
+            #fewer iterations give different results e.g. short bursts on the data channels
+            print("Warning: --quick differs from the baseline. The results are not comparable")
+        regressions = compare(results, baseline, args.tolerance)
+        for message in regressions:
+            print(f"REGRESSION {message}")
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
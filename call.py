@@ -1,10 +1,64 @@
-from typing import Dict, Optional
+import asyncio
+from dataclasses import dataclass
+import time
+from typing import Callable, Dict, List, Optional
 from call_events import CallEndedEventArgs, CallEventArgs
-from prefix_logger import setup_logger
+from prefix_logger import LogPayload, setup_logger
 from websocket_network import ConnectionId, WebsocketNetwork, NetworkEvent, NetEventType
 from aiortc import MediaStreamTrack
 
-from call_peer import CallPeer, CallEventHandler
+from call_peer import CallPeer, CallEventHandler, RecoveryConfig
+
+@dataclass
+class PeerLimits:
+    #max number of peers. If reached the oldest half-open peer is evicted or if there is
+    #none the new connection is rejected. None = no limit
+    max_peers: int | None = None
+    #max number of peers that are not connected (signaling not completed, ICE not finished or lost).
+    #The oldest ones are evicted first. None = no limit
+    max_half_open: int | None = None
+    #time in seconds a peer has from NewConnection until the peer connection is connected
+    #before it is evicted. None = wait forever
+    signaling_timeout: float | None = None
+    #time in seconds a connected peer may go without receiving signaling, data messages or media
+    #before it is evicted. Checked every idle_timeout / 2. None = never
+    idle_timeout: float | None = None
+
+    @property
+    def enabled(self) -> bool:
+        return (self.max_peers is not None or self.max_half_open is not None or self.signaling_timeout is not None
+                or self.idle_timeout is not None)
+
+@dataclass
+class AdmissionStats:
+    #new connections rejected because max_peers was reached
+    rejected: int = 0
+    #half-open peers evicted to make room for new connections
+    evicted: int = 0
+    #peers evicted because they did not connect within signaling_timeout
+    timed_out: int = 0
+    #connected peers evicted because nothing was received within idle_timeout
+    idle: int = 0
+
+#Decides the offer/answer role for a new connection in conference mode without the random number
+#exchange. Returns True if the local side creates the offer, False if it waits for the remote offer
+#and None if the remote side is not known to use the same rule. The rule must return
+#opposite results on both sides of a connection so it has to be based on data both sides share.
+RoleRule = Callable[[ConnectionId], Optional[bool]]
+
+def id_role_rule(local_id: int, get_remote_id: Callable[[ConnectionId], Optional[int]]) -> RoleRule:
+    '''
+    Rule for apps in which both sides know each other's ids before they connect e.g. user ids of a
+    lobby. The side with the higher id sends the offer. get_remote_id returns the id of the remote
+    side of a connection or None if it is unknown or an older client. These fall back to the
+    random number exchange.
+    '''
+    def rule(connection_id: ConnectionId) -> Optional[bool]:
+        remote_id = get_remote_id(connection_id)
+        if remote_id is None or remote_id == local_id:
+            return None
+        return local_id > remote_id
+    return rule
 
 '''
 Prototype Call implementation similar to Unity ICall and BrowserCall for web. 
@@ -14,7 +68,15 @@ Prototype Call implementation similar to Unity ICall and BrowserCall for web.
 * The remote side must already wait for an incoming call
 '''
 class Call(CallEventHandler):
-    def __init__(self, uri, track_observer: CallEventHandler, is_conference = False):
+    #max time in seconds a single peer / the network may take to close during shutdown
+    PEER_CLOSE_TIMEOUT = 5.0
+    NETWORK_CLOSE_TIMEOUT = 5.0
+    #number of rejected / evicted connection ids remembered to ignore their remaining signaling
+    MAX_DROPPED_IDS = 1024
+
+    def __init__(self, uri, track_observer: CallEventHandler, is_conference = False, network: Optional[WebsocketNetwork] = None,
+                 limits: Optional[PeerLimits] = None, recovery: Optional[RecoveryConfig] = None,
+                 role_rule: Optional[RoleRule] = None):
         self.logger = setup_logger().get_child("Call")
         self.is_conference = is_conference
         self.uri = uri
@@ -22,11 +84,25 @@ class Call(CallEventHandler):
         self.listening = False
         self.track_observer = track_observer
         self.peers : Dict[int, CallPeer] = {}
+        self.limits = limits if limits is not None else PeerLimits()
+        self.admission_stats = AdmissionStats()
+        #None = peers end the call on the first connection failure
+        self.recovery = recovery
+        #None = roles in conference mode are always negotiated via random numbers
+        self.role_rule = role_rule
+        self._signaling_timeouts : Dict[int, asyncio.Task] = {}
+        #started with the first peer if limits.idle_timeout is set
+        self._idle_task : Optional[asyncio.Task] = None
+        #ids of rejected and evicted connections in the order they were added. Messages that
+        #were already on the way when they were dropped are expected and ignored
+        self._dropped_ids : Dict[int, None] = {}
 
         self.out_video_track : Optional[MediaStreamTrack]= None
         self.out_audio_track : Optional[MediaStreamTrack] = None
         
-        self.network = WebsocketNetwork(self.logger)
+        #a network can be injected e.g. by a ShardedCallHost worker that receives
+        #its signaling events from another process
+        self.network = network if network is not None else WebsocketNetwork(self.logger)
         self.network.register_event_handler(self.signaling_event_handler)
         self.logger.info("call created")
     
@@ -37,20 +113,88 @@ class Call(CallEventHandler):
         #signaling connection a few seconds after CallAccepted
         if isinstance(args, CallEndedEventArgs):
             peer = self.peers[args.connection_id.id]
-            await peer.close()
-            del self.peers[args.connection_id.id]
+            await peer.close(Call.PEER_CLOSE_TIMEOUT)
+            self.peers.pop(args.connection_id.id, None)
+            self._cancel_signaling_timeout(args.connection_id)
         #forward to user
         await self.track_observer.on_call_event(args)
 
     def createPeer(self, connectionId: ConnectionId):
         self.logger.info(f"Creating peer with id {connectionId}")
-        peer = CallPeer(connectionId, self, self.logger)
+        peer = CallPeer(connectionId, self, self.logger, self.recovery)
         
         peer.on_signaling_message(self.on_peer_signaling_message)
         
         self.attach_tracks_peer(peer)
         self.peers[connectionId.id] = peer
+        if self.limits.signaling_timeout is not None:
+            self._signaling_timeouts[connectionId.id] = asyncio.create_task(self._signaling_timeout(peer, self.limits.signaling_timeout))
+        if self.limits.idle_timeout is not None and self._idle_task is None:
+            self._idle_task = asyncio.create_task(self._evict_idle_peers(self.limits.idle_timeout))
         return peer
+
+    def get_half_open_peers(self) -> List[CallPeer]:
+        #oldest first
+        half_open = [p for p in self.peers.values() if not p.is_established]
+        half_open.sort(key=lambda p: p.created_at)
+        return half_open
+
+    async def _admit(self, connection_id: ConnectionId) -> bool:
+        #makes room for a new peer by evicting the oldest half-open peers
+        half_open = self.get_half_open_peers()
+        if self.limits.max_half_open is not None:
+            while len(half_open) >= self.limits.max_half_open and half_open:
+                self.admission_stats.evicted += 1
+                await self.evict_peer(half_open.pop(0), "max_half_open reached")
+
+        if self.limits.max_peers is not None and len(self.peers) >= self.limits.max_peers:
+            if half_open:
+                self.admission_stats.evicted += 1
+                await self.evict_peer(half_open.pop(0), "max_peers reached")
+            else:
+                self.admission_stats.rejected += 1
+                self.logger.warning(f"Rejecting connection {connection_id}. max_peers {self.limits.max_peers} reached")
+                self._add_dropped_id(connection_id)
+                await self.network.disconnect(connection_id)
+                return False
+        return True
+
+    async def evict_peer(self, peer: CallPeer, reason: str):
+        self.logger.warning(f"Evicting peer {peer.connection_id}: {reason}")
+        self._add_dropped_id(peer.connection_id)
+        #triggers CallEnded which removes the peer from the list
+        await peer.close(Call.PEER_CLOSE_TIMEOUT)
+        await self.network.disconnect(peer.connection_id)
+
+    async def _signaling_timeout(self, peer: CallPeer, timeout: float):
+        await asyncio.sleep(timeout)
+        #the task is cancelled once the peer is removed
+        del self._signaling_timeouts[peer.connection_id.id]
+        if not peer.is_established:
+            self.admission_stats.timed_out += 1
+            await self.evict_peer(peer, f"not connected after {timeout}s")
+
+    async def _evict_idle_peers(self, timeout: float):
+        #half-open peers are left to the signaling timeout
+        while True:
+            await asyncio.sleep(timeout / 2)
+            for peer in list(self.peers.values()):
+                if not peer.is_established or peer.is_closing:
+                    continue
+                idle = time.monotonic() - await peer.check_activity()
+                if idle >= timeout:
+                    self.admission_stats.idle += 1
+                    await self.evict_peer(peer, f"nothing received for {idle:.1f}s")
+
+    def _add_dropped_id(self, connection_id: ConnectionId):
+        self._dropped_ids[connection_id.id] = None
+        if len(self._dropped_ids) > Call.MAX_DROPPED_IDS:
+            del self._dropped_ids[next(iter(self._dropped_ids))]
+
+    def _cancel_signaling_timeout(self, connection_id: ConnectionId):
+        task = self._signaling_timeouts.pop(connection_id.id, None)
+        if task is not None:
+            task.cancel()
     
     def attach_tracks_peer(self, peer: CallPeer):
         if self.out_video_track:
@@ -74,7 +218,7 @@ class Call(CallEventHandler):
             self.attach_tracks_peer(p)
 
     async def on_peer_signaling_message(self, peer: CallPeer, msg: str):
-        self.logger.debug(f"Sending: {msg}")
+        self.logger.debug("Sending: %s", LogPayload(msg), category="signaling")
         await self.network.send_text(msg, peer.connection_id)
 
     async def listen(self, address):
@@ -98,6 +242,13 @@ class Call(CallEventHandler):
         #loop and wait for messages.
         #they are returned via the event handler
         await self.network.process_messages()
+
+    async def serve(self):
+        #used if the network was already started and connected elsewhere
+        #(see sharded_call.py). Only processes the incoming signaling events
+        self.in_signaling = True
+        self.logger.info("Serving signaling events of an already started network")
+        await self.network.process_messages()
         
     def shutdown(self, reason = ""):
         self.logger.info(f"Shutting down. Reason: {reason}")
@@ -106,17 +257,28 @@ class Call(CallEventHandler):
         #self.network.shutdown()
 
     async def handle_message(self, message):
-        self.logger.debug(f"Forwarding signaling message from peer: {message}")
+        self.logger.debug("Forwarding signaling message from peer: %s", LogPayload(message), category="signaling")
         await self.network.send_text(message)
     
     async def signaling_event_handler(self, evt: NetworkEvent):    
-        self.logger.debug(f"Received signaling event of type {evt.type}")
+        self.logger.debug("Received signaling event of type %s", evt.type)
         if evt.type == NetEventType.NewConnection:
             self.logger.info("Signaling NewConnection event")
+            #the network reused the id of a dropped connection
+            self._dropped_ids.pop(evt.connection_id.id, None)
+            if not await self._admit(evt.connection_id):
+                return
             peer = self.createPeer(evt.connection_id)
             
             if self.is_conference:
-                await peer.negotiate_role()
+                is_offerer = self.role_rule(evt.connection_id) if self.role_rule is not None else None
+                if is_offerer is None:
+                    #fallback for remote sides that don't support the rule
+                    await peer.negotiate_role()
+                elif is_offerer:
+                    await peer.create_offer()
+                else:
+                    peer.wait_for_offer(CallPeer.ROLE_FALLBACK_TIMEOUT)
             elif self.listening == False:
                 #by default new outgoing connections create an offer
                 await peer.create_offer()
@@ -125,6 +287,12 @@ class Call(CallEventHandler):
             #peer = self.getPeer(evt.connection_id)
             self.logger.warning(f"Signaling ConnectionFailed event {evt.connection_id}")
             
+        elif evt.connection_id is not None and evt.connection_id.id in self._dropped_ids:
+            #signaling of a rejected or evicted connection that was already on the way
+            self.logger.debug("Ignoring signaling event %s of dropped connection %s", evt.type, evt.connection_id)
+            if evt.type == NetEventType.Disconnected:
+                self._dropped_ids.pop(evt.connection_id.id, None)
+
         elif evt.type == NetEventType.Disconnected:
             peer = self.getPeer(evt.connection_id)
             #For conference mode we expect signaling connections to remain open
@@ -134,9 +302,12 @@ class Call(CallEventHandler):
             if peer is not None:
                 if self.is_conference:
                     await peer.close()
-                #do nothing for 1 to 1 connections
-                #TODO: Maybe close the peer if they didn't complete
-                #signaling yet?
+                elif self.limits.enabled and not peer.is_established:
+                    #1 to 1 connections usually remain open after signaling. If the peer did not
+                    #connect yet it never will without the signaling connection. Only done if
+                    #admission limits are set to protect the host from such peers
+                    self.logger.info(f"Closing peer {evt.connection_id}. Signaling ended before it connected")
+                    await peer.close()
             
         elif evt.type == NetEventType.ServerInitialized:
             self.listening = True
@@ -152,7 +323,7 @@ class Call(CallEventHandler):
                 self.logger.warning(f"Message for unknown connection received id {evt.connection_id}")
                 
     async def send(self, msg: str, reliable, connection_id: ConnectionId) -> bool:
-        self.logger.debug(f"Sending message to peer {connection_id} {reliable}: {msg}")
+        self.logger.debug("Sending message to peer %s %s: %s", connection_id, reliable, LogPayload(msg), category="data")
         peer = self.getPeer(connection_id)
         if peer:
             return peer.send(msg, reliable)
@@ -160,9 +331,46 @@ class Call(CallEventHandler):
             self.logger.warning(f"Message for unknown connection received id {connection_id}")
             return False
 
-    async def dispose(self):
+    async def _close_peer(self, peer: CallPeer, timeout: float):
+        #the peer connection itself gets timeout seconds to close. The outer limit
+        #also covers the CallEnded event handlers of the user
+        try:
+            await asyncio.wait_for(peer.close(timeout), 2 * timeout)
+        except asyncio.TimeoutError:
+            self.logger.warning(f"Closing peer {peer.connection_id} timed out after {2 * timeout}s")
+
+    async def dispose(self, peer_timeout: Optional[float] = None) -> Dict[str, float]:
+        '''
+        Closes all peers in parallel and then the signaling connection.
+        Returns the time in seconds each phase took.
+        '''
+        if peer_timeout is None:
+            peer_timeout = Call.PEER_CLOSE_TIMEOUT
+        start = time.monotonic()
         #close all peers. Note: Each peer triggers an CallEnded event when still open at this point
         #the event handler will remove them from the peer list
-        for p in list(self.peers.values()):
-            await p.close()
-        await self.network.dispose()
+        for task in self._signaling_timeouts.values():
+            task.cancel()
+        self._signaling_timeouts.clear()
+        if self._idle_task is not None:
+            self._idle_task.cancel()
+            self._idle_task = None
+        peers = list(self.peers.values())
+        await asyncio.gather(*[self._close_peer(p, peer_timeout) for p in peers])
+        peers_closed = time.monotonic()
+
+        #the network is closed last so pending signaling messages of the peers can still be sent
+        try:
+            await asyncio.wait_for(self.network.dispose(), Call.NETWORK_CLOSE_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.logger.warning(f"Network did not close within {Call.NETWORK_CLOSE_TIMEOUT}s")
+        end = time.monotonic()
+
+        timings = {
+            "peers": peers_closed - start,
+            "network": end - peers_closed,
+            "total": end - start
+        }
+        self.logger.info(f"Disposed {len(peers)} peers in {timings['peers']:.3f}s, "
+                         f"network in {timings['network']:.3f}s, total {timings['total']:.3f}s")
+        return timings
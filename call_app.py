@@ -5,6 +5,9 @@ from dotenv import load_dotenv
 from app_common import CallAppEventHandler, get_tracks_from_args, parse_args, setup_signal_handling
 from call import Call
 import logging
+from loop_monitor import LoopMonitor
+from prefix_logger import setup_logger
+from tracing import tracer
 logging.basicConfig(level=logging.INFO)
 
 
@@ -29,7 +32,7 @@ async def main():
     #either gets tracks from the --from-file flag or from --video / --audio
     video_track, audio_track = get_tracks_from_args(args)
     
-    track_handler = CallAppEventHandler(args.to_file)
+    track_handler = CallAppEventHandler(args.to_file, args.passthrough, args.segment, args.metrics)
     call  = Call(uri, track_handler)
     
     if video_track:
@@ -39,6 +42,15 @@ async def main():
         call.attach_track(audio_track)
     
     
+    if args.trace:
+        tracer.enable()
+        tracer.install_signal_dump(os.path.dirname(os.path.abspath(args.trace)))
+
+    monitor = None
+    if args.loop_monitor:
+        monitor = LoopMonitor(setup_logger().get_child("LoopMonitor"), report_interval=10)
+        monitor.start()
+
     try:
         if listen:
             main_loop =  asyncio.create_task(call.listen(address))
@@ -55,6 +67,11 @@ async def main():
     finally:
         print("Shutting down...")
         await call.dispose()
+        if monitor is not None:
+            await monitor.stop()
+            monitor.log_report()
+        if args.trace:
+            tracer.dump(args.trace)
         print("Shutdown complete.")
 
 
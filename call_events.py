@@ -1,6 +1,7 @@
 from enum import Enum
 from typing import Callable, Optional, Any, List
 
+from aiortc import RTCRtpReceiver
 from aiortc.mediastreams import MediaStreamTrack
 from websocket_network import ConnectionId
 
@@ -36,10 +37,12 @@ class CallEndedEventArgs(CallEventArgs):
         self.connection_id: ConnectionId = connection_id
 
 class TrackUpdateEventArgs(CallEventArgs):
-    def __init__(self, connection_id: ConnectionId, track: MediaStreamTrack):
+    def __init__(self, connection_id: ConnectionId, track: MediaStreamTrack, receiver: Optional[RTCRtpReceiver] = None):
         super().__init__(CallEventType.TRACK_UPDATE)
         self.connection_id: ConnectionId = connection_id
         self.track = track
+        #receiver of the incoming track. Gives access to the encoded frames (see passthrough.py)
+        self.receiver = receiver
 
 class ErrorInfo:
     def __init__(self, message: str):
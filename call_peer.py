@@ -1,6 +1,8 @@
 import asyncio
+from dataclasses import dataclass
 import json
 import random
+import time
 from abc import ABC, abstractmethod
 import traceback
 from typing import Awaitable, Callable, List, Optional, Union
@@ -9,7 +11,8 @@ from aiortc.sdp import candidate_from_sdp
 from call_events import CallAcceptedEventArgs, CallEndedEventArgs, CallEventArgs, CallEventType, DataMessageEventArgs, MessageEventArgs, TrackUpdateEventArgs
 from websocket_network import ConnectionId
 from sdp_workarounds import proc_local_sdp
-from prefix_logger import PrefixLogger
+from prefix_logger import LogPayload, PrefixLogger
+from tracing import tracer
 
 DATA_CHANNEL_RELIABLE= "reliable"
 DATA_CHANNEL_UNRELIABLE= "unreliable"
@@ -43,14 +46,34 @@ class OldCallEventHandler(CallEventHandler):
 
 SignalingCallback = Callable[['CallPeer', str], Awaitable[None]]
 
+@dataclass
+class RecoveryConfig:
+    '''
+    Allows a connected peer to reconnect after a transient network failure instead of ending the call.
+    aiortc does not support ICE restarts. A failed RTCPeerConnection is replaced by a new one
+    that is negotiated via the still open signaling connection. The side that sent the original
+    offer sends a new offer, the other side waits for it.
+    '''
+    #time in seconds a "disconnected" peer has to return to "connected" before recovery starts
+    #(aiortc itself does not report "disconnected" yet)
+    grace_period: float = 2.0
+    #time in seconds the replacement connection has to connect before the call ends
+    timeout: float = 10.0
+    #max number of recoveries during the lifetime of a peer
+    max_attempts: int = 3
+
 class CallPeer:
-    
+    #time in seconds a peer that waits for an offer due to a RoleRule waits before it falls
+    #back to the random number exchange e.g. because the remote side used a different rule
+    ROLE_FALLBACK_TIMEOUT = 3.0
 
-    def __init__(self, connection_id : ConnectionId, public_event_observer: CallEventHandler, logger: PrefixLogger):
+    def __init__(self, connection_id : ConnectionId, public_event_observer: CallEventHandler, logger: PrefixLogger,
+                 recovery: Optional[RecoveryConfig] = None):
         self.logger = logger.get_child("CallPeer" + str(connection_id.id))
-        self.peer = RTCPeerConnection()
+        self.peer : RTCPeerConnection
         self.connection_id = connection_id
-        self.random_number : int
+        #None until a random number was sent. Stays None if the role was decided by a RoleRule
+        self.random_number : Optional[int] = None
         self.public_event_observer : CallEventHandler = public_event_observer
         self.dc_reliable : RTCDataChannel
         self.dc_unreliable : RTCDataChannel
@@ -64,31 +87,60 @@ class CallPeer:
         self.audioTransceiver: Optional[RTCRtpTransceiver] = None
 
         self.has_ended = False
+        self.is_closing = False
+        #used to evict the oldest half-open peers first
+        self.created_at = time.monotonic()
+        #last time signaling, a data message or media was received. Used to evict idle peers
+        self.last_activity = self.created_at
+        #media packets received as of the last check_activity
+        self._media_packets = 0
+
+        self.recovery = recovery
+        self.recovery_attempts = 0
+        self.is_offerer = False
+        self.was_accepted = False
+        self._recovery_task : Optional[asyncio.Task] = None
+        self._role_fallback_task : Optional[asyncio.Task] = None
+        #set once the current peer connection connected. Cleared instead of replaced when the
+        #connection is replaced so a pending recovery keeps waiting on the same event
+        self._connected = asyncio.Event()
 
         self._observers:list[SignalingCallback] = []
+        self._create_peer_connection()
+
+    def _create_peer_connection(self):
+        self.peer = RTCPeerConnection()
+        self._connected.clear()
+        self.videoTransceiver = None
+        self.audioTransceiver = None
         # Setup peer connection event handlers
         self.peer.on("track", self.on_track)
         self.peer.on("connectionstatechange", self.on_connectionstatechange)
         #self.peer.on("iceconnectionstatechange", self.on_iceConnectionState)        
         self.peer.on("datachannel", self.on_data_channel)
     
+    @property
+    def is_established(self) -> bool:
+        return self.peer.connectionState == "connected"
+
     def configure_data_channel(self, data_channel:RTCDataChannel, reliable: bool):
         # Set up event handlers for the data channel
         @data_channel.on("message")
         def on_message(message):
+            self.last_activity = time.monotonic()
             # check and throw error if string. we expect only bytes
             if isinstance(message, str):
-                self.logger.error(f"Received strings directly. {message}")
+                self.logger.error("Received strings directly. %s", LogPayload(message), category="data")
                 return
             if message[0] == 1:
                 # this is a byte message
-                self.logger.debug(f"Received byte message: {message[1:]}")
+                self.logger.debug("Received byte message: %s", LogPayload(message[1:]), category="data")
                 # to MessageEventArgs
                 asyncio.create_task(self.trigger_event(DataMessageEventArgs(self.connection_id, message[1:], reliable)))
             elif message[0] == 2:
                 # this is a utf-16 string message
                 message = message[1:].decode("utf-16")
-                self.logger.debug(f"Received string message: {message}")
+                self.logger.debug("Received string message: %s", LogPayload(message), category="data")
                 asyncio.create_task(self.trigger_event(MessageEventArgs(self.connection_id, message, reliable)))
         
 
@@ -117,17 +169,22 @@ class CallPeer:
 
     async def trigger_on_signaling_message(self, message: str):
         
-        self.logger.info(f"SIG OUT: {message}")
+        self.logger.info("SIG OUT: %s", LogPayload(message), category="signaling")
         for observer in self._observers:
             await observer(self, message)
     
     async def forward_message(self, msg: str):
-        self.logger.info(f"SIG IN : {msg}")
+        self.logger.info("SIG IN : %s", LogPayload(msg), category="signaling")
+        self.last_activity = time.monotonic()
         try:
             jobj = json.loads(msg)
             if isinstance(jobj, dict):
                 if 'sdp' in jobj:
-                    await self.peer.setRemoteDescription(RTCSessionDescription(jobj["sdp"], jobj["type"]))
+                    if jobj["type"] == "offer" and self.is_renegotiation_offer():
+                        #the remote side replaced its failed connection. Follow along
+                        await self.replace_peer_connection()
+                    with tracer.span("setRemoteDescription", "sdp", {"type": jobj["type"]}):
+                        await self.peer.setRemoteDescription(RTCSessionDescription(jobj["sdp"], jobj["type"]))
                     self.logger.info("setRemoteDescription done")
                     if self.peer.signalingState == "have-remote-offer":
                         await self.create_answer()
@@ -141,17 +198,24 @@ class CallPeer:
                         candidate = candidate_from_sdp(str_candidate)
                         candidate.sdpMid = jobj.get("sdpMid")
                         candidate.sdpMLineIndex = jobj.get("sdpMLineIndex")
-                        await self.peer.addIceCandidate(candidate)
-                        self.logger.debug(f"addIceCandidate done for: {str_candidate}")
+                        with tracer.span("addIceCandidate", "ice"):
+                            await self.peer.addIceCandidate(candidate)
+                        self.logger.debug("addIceCandidate done for: %s", str_candidate)
                     else:
-                        self.logger.warning(f"Invalid candidate message: {msg}")
+                        self.logger.warning("Invalid candidate message: %s", LogPayload(msg), category="signaling")
                 else:
-                    self.logger.error(f"Unexpected JSON object received: {msg}")
+                    self.logger.error("Unexpected JSON object received: %s", LogPayload(msg), category="signaling")
             elif isinstance(jobj, int):
                 #if needed we compare our random numbers and decide who sends out the offer
                 #if not needed we already have created an offer and signalingState is "have-local-offer""
                 self.logger.info(f"Random number received: {jobj}")
-                if self.peer.signalingState == "stable" and int(self.random_number) > jobj:
+                if self.random_number is None and not self.is_offerer:
+                    #our role was decided by a RoleRule the remote side doesn't use. The offer
+                    #we wait for won't come. Fall back to the exchange
+                    self._cancel_role_fallback()
+                    await self.negotiate_role()
+                #if a RoleRule made us the offerer no number is sent. The remote side answers our offer
+                if self.random_number is not None and self.peer.signalingState == "stable" and self.random_number > jobj:
                     await self.create_offer()
 
         except json.JSONDecodeError:
@@ -163,12 +227,27 @@ class CallPeer:
                 # For example:
                 # await self.handle_integer_message(integer_value)
             else:
-                self.logger.error(f"Received message is neither valid JSON nor an integer: {msg}")
+                self.logger.error("Received message is neither valid JSON nor an integer: %s", LogPayload(msg), category="signaling")
                 # Handle the error case here, maybe raise an exception or log an error
         #check if it is just a single integer
         
         self.logger.debug("Message processing done")
 
+    async def check_activity(self) -> float:
+        '''
+        Returns last_activity. Received media is only counted here from the receiver stats instead
+        of on each packet so the media path has no extra work.
+        '''
+        packets = 0
+        for receiver in self.peer.getReceivers():
+            report = await receiver.getStats()
+            packets += sum(stats.packetsReceived for stats in report.values() if stats.type == "inbound-rtp")
+        #also changes if the peer connection was replaced and counts from 0 again
+        if packets != self._media_packets:
+            self._media_packets = packets
+            self.last_activity = time.monotonic()
+        return self.last_activity
+
     async def on_track(self, track):
         self.logger.info(f"Track received: {track.kind}")
         if track.kind == "audio":
@@ -176,7 +255,11 @@ class CallPeer:
         elif track.kind == "video":
             self.inc_video_track = track
         
-        await self.trigger_event(TrackUpdateEventArgs(self.connection_id, track))
+        receiver = None
+        for transceiver in self.peer.getTransceivers():
+            if transceiver.receiver.track is track:
+                receiver = transceiver.receiver
+        await self.trigger_event(TrackUpdateEventArgs(self.connection_id, track, receiver))
             
 
     async def trigger_event(self, args: CallEventArgs):
@@ -185,13 +268,93 @@ class CallPeer:
 
     async def on_connectionstatechange(self):
         self.logger.info(f"Connection state changed: {self.peer.connectionState}")
+        tracer.instant("connectionState", "ice", {"state": self.peer.connectionState, "peer": self.connection_id.id})
         if self.peer.connectionState == "connected":
-            await self.trigger_event(CallAcceptedEventArgs(self.connection_id))
+            self._connected.set()
+            #reconnects after a recovery are not reported to the user
+            if not self.was_accepted:
+                self.was_accepted = True
+                await self.trigger_event(CallAcceptedEventArgs(self.connection_id))
+        elif self.peer.connectionState == "disconnected":
+            if self.recovery is not None and self.can_recover():
+                self._start_recovery(self.recovery.grace_period, self.recovery.timeout)
         elif self.peer.connectionState == "failed":
-            await self.trigger_ended()
+            if self._recovery_task is not None:
+                #e.g. failed after disconnected. The pending recovery ends the call if it doesn't reconnect
+                self.logger.debug("Connection failed while a recovery is pending")
+            elif self.recovery is not None and self.can_recover():
+                self._start_recovery(0, self.recovery.timeout)
+            else:
+                await self.trigger_ended()
         elif self.peer.connectionState == "closed":
             await self.trigger_ended()
 
+    def can_recover(self) -> bool:
+        #only calls that connected before can be recovered
+        return (self.recovery is not None and self.was_accepted and not self.is_closing
+                and self._recovery_task is None and self.recovery_attempts < self.recovery.max_attempts)
+
+    def is_renegotiation_offer(self) -> bool:
+        #a new offer for a connection that already completed negotiation
+        return (self.recovery is not None and not self.is_closing
+                and self.peer.signalingState == "stable" and self.peer.remoteDescription is not None)
+
+    def _start_recovery(self, grace_period: float, timeout: float):
+        self._recovery_task = asyncio.create_task(self._recover(grace_period, timeout))
+
+    async def _recover(self, grace_period: float, timeout: float):
+        try:
+            if grace_period > 0:
+                await asyncio.sleep(grace_period)
+                if self.is_established:
+                    self.logger.info("Connection returned within the grace period")
+                    return
+            self.recovery_attempts += 1
+            self.logger.warning(f"Connection lost. Recovery attempt {self.recovery_attempts}")
+            #still set from the lost connection
+            self._connected.clear()
+            old_peer = None
+            if self.is_offerer:
+                #the old connection is closed after the new one connected. Closing it right away
+                #can end the call on the remote side before it received the new offer
+                old_peer = await self.replace_peer_connection(close_old=False)
+                await self.create_offer()
+            #else: the remote side sends a new offer. See forward_message
+
+            try:
+                await asyncio.wait_for(self._connected.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            if old_peer is not None:
+                await self._close_replaced(old_peer)
+            if self.is_established:
+                self.logger.info("Connection recovered")
+            elif not self.is_closing:
+                self.logger.warning(f"Recovery failed after {timeout}s")
+                await self.trigger_ended()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self._recovery_task = None
+
+    async def replace_peer_connection(self, close_old: bool = True) -> Optional[RTCPeerConnection]:
+        self.logger.info("Replacing the peer connection")
+        old_peer = self.peer
+        #stop events of the old connection from ending the call
+        old_peer.remove_all_listeners()
+        self._create_peer_connection()
+        self.setup_transceivers()
+        if close_old:
+            await self._close_replaced(old_peer)
+            return None
+        return old_peer
+
+    async def _close_replaced(self, old_peer: RTCPeerConnection):
+        try:
+            await old_peer.close()
+        except Exception as e:
+            self.logger.warning(f"Closing the replaced peer connection failed: {e}")
+
     #catch all shutdown either because network closed, user stopped it or some error happened
     async def trigger_ended(self):
             if self.has_ended == False:
@@ -212,14 +375,34 @@ class CallPeer:
             self.audioTransceiver.sender.replaceTrack(self.out_audio_track)
             self.audioTransceiver.direction = "sendrecv"
 
+    def wait_for_offer(self, timeout: float):
+        #used if a RoleRule decided that the remote side sends the offer
+        self._role_fallback_task = asyncio.create_task(self._role_fallback(timeout))
+
+    async def _role_fallback(self, timeout: float):
+        await asyncio.sleep(timeout)
+        self._role_fallback_task = None
+        if self.random_number is None and self.peer.remoteDescription is None and not self.is_closing:
+            self.logger.warning(f"No offer received after {timeout}s. Falling back to the random number exchange")
+            await self.negotiate_role()
+
+    def _cancel_role_fallback(self):
+        if self._role_fallback_task is not None:
+            self._role_fallback_task.cancel()
+            self._role_fallback_task = None
+
     async def negotiate_role(self):
         #send random number in case offer/answer role is unclear
-        self.random_number = random.randint(1, 2**31 - 1)
+        await self.send_role_number(random.randint(1, 2**31 - 1))
+
+    async def send_role_number(self, number: int):
+        self.random_number = number
         neg = str(self.random_number)
         self.logger.info(f"Sending random number: {neg}")
         await self.trigger_on_signaling_message(neg)
         
     async def create_offer(self):
+        self.is_offerer = True
 
         self.dc_reliable = self.peer.createDataChannel(label=DATA_CHANNEL_RELIABLE)
         self.dc_unreliable = self.peer.createDataChannel(label=DATA_CHANNEL_UNRELIABLE)
@@ -230,11 +413,14 @@ class CallPeer:
         self.videoTransceiver = self.peer.addTransceiver("video", direction="sendrecv")
         self.setup_transceivers()
 
-        offer = await self.peer.createOffer()
+        with tracer.span("createOffer", "sdp"):
+            offer = await self.peer.createOffer()
         self.logger.info("Offer created")
-        await self.peer.setLocalDescription(offer)
+        #includes gathering the ICE candidates
+        with tracer.span("setLocalDescription", "sdp", {"type": "offer"}):
+            await self.peer.setLocalDescription(offer)
         offer_w_ice = self.sdpToText(self.peer.localDescription.sdp, "offer")
-        self.logger.info(f"Offer with ICE: {offer_w_ice}")
+        #the offer itself is logged as SIG OUT
         
         await self.trigger_on_signaling_message(offer_w_ice)
         #return offer_w_ice
@@ -268,21 +454,25 @@ class CallPeer:
         
         self.setup_transceivers()
             
-        answer : Optional[RTCSessionDescription] = await self.peer.createAnswer()
+        with tracer.span("createAnswer", "sdp"):
+            answer : Optional[RTCSessionDescription] = await self.peer.createAnswer()
         if answer is None:
             self.logger.error("Error creating answer returned none")
             return
-        await self.peer.setLocalDescription(answer)
+        with tracer.span("setLocalDescription", "sdp", {"type": "answer"}):
+            await self.peer.setLocalDescription(answer)
         text_answer = self.sdpToText(self.peer.localDescription.sdp, "answer")
         await self.trigger_on_signaling_message(text_answer)
 
     async def set_remote_description(self, sdp, type_):
         description = RTCSessionDescription(sdp, type_)
-        await self.peer.setRemoteDescription(description)
+        with tracer.span("setRemoteDescription", "sdp", {"type": type_}):
+            await self.peer.setRemoteDescription(description)
         self.logger.info("Remote description set")
 
     async def add_ice_candidate(self, candidate):
-        await self.peer.addIceCandidate(candidate)
+        with tracer.span("addIceCandidate", "ice"):
+            await self.peer.addIceCandidate(candidate)
     
 
     def send(self, message: Union[str, bytes], reliable: bool) -> bool:
@@ -310,11 +500,22 @@ class CallPeer:
                 return False
 
     
-    async def close(self):
+    async def close(self, timeout: Optional[float] = None):
+        #CallEnded handlers usually call close again
+        if self.is_closing:
+            return
+        self.is_closing = True
+        #a failed recovery ends the call from within the recovery task. Cancelling it would interrupt this close
+        if self._recovery_task is not None and self._recovery_task is not asyncio.current_task():
+            self._recovery_task.cancel()
+        self._cancel_role_fallback()
         await self.trigger_ended()
         self.logger.info("Calling close")
         try:
-            await self.peer.close()
+            #a stuck DTLS transport can block close() forever
+            await asyncio.wait_for(self.peer.close(), timeout)
+        except asyncio.TimeoutError:
+            self.logger.warning(f"Peer connection did not close within {timeout}s")
         except asyncio.CancelledError as e:
             self.logger.error(f"Peer connection triggered a CancelledError on close  {str(e)}\n{traceback.format_exc()}")
         except Exception as e:
@@ -0,0 +1,97 @@
+import asyncio
+from typing import List, Optional
+from aiortc.mediastreams import MediaStreamError, MediaStreamTrack
+from app_common import setup_signal_handling
+from call import Call
+import logging
+from call_events import CallEventArgs, TrackUpdateEventArgs
+from call_peer import CallEventHandler
+from latency_probe import AudioLatencyAnalyzer, LatencyProbeTrack, VideoLatencyAnalyzer
+from loopback_network import LoopbackSignalingServer
+from prefix_logger import PrefixLogger
+from tracks import BeepTrack
+
+'''
+Loopback benchmark of the glass-to-glass latency.
+
+The caller sends a LatencyProbeTrack and a BeepTrack in chirp mode. The listener runs in the
+same process and reads the timestamps back from the received frames. Every 5 seconds the
+latency distribution, lost frames and freezes are printed.
+
+Signaling uses an in-memory LoopbackSignalingServer so no server is needed.
+'''
+
+logging.basicConfig(level=logging.INFO)
+
+address = "pylatency"
+REPORT_INTERVAL = 5
+
+
+class LatencyProbeHandler(CallEventHandler):
+    def __init__(self, audio_sender: Optional[BeepTrack] = None):
+        self.video = VideoLatencyAnalyzer()
+        self.audio = AudioLatencyAnalyzer(audio_sender) if audio_sender is not None else None
+        self.tasks: List[asyncio.Task] = []
+
+    async def on_call_event(self, args: CallEventArgs) -> None:
+        if isinstance(args, TrackUpdateEventArgs):
+            self.tasks.append(asyncio.create_task(self._analyze(args.track)))
+
+    async def _analyze(self, track: MediaStreamTrack) -> None:
+        try:
+            while True:
+                frame = await track.recv()
+                if track.kind == "video":
+                    self.video.add_frame(frame)
+                elif self.audio is not None:
+                    self.audio.add_frame(frame)
+        except MediaStreamError:
+            pass
+
+    def report(self) -> None:
+        print(f"video latency: {self.video.latency.summary()}")
+        print(f"video frames: {self.video.result}")
+        if self.audio is not None:
+            print(f"audio latency: {self.audio.latency.summary()} sweeps found {self.audio.detections}")
+
+
+async def run(calls: List[Call]):
+    server = LoopbackSignalingServer()
+    audio_track = BeepTrack(chirp=True)
+    handler = LatencyProbeHandler(audio_track)
+
+    listener = Call(None, handler, network=server.create_network(PrefixLogger("listener")))
+    calls.append(listener)
+    listen_task = asyncio.create_task(listener.listen(address))
+    await server.wait_listening(address)
+
+    caller = Call(None, LatencyProbeHandler(), network=server.create_network(PrefixLogger("caller")))
+    calls.append(caller)
+    caller.attach_track(LatencyProbeTrack())
+    caller.attach_track(audio_track)
+    call_task = asyncio.create_task(caller.call(address))
+
+    while True:
+        await asyncio.sleep(REPORT_INTERVAL)
+        handler.report()
+        for task in (listen_task, call_task):
+            if task.done():
+                return
+
+
+async def main():
+    calls: List[Call] = []
+    try:
+        main_loop = asyncio.create_task(run(calls))
+        setup_signal_handling(main_loop)
+        await main_loop
+    except asyncio.CancelledError:
+        print("CancelledError triggered. Starting controlled shutdown")
+    finally:
+        for call in calls:
+            await call.dispose()
+        print("Shutdown complete.")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -6,6 +6,8 @@ from app_common import CallAppEventHandler, setup_signal_handling
 from call import Call
 import logging
 from call_events import CallAcceptedEventArgs, CallEventArgs, DataMessageEventArgs, MessageEventArgs
+from loopback_network import LoopbackSignalingServer
+from prefix_logger import PrefixLogger
 from tracks import BeepTrack, TestVideoStreamTrack
 from websocket_network import ConnectionId
 
@@ -19,6 +21,10 @@ Optionally:
 * Attach a video track to the call (uncommend tracks below)
 * Attach an audio track to the call (uncommend tracks below)
 * start only the listener or caller task to run them as separate processes
+  (needs USE_SIGNALING_SERVER = True)
+
+By default both calls are connected via an in-memory LoopbackSignalingServer. Set
+USE_SIGNALING_SERVER to True to use the server from SIGNALING_URI instead.
 '''
 
 
@@ -27,6 +33,9 @@ logging.basicConfig(level=logging.INFO)
 
 address = "pyloop"
 
+USE_SIGNALING_SERVER = False
+loopback_server = LoopbackSignalingServer()
+
 call_listen : Call | None = None
 call_outgoing : Call | None = None
 
@@ -59,6 +68,14 @@ class LoopbackCallAppEventHandler(CallAppEventHandler):
         except asyncio.CancelledError:
             pass  # Gracefully exit on cancellation
 
+
+def create_network(name: str):
+    #None lets the Call connect to the real signaling server
+    if USE_SIGNALING_SERVER:
+        return None
+    return loopback_server.create_network(PrefixLogger(name))
+
+
 async def loop_listener():
     global call_listen
     video_track : VideoStreamTrack | None = None
@@ -70,7 +87,7 @@ async def loop_listener():
 
     uri = os.getenv('SIGNALING_URI', 'ws://192.168.1.3:12776')
     track_handler = LoopbackCallAppEventHandler("listener")
-    call_listen  = Call(uri, track_handler)
+    call_listen  = Call(uri, track_handler, network=create_network("listener"))
     track_handler.set_call(call_listen)
     if video_track:
         call_listen.attach_track(video_track)
@@ -89,11 +106,14 @@ async def loop_caller():
     #video_track = TestVideoStreamTrack()
     #audio_track = BeepTrack()
 
-    await asyncio.sleep(0.5)
+    if USE_SIGNALING_SERVER:
+        await asyncio.sleep(0.5)
+    else:
+        await loopback_server.wait_listening(address)
 
     uri = os.getenv('SIGNALING_URI', 'ws://192.168.1.3:12776')
     track_handler = LoopbackCallAppEventHandler("caller")
-    call_outgoing  = Call(uri, track_handler)
+    call_outgoing  = Call(uri, track_handler, network=create_network("caller"))
     track_handler.set_call(call_outgoing)
     if video_track:
         call_outgoing.attach_track(video_track)
@@ -0,0 +1,250 @@
+import binascii
+from collections import deque
+from dataclasses import dataclass
+import struct
+import time
+from typing import Optional
+
+import av
+import numpy as np
+from av import AudioFrame, VideoFrame
+
+from tracks import BeepTrack, TestVideoStreamTrack, yuv_planes
+
+'''
+Measures the glass-to-glass latency of media sent through a Call.
+
+LatencyProbeTrack is a TestVideoStreamTrack that writes a sequence number and the time.monotonic
+time of each frame into the frame as a pattern of large black and white blocks. The blocks survive
+lossy compression and scaling. VideoLatencyAnalyzer reads them back from the received frames.
+
+For audio BeepTrack(chirp=True) sends sweeps and records when each started. AudioLatencyAnalyzer
+finds the sweeps in the received audio via correlation.
+
+Both sides must run on the same machine as they compare time.monotonic values
+e.g. a caller and listener in one process via a loopback network.
+'''
+
+
+class LatencyStats:
+    '''
+    Latency samples in seconds. Keeps the last max_samples for the percentiles.
+    '''
+
+    def __init__(self, max_samples: int = 10000):
+        self.samples: deque[float] = deque(maxlen=max_samples)
+        self.count = 0
+
+    def add(self, latency: float) -> None:
+        self.samples.append(latency)
+        self.count += 1
+
+    def percentile_ms(self, percentile: float) -> float:
+        if not self.samples:
+            return 0
+        return float(np.percentile(np.fromiter(self.samples, dtype=np.float64), percentile)) * 1000
+
+    @property
+    def max_ms(self) -> float:
+        return max(self.samples) * 1000 if self.samples else 0
+
+    def summary(self) -> str:
+        return (f"{self.count} samples p50 {self.percentile_ms(50):.1f}ms p95 {self.percentile_ms(95):.1f}ms "
+                f"p99 {self.percentile_ms(99):.1f}ms max {self.max_ms:.1f}ms")
+
+
+#the pattern is a grid of PATTERN_COLUMNS x PATTERN_ROWS blocks in the top left corner.
+#Each block is 1/32 of the frame width so the pattern scales with the frame
+PATTERN_COLUMNS = 16
+PATTERN_ROWS = 4
+PATTERN_BLOCK_DIVISOR = 32
+#y values of a 0 and 1 bit. Far apart so blurring and quantization don't flip bits
+PATTERN_LOW = 16
+PATTERN_HIGH = 235
+
+
+def _pattern_block_size(width: int, height: int) -> int:
+    return max(4, min(width // PATTERN_BLOCK_DIVISOR, height // (PATTERN_ROWS * 2)))
+
+
+def encode_pattern(sequence: int, timestamp_us: int) -> np.ndarray:
+    '''
+    64 bits: 16 bit sequence number, 32 bit timestamp in us and a 16 bit CRC of both.
+    '''
+    payload = struct.pack(">HI", sequence & 0xFFFF, timestamp_us & 0xFFFFFFFF)
+    data = payload + struct.pack(">H", binascii.crc_hqx(payload, 0))
+    return np.unpackbits(np.frombuffer(data, dtype=np.uint8))
+
+
+def decode_pattern(bits: np.ndarray) -> Optional[tuple[int, int]]:
+    '''
+    Returns (sequence, timestamp_us) or None if the CRC doesn't match.
+    '''
+    data = np.packbits(bits.astype(np.uint8)).tobytes()
+    if binascii.crc_hqx(data[:6], 0) != struct.unpack(">H", data[6:8])[0]:
+        return None
+    sequence, timestamp_us = struct.unpack(">HI", data[:6])
+    return sequence, timestamp_us
+
+
+class LatencyProbeTrack(TestVideoStreamTrack):
+    '''
+    TestVideoStreamTrack with the sequence number and capture time of each frame written into it.
+    '''
+
+    def __init__(self, fps=30, width=640, height=480):
+        super().__init__(fps, width, height)
+        self.sequence = 0
+
+    async def create_frame(self, pts):
+        frame = await super().create_frame(pts)
+        y_plane, u_plane, v_plane = yuv_planes(frame)
+        block = _pattern_block_size(frame.width, frame.height)
+        bits = encode_pattern(self.sequence, time.monotonic_ns() // 1000)
+        self.sequence += 1
+        #one value per block scaled up to the block size. Drawn last so the boxes never cover it
+        grid = np.where(bits.reshape(PATTERN_ROWS, PATTERN_COLUMNS), PATTERN_HIGH, PATTERN_LOW).astype(np.uint8)
+        y_plane[:PATTERN_ROWS * block, :PATTERN_COLUMNS * block] = np.kron(grid, np.ones((block, block), dtype=np.uint8))
+        #grey chroma. Moving boxes under the pattern would otherwise tint it
+        u_plane[:PATTERN_ROWS * block // 2, :PATTERN_COLUMNS * block // 2] = 128
+        v_plane[:PATTERN_ROWS * block // 2, :PATTERN_COLUMNS * block // 2] = 128
+        return frame
+
+
+@dataclass
+class VideoLatencyResult:
+    #frames with a readable pattern
+    frames: int = 0
+    #frames whose pattern couldn't be read e.g. heavy compression artifacts
+    unreadable: int = 0
+    #sequence numbers that never arrived. Unreadable frames don't count as lost
+    lost: int = 0
+    #frames that repeated the previous sequence number
+    repeated: int = 0
+    #periods without a new frame for longer than FREEZE_THRESHOLD
+    freezes: int = 0
+    freeze_ms: float = 0
+    max_freeze_ms: float = 0
+
+
+class VideoLatencyAnalyzer:
+    '''
+    Reads the pattern of LatencyProbeTrack frames. Call add_frame for each received frame right after recv.
+    '''
+
+    FREEZE_THRESHOLD = 0.2
+
+    def __init__(self):
+        self.latency = LatencyStats()
+        self.result = VideoLatencyResult()
+        self._last_sequence: Optional[int] = None
+        self._last_new_frame: Optional[float] = None
+        self._unreadable_since_last = 0
+
+    def add_frame(self, frame: VideoFrame) -> Optional[float]:
+        '''
+        Returns the latency of the frame in seconds or None if the pattern couldn't be read.
+        '''
+        now_ns = time.monotonic_ns()
+        if frame.format.name != "yuv420p":
+            frame = frame.reformat(format="yuv420p")
+        y_plane = yuv_planes(frame)[0]
+        block = _pattern_block_size(frame.width, frame.height)
+        #average the center of each block. The edges are blurred by the encoder
+        grid = y_plane[:PATTERN_ROWS * block, :PATTERN_COLUMNS * block].reshape(PATTERN_ROWS, block, PATTERN_COLUMNS, block)
+        inner = grid[:, block // 4:block - block // 4, :, block // 4:block - block // 4]
+        bits = inner.mean(axis=(1, 3)).flatten() > (PATTERN_LOW + PATTERN_HIGH) / 2
+        decoded = decode_pattern(bits)
+        if decoded is None:
+            self.result.unreadable += 1
+            self._unreadable_since_last += 1
+            return None
+        sequence, timestamp_us = decoded
+
+        r = self.result
+        r.frames += 1
+        now = now_ns / 1_000_000_000
+        if self._last_sequence is not None:
+            step = (sequence - self._last_sequence) & 0xFFFF
+            if step == 0:
+                r.repeated += 1
+                return None
+            if step < 0x8000:
+                #unreadable frames arrived and are already counted
+                r.lost += max(0, step - 1 - self._unreadable_since_last)
+        self._last_sequence = sequence
+        self._unreadable_since_last = 0
+        if self._last_new_frame is not None:
+            gap = now - self._last_new_frame
+            if gap > VideoLatencyAnalyzer.FREEZE_THRESHOLD:
+                r.freezes += 1
+                r.freeze_ms += gap * 1000
+                r.max_freeze_ms = max(r.max_freeze_ms, gap * 1000)
+        self._last_new_frame = now
+
+        #the timestamp wraps after 71 minutes. The difference is still correct modulo 2^32
+        latency = ((now_ns // 1000 - timestamp_us) & 0xFFFFFFFF) / 1_000_000
+        self.latency.add(latency)
+        return latency
+
+
+class AudioLatencyAnalyzer:
+    '''
+    Finds the sweeps of a BeepTrack(chirp=True) in the received audio. Call add_frame for each
+    received frame right after recv. The sender is needed for its sweep and marker times.
+    '''
+
+    #normalized correlation needed to count as a sweep
+    THRESHOLD = 0.5
+
+    def __init__(self, sender: BeepTrack):
+        assert sender.chirp, "The sender needs to be a BeepTrack with chirp=True"
+        self.sender = sender
+        self.sample_rate = sender.sample_rate
+        self.template = sender._generate_beep()
+        self.template_energy = float(np.sqrt(np.sum(self.template ** 2)))
+        self.latency = LatencyStats()
+        self.detections = 0
+        self._resampler = av.AudioResampler(format="s16", layout="mono", rate=self.sample_rate)
+        self._history = np.zeros(0, dtype=np.float64)
+        self._last_detection = 0.0
+
+    def add_frame(self, frame: AudioFrame) -> Optional[float]:
+        '''
+        Returns the latency of a sweep that ended in this frame in seconds or None.
+        '''
+        now = time.monotonic()
+        #the resampler expects continuous pts but received frames can jump. A copy without pts is
+        #resampled as the frame may still be used by others e.g. a recorder
+        copy = AudioFrame.from_ndarray(frame.to_ndarray(), format=frame.format.name, layout=frame.layout.name)
+        copy.sample_rate = frame.sample_rate
+        new = np.concatenate([f.to_ndarray().reshape(-1) for f in self._resampler.resample(copy)]).astype(np.float64) / 32767
+        #keep enough history to find a sweep that started before this frame
+        template_len = len(self.template)
+        self._history = np.concatenate([self._history, new])[-(template_len + len(new)):]
+        if len(self._history) < template_len:
+            return None
+
+        #correlation via FFT. Only starts whose sweep ends within the new samples are checked
+        history = self._history
+        n = len(history) + template_len
+        corr = np.fft.irfft(np.fft.rfft(history, n) * np.conj(np.fft.rfft(self.template, n)), n)[:len(history) - template_len + 1]
+        energy = np.sqrt(np.convolve(history ** 2, np.ones(template_len), "valid"))
+        score = corr / np.maximum(energy * self.template_energy, 1e-9)
+        start = int(np.argmax(score))
+        if score[start] < AudioLatencyAnalyzer.THRESHOLD:
+            return None
+
+        #like on the sending side the time of recv is the time the first sample of the frame plays
+        detected = now - (len(history) - len(new) - start) / self.sample_rate
+        if detected - self._last_detection < self.sender.interval / 2:
+            return None
+        self._last_detection = detected
+        self.detections += 1
+        #the sweep sent last before it was received
+        sent = [t for t in self.sender.marker_times if t <= detected + 0.005]
+        if not sent:
+            return None
+        latency = max(0.0, detected - sent[-1])
+        self.latency.add(latency)
+        return latency
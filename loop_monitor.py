@@ -0,0 +1,206 @@
+import asyncio
+from dataclasses import dataclass
+import logging
+import sys
+import threading
+import time
+import traceback
+from types import FrameType
+from typing import Dict, List, Optional
+
+from prefix_logger import PrefixLogger
+
+'''
+Opt-in monitor for the asyncio event loop. Finds code that blocks the loop e.g. encoding,
+synchronous file or device IO or parsing large messages.
+
+A task on the loop wakes up every interval and measures how late it is (the loop lag).
+A watchdog thread checks that the task keeps running. If the loop is blocked for longer than
+threshold the watchdog captures the stack of the loop thread while it is still blocked.
+Once the loop runs again the blocked time is added to the component that blocked it.
+
+The component is the name of the innermost PrefixLogger found on the stack (self.logger or a
+local logger), otherwise the name of the module logger. E.g. "awrtc.call.CallPeer".
+
+Example:
+    monitor = LoopMonitor(PrefixLogger("app").get_child("LoopMonitor"))
+    monitor.start()
+    ...
+    monitor.log_report()
+    await monitor.stop()
+'''
+
+
+@dataclass
+class LoopLagStats:
+    #number of lag measurements
+    samples: int = 0
+    last_lag_ms: float = 0
+    max_lag_ms: float = 0
+    total_lag_ms: float = 0
+    #measurements with a lag above the threshold
+    stalls: int = 0
+    #sum of the lag above the threshold
+    blocked_ms: float = 0
+
+    @property
+    def average_lag_ms(self) -> float:
+        if self.samples == 0:
+            return 0
+        return self.total_lag_ms / self.samples
+
+
+@dataclass
+class BlockingTotal:
+    count: int = 0
+    total_ms: float = 0
+    max_ms: float = 0
+    #stack of the longest stall
+    stack: str = ""
+
+
+#used if the watchdog didn't see the stall e.g. because it was shorter than its check interval
+UNKNOWN_COMPONENT = "unknown"
+
+
+def find_component(frame: Optional[FrameType]) -> str:
+    '''
+    Returns the logger name of the innermost frame that has one. frame is the innermost frame.
+    '''
+    module_name = None
+    while frame is not None:
+        f_locals = frame.f_locals
+        owner = f_locals.get("self")
+        for candidate in (getattr(owner, "logger", None), f_locals.get("logger")):
+            if isinstance(candidate, PrefixLogger):
+                return candidate.name
+        if module_name is None:
+            module_logger = frame.f_globals.get("logger")
+            if isinstance(module_logger, (PrefixLogger, logging.Logger)):
+                module_name = module_logger.name
+        frame = frame.f_back
+    return module_name or UNKNOWN_COMPONENT
+
+
+class LoopMonitor:
+    '''
+    Measures the event loop lag and attributes stalls to components. start and stop must be called
+    on the loop that is monitored.
+    '''
+
+    #stacks logged per stall. Deeper frames are mostly asyncio internals
+    STACK_LIMIT = 12
+
+    def __init__(self, logger: PrefixLogger, threshold: float = 0.1, interval: float = 0.05,
+                 log_stalls: bool = True, report_interval: Optional[float] = None):
+        self.logger = logger
+        self.threshold = threshold
+        self.interval = interval
+        #logs a warning with the stack for each stall
+        self.log_stalls = log_stalls
+        #if set log_report is called periodically
+        self.report_interval = report_interval
+        self.stats = LoopLagStats()
+        #component name -> blocking time
+        self.totals: Dict[str, BlockingTotal] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._watchdog: Optional[threading.Thread] = None
+        self._running = False
+        self._loop_thread_id = 0
+        #time.monotonic the loop task ran last. Written by the loop, read by the watchdog
+        self._heartbeat = 0.0
+        #(component, stack) captured by the watchdog during the current stall
+        self._lock = threading.Lock()
+        self._captured: Optional[tuple[str, str]] = None
+
+    def start(self) -> None:
+        if self._running:
+            return
+        self._running = True
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._task = asyncio.create_task(self._run())
+        self._watchdog = threading.Thread(target=self._run_watchdog, name="LoopMonitor", daemon=True)
+        self._watchdog.start()
+
+    async def stop(self) -> None:
+        self._running = False
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._watchdog is not None:
+            self._watchdog.join()
+            self._watchdog = None
+
+    async def _run(self) -> None:
+        last_report = time.monotonic()
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self._heartbeat = now
+            self._add_lag(max(0.0, now - expected))
+            if self.report_interval is not None and now - last_report >= self.report_interval:
+                last_report = now
+                self.log_report()
+
+    def _add_lag(self, lag: float) -> None:
+        lag_ms = lag * 1000
+        s = self.stats
+        s.samples += 1
+        s.last_lag_ms = lag_ms
+        s.max_lag_ms = max(s.max_lag_ms, lag_ms)
+        s.total_lag_ms += lag_ms
+        with self._lock:
+            captured = self._captured
+            self._captured = None
+        if lag < self.threshold:
+            return
+        s.stalls += 1
+        s.blocked_ms += lag_ms
+        component, stack = captured if captured is not None else (UNKNOWN_COMPONENT, "")
+        total = self.totals.get(component)
+        if total is None:
+            total = BlockingTotal()
+            self.totals[component] = total
+        total.count += 1
+        total.total_ms += lag_ms
+        if lag_ms > total.max_ms:
+            total.max_ms = lag_ms
+            total.stack = stack
+        if self.log_stalls:
+            self.logger.warning(f"Event loop blocked for {lag_ms:.1f}ms by {component}\n{stack}")
+
+    def _run_watchdog(self) -> None:
+        #checks a few times per threshold so stalls are caught while they still block
+        check_interval = self.threshold / 4
+        while self._running:
+            time.sleep(check_interval)
+            blocked = time.monotonic() - self._heartbeat - self.interval
+            if blocked < self.threshold:
+                continue
+            with self._lock:
+                if self._captured is not None:
+                    #the first capture of a stall is kept. Later ones are usually the same callback
+                    continue
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            component = find_component(frame)
+            stack = "".join(traceback.format_stack(frame, limit=LoopMonitor.STACK_LIMIT))
+            with self._lock:
+                self._captured = (component, stack)
+
+    def top_components(self, count: int = 5) -> List[tuple[str, BlockingTotal]]:
+        return sorted(self.totals.items(), key=lambda item: item[1].total_ms, reverse=True)[:count]
+
+    def log_report(self) -> None:
+        s = self.stats
+        self.logger.info(f"Loop lag avg {s.average_lag_ms:.1f}ms max {s.max_lag_ms:.1f}ms "
+                         f"stalls {s.stalls} blocked {s.blocked_ms:.0f}ms")
+        for component, total in self.top_components():
+            self.logger.info(f"  {component}: {total.count} stalls {total.total_ms:.0f}ms max {total.max_ms:.0f}ms")
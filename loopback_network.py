@@ -0,0 +1,192 @@
+import asyncio
+from typing import Dict, List, Optional, Tuple
+
+from prefix_logger import PrefixLogger
+from websocket_network import ConnectionId, NetEventType, NetworkEvent, WebsocketNetwork
+
+'''
+In-memory signaling for several Calls within one process. Used for tests and benchmarks
+that shouldn't depend on a signaling server.
+
+The LoopbackSignalingServer implements the parts of the awrtc signaling protocol the Call uses
+(listen, connect, messages, disconnect). Each Call gets a LoopbackNetwork that is injected instead
+of the WebsocketNetwork. The events are still serialized like on the real connection but are
+delivered via queues without any timers, so the order of events is deterministic.
+
+Example:
+    server = LoopbackSignalingServer()
+    listener = Call(None, handler1, network=server.create_network(logger))
+    caller = Call(None, handler2, network=server.create_network(logger))
+    asyncio.create_task(listener.listen("test"))
+    await server.wait_listening("test")
+    asyncio.create_task(caller.call("test"))
+'''
+
+
+class LoopbackNetwork(WebsocketNetwork):
+    '''
+    WebsocketNetwork that exchanges its messages with a LoopbackSignalingServer. Created via LoopbackSignalingServer.create_network.
+    '''
+
+    def __init__(self, server: "LoopbackSignalingServer", logger: PrefixLogger):
+        super().__init__(logger)
+        self.logger = logger.get_child("LoopbackNetwork")
+        self._server = server
+        #messages from the server. None ends process_messages
+        self._queue: asyncio.Queue[Optional[bytes]] = asyncio.Queue()
+        self._closed = False
+        #ids the server assigns to incoming connections of this network
+        self.next_incoming_id = LoopbackSignalingServer.FIRST_INCOMING_ID
+
+    async def start(self, uri):
+        self.logger.info("Connecting to the loopback signaling server")
+        await self.send_version()
+        response = await self._queue.get()
+        if response is not None:
+            await self.process_message(response)
+        self.logger.info("Ready to exchange messages")
+
+    async def process_messages(self):
+        while True:
+            msg = await self._queue.get()
+            if msg is None:
+                break
+            try:
+                await self.process_message(msg)
+            except Exception as e:
+                self.logger.error(f"process_messages triggered an exception: {e}")
+        self.logger.info("process_messages stopped")
+
+    async def _internal_send(self, msg):
+        if self._closed:
+            return
+        self._server.receive(self, bytes(msg))
+
+    def deliver(self, msg: bytes) -> None:
+        if not self._closed:
+            self._queue.put_nowait(msg)
+
+    async def shutdown(self):
+        if self._closed:
+            return
+        #closed first so the Disconnected events of its own connections aren't delivered. Like a closed
+        #websocket this network receives nothing after shutdown and its Call already closed the peers
+        self._closed = True
+        self._server.remove(self)
+        self._queue.put_nowait(None)
+
+
+class LoopbackSignalingServer:
+    '''
+    Routes the signaling messages between LoopbackNetworks. In conference mode several networks
+    can listen on the same address and are connected with each other like on the real server.
+    '''
+
+    #the signaling server assigns incoming connections ids starting at 16384
+    FIRST_INCOMING_ID = 16384
+
+    def __init__(self, conference: bool = False):
+        self.conference = conference
+        #address -> listening networks
+        self._listeners: Dict[str, List[LoopbackNetwork]] = {}
+        #(network, connection id) -> (network, connection id) of the other side
+        self._links: Dict[Tuple[LoopbackNetwork, int], Tuple[LoopbackNetwork, int]] = {}
+        self._listening: Dict[str, asyncio.Event] = {}
+        #messages routed. Used by benchmarks
+        self.message_count = 0
+
+    def create_network(self, logger: PrefixLogger) -> LoopbackNetwork:
+        return LoopbackNetwork(self, logger)
+
+    async def wait_listening(self, address: str) -> None:
+        '''
+        Waits until a network listens on the address. Calls made after this won't fail.
+        '''
+        await self._listening_event(address).wait()
+
+    def _listening_event(self, address: str) -> asyncio.Event:
+        event = self._listening.get(address)
+        if event is None:
+            event = asyncio.Event()
+            self._listening[address] = event
+        return event
+
+    def receive(self, network: LoopbackNetwork, msg: bytes) -> None:
+        self.message_count += 1
+        if msg[0] == NetEventType.MetaVersion.value:
+            network.deliver(bytes([NetEventType.MetaVersion.value, WebsocketNetwork.PROTOCOL_VERSION]))
+            return
+        if msg[0] == NetEventType.MetaHeartbeat.value:
+            network.deliver(bytes([NetEventType.MetaHeartbeat.value]))
+            return
+        evt = NetworkEvent.from_byte_array(msg)
+        if evt.type == NetEventType.ServerInitialized:
+            self._listen(network, evt.info)
+        elif evt.type == NetEventType.ServerClosed:
+            self._stop_listening(network)
+            self._send(network, NetEventType.ServerClosed, ConnectionId.INVALID(), None)
+        elif evt.type == NetEventType.NewConnection:
+            self._connect(network, evt.connection_id.id, evt.info)
+        elif evt.type == NetEventType.Disconnected:
+            self._disconnect(network, evt.connection_id.id)
+        elif evt.type in (NetEventType.ReliableMessageReceived, NetEventType.UnreliableMessageReceived):
+            other = self._links.get((network, evt.connection_id.id))
+            if other is not None:
+                self._send(other[0], evt.type, ConnectionId(other[1]), evt.raw_data)
+
+    def remove(self, network: LoopbackNetwork) -> None:
+        '''
+        Called when a network shuts down. The other side of each of its connections is disconnected.
+        '''
+        self._stop_listening(network)
+        for (net, connection_id) in [key for key in self._links if key[0] is network]:
+            self._disconnect(net, connection_id)
+
+    def _send(self, network: LoopbackNetwork, type: NetEventType, connection_id: ConnectionId, data) -> None:
+        network.deliver(bytes(NetworkEvent.to_byte_array(NetworkEvent(type, connection_id, data))))
+
+    def _listen(self, network: LoopbackNetwork, address: str) -> None:
+        listeners = self._listeners.setdefault(address, [])
+        if listeners and not self.conference:
+            self._send(network, NetEventType.ServerInitFailed, ConnectionId.INVALID(), address)
+            return
+        self._send(network, NetEventType.ServerInitialized, ConnectionId.INVALID(), address)
+        #conference: everyone already listening connects to the new user
+        for other in listeners:
+            self._link(network, self._incoming_id(network), other, self._incoming_id(other))
+        listeners.append(network)
+        self._listening_event(address).set()
+
+    def _stop_listening(self, network: LoopbackNetwork) -> None:
+        for address, listeners in self._listeners.items():
+            if network in listeners:
+                listeners.remove(network)
+                if not listeners:
+                    self._listening_event(address).clear()
+
+    def _connect(self, network: LoopbackNetwork, connection_id: int, address: str) -> None:
+        listeners = self._listeners.get(address)
+        if not listeners:
+            self._send(network, NetEventType.ConnectionFailed, ConnectionId(connection_id), None)
+            return
+        listener = listeners[0]
+        self._link(network, connection_id, listener, self._incoming_id(listener))
+
+    def _incoming_id(self, network: LoopbackNetwork) -> int:
+        connection_id = network.next_incoming_id
+        network.next_incoming_id += 1
+        return connection_id
+
+    def _link(self, a: LoopbackNetwork, a_id: int, b: LoopbackNetwork, b_id: int) -> None:
+        self._links[(a, a_id)] = (b, b_id)
+        self._links[(b, b_id)] = (a, a_id)
+        self._send(a, NetEventType.NewConnection, ConnectionId(a_id), None)
+        self._send(b, NetEventType.NewConnection, ConnectionId(b_id), None)
+
+    def _disconnect(self, network: LoopbackNetwork, connection_id: int) -> None:
+        other = self._links.pop((network, connection_id), None)
+        if other is None:
+            return
+        self._links.pop(other, None)
+        self._send(network, NetEventType.Disconnected, ConnectionId(connection_id), None)
+        self._send(other[0], NetEventType.Disconnected, ConnectionId(other[1]), None)
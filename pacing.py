@@ -0,0 +1,187 @@
+import asyncio
+import time
+import weakref
+from dataclasses import dataclass
+from fractions import Fraction
+from typing import Dict, List, Optional, Tuple
+
+'''
+Shared pacing for generated tracks.
+
+Every track used to sleep on its own timer based on time.time(). With hundreds of tracks this means
+hundreds of timers that drift apart and jump with the wall clock. A PacingClock instead keeps one timer
+per frame period (e.g. one for all 30 fps video tracks and one for all 20 ms audio tracks) based on
+time.monotonic_ns. The timer wakes all tracks that are due at once.
+
+Each track uses a Pacer which counts its frames. The pts is calculated from this count so it
+is exact and never affected by timer jitter. The Pacer also records how late each frame was.
+
+Example:
+    pacer = Pacer(Fraction(1, 30))
+    while True:
+        await pacer.next_frame()
+        frame.pts = pacer.pts(90000)
+'''
+
+
+@dataclass
+class PacerStats:
+    frames: int = 0
+    #frames that were returned later than one frame period after their deadline
+    late_frames: int = 0
+    #frames skipped because the track fell behind (only if skip_missed is set)
+    skipped_frames: int = 0
+    #delay between the deadline and the time the track was woken up
+    last_lag_ns: int = 0
+    max_lag_ns: int = 0
+    total_lag_ns: int = 0
+
+    @property
+    def average_lag_ms(self) -> float:
+        if self.frames == 0:
+            return 0
+        return self.total_lag_ns / self.frames / 1_000_000
+
+
+class _Bucket:
+    '''
+    All pacers with the same frame period. Deadlines are origin + tick * period.
+    '''
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, period: Fraction, origin_ns: int):
+        self.loop = loop
+        #period in ns as integer fraction. Fraction arithmetic is too slow for the per frame calls
+        period_ns = period * 1_000_000_000
+        self.period_num = period_ns.numerator
+        self.period_den = period_ns.denominator
+        self.period_ns = int(period_ns)
+        self.origin_ns = origin_ns
+        #(tick, future) of the pacers waiting for a tick
+        self.waiters: List[Tuple[int, asyncio.Future]] = []
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.timer_tick = -1
+
+    def deadline_ns(self, tick: int) -> int:
+        return self.origin_ns + tick * self.period_num // self.period_den
+
+    def tick_at(self, now_ns: int) -> int:
+        return (now_ns - self.origin_ns) * self.period_den // self.period_num
+
+    def wait(self, tick: int) -> asyncio.Future:
+        future = self.loop.create_future()
+        self.waiters.append((tick, future))
+        if self.timer is None or tick < self.timer_tick:
+            self._schedule(tick)
+        return future
+
+    def _schedule(self, tick: int) -> None:
+        if self.timer is not None:
+            self.timer.cancel()
+        delay = (self.deadline_ns(tick) - time.monotonic_ns()) / 1_000_000_000
+        self.timer_tick = tick
+        self.timer = self.loop.call_later(max(0, delay), self._on_timer)
+
+    def _on_timer(self) -> None:
+        self.timer = None
+        current = self.tick_at(time.monotonic_ns())
+        pending = []
+        for tick, future in self.waiters:
+            if tick <= current:
+                if not future.done():
+                    future.set_result(None)
+            else:
+                pending.append((tick, future))
+        self.waiters = pending
+        if pending:
+            self._schedule(min(tick for tick, _ in pending))
+
+
+class PacingClock:
+    '''
+    One timer per frame period for all pacers of an event loop. Use PacingClock.get() to get the shared instance.
+    '''
+
+    _instances: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, PacingClock]" = weakref.WeakKeyDictionary()
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.origin_ns = time.monotonic_ns()
+        self._buckets: Dict[Fraction, _Bucket] = {}
+
+    @staticmethod
+    def get() -> "PacingClock":
+        '''
+        Shared clock of the running event loop.
+        '''
+        loop = asyncio.get_running_loop()
+        clock = PacingClock._instances.get(loop)
+        if clock is None:
+            clock = PacingClock(loop)
+            PacingClock._instances[loop] = clock
+        return clock
+
+    def bucket(self, period: Fraction) -> _Bucket:
+        bucket = self._buckets.get(period)
+        if bucket is None:
+            bucket = _Bucket(self.loop, period, self.origin_ns)
+            self._buckets[period] = bucket
+        return bucket
+
+    @property
+    def timer_count(self) -> int:
+        return sum(1 for bucket in self._buckets.values() if bucket.timer is not None)
+
+
+class Pacer:
+    '''
+    Paces a single track. period is the frame duration in seconds e.g. Fraction(1, 30) or Fraction(960, 48000).
+
+    If the track falls behind video tracks should set skip_missed to continue with the current frame.
+    Audio tracks keep it False and catch up by returning the missed frames without waiting.
+    '''
+
+    def __init__(self, period: Fraction, skip_missed: bool = False, clock: Optional[PacingClock] = None):
+        self.period = Fraction(period)
+        self._period_num = self.period.numerator
+        self._period_den = self.period.denominator
+        self.skip_missed = skip_missed
+        self._clock = clock
+        self._bucket: Optional[_Bucket] = None
+        self._start_tick = 0
+        #index of the current frame. -1 until next_frame was called the first time
+        self.index = -1
+        self.stats = PacerStats()
+
+    async def next_frame(self) -> int:
+        '''
+        Waits until the next frame is due and returns its index. The first frame is returned right away.
+        '''
+        if self._bucket is None:
+            clock = self._clock if self._clock is not None else PacingClock.get()
+            self._bucket = clock.bucket(self.period)
+            self._start_tick = self._bucket.tick_at(time.monotonic_ns())
+            self.index = 0
+        else:
+            self.index += 1
+            now_tick = self._bucket.tick_at(time.monotonic_ns())
+            due_tick = self._start_tick + self.index
+            if due_tick > now_tick:
+                await self._bucket.wait(due_tick)
+            elif self.skip_missed and due_tick < now_tick:
+                self.stats.skipped_frames += now_tick - due_tick
+                self.index = now_tick - self._start_tick
+
+        lag = max(0, time.monotonic_ns() - self._bucket.deadline_ns(self._start_tick + self.index))
+        self.stats.frames += 1
+        self.stats.last_lag_ns = lag
+        self.stats.total_lag_ns += lag
+        self.stats.max_lag_ns = max(self.stats.max_lag_ns, lag)
+        if lag > self._bucket.period_ns:
+            self.stats.late_frames += 1
+        return self.index
+
+    def pts(self, clock_rate: int) -> int:
+        '''
+        pts of the current frame for the given clock rate e.g. 90000 for video or the sample rate for audio.
+        '''
+        return self.index * self._period_num * clock_rate // self._period_den
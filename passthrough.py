@@ -0,0 +1,264 @@
+import fractions
+import time
+import traceback
+from typing import Callable, List, Optional, Tuple, cast
+
+import av
+from aiortc import RTCRtpCodecParameters, RTCRtpReceiver
+from aiortc.jitterbuffer import JitterFrame
+from av.audio.layout import AudioLayout
+from av.audio.stream import AudioStream
+from av.container.output import OutputContainer
+from av.stream import Stream
+from av.video.codeccontext import VideoCodecContext
+from av.video.stream import VideoStream
+import logging
+logger = logging.getLogger(__name__)
+
+'''
+Access to the encoded media of an RTCRtpReceiver before aiortc decodes it.
+
+aiortc 1.9 hands every complete (depacketized) frame to a decoder thread via a private queue.
+install_encoded_frame_tap replaces this queue with a wrapper that passes each frame to a callback
+and optionally skips decoding entirely. The PassthroughRecorder uses this to write the received
+VP8 / H264 / Opus frames into a container without decoding and encoding them again.
+'''
+
+#called on the event loop for every complete encoded frame
+EncodedFrameCallback = Callable[[RTCRtpCodecParameters, JitterFrame], None]
+
+
+class _DecoderQueueTap:
+    def __init__(self, queue, callback: EncodedFrameCallback, decode: bool):
+        self._queue = queue
+        self._callback = callback
+        self._decode = decode
+
+    def put(self, item, *args, **kwargs):
+        if item is not None:
+            codec, encoded_frame = item
+            try:
+                self._callback(codec, encoded_frame)
+            except Exception as e:
+                logger.error(f"Encoded frame callback failed: {e}\n{traceback.format_exc()}")
+            if not self._decode:
+                return
+        #None is the shutdown signal for the decoder thread and always forwarded
+        self._queue.put(item, *args, **kwargs)
+
+    def get(self, *args, **kwargs):
+        return self._queue.get(*args, **kwargs)
+
+
+def install_encoded_frame_tap(receiver: RTCRtpReceiver, callback: EncodedFrameCallback, decode: bool = True) -> None:
+    '''
+    Passes each encoded frame received by the receiver to the callback.
+    If decode is False the frames are not decoded and the receiver's track will not return any frames.
+    This accesses a private member of aiortc's RTCRtpReceiver and needs to be checked when updating aiortc.
+    '''
+    #the decoder thread might already run with the original queue. The tap forwards to it
+    queue = receiver._RTCRtpReceiver__decoder_queue  # type: ignore
+    receiver._RTCRtpReceiver__decoder_queue = _DecoderQueueTap(queue, callback, decode)  # type: ignore
+
+
+#maps the mime type of aiortc's codecs to the ffmpeg codec used for the container stream
+PASSTHROUGH_CODECS = {
+    "video/vp8": "libvpx",
+    "video/h264": "libx264",
+    "audio/opus": "libopus",
+}
+
+#ffmpeg decoder names used to parse the frame size without decoding
+PARSER_CODECS = {
+    "video/vp8": "vp8",
+    "video/h264": "h264",
+}
+
+
+def is_keyframe(mime_type: str, data: bytes) -> bool:
+    mime_type = mime_type.lower()
+    if mime_type == "video/vp8":
+        #first bit of the VP8 frame tag is 0 for keyframes
+        return len(data) > 0 and (data[0] & 0x01) == 0
+    if mime_type == "video/h264":
+        #aiortc depacketizes H264 into Annex B. Look for IDR or SPS NAL units
+        i = data.find(b"\x00\x00\x01")
+        while i != -1 and i + 3 < len(data):
+            nal_type = data[i + 3] & 0x1F
+            if nal_type == 5 or nal_type == 7:
+                return True
+            i = data.find(b"\x00\x00\x01", i + 3)
+        return False
+    #audio frames are all independent
+    return True
+
+
+def parse_frame_size(mime_type: str, data: bytes) -> Tuple[int, int]:
+    '''
+    Reads the frame size of a keyframe from its bitstream headers without decoding it.
+    Returns (0, 0) if the codec isn't supported or the size couldn't be read.
+    '''
+    parser_codec = PARSER_CODECS.get(mime_type.lower())
+    if parser_codec is None:
+        return 0, 0
+    #a parser keeps the size of the first keyframe it saw so each keyframe gets a new one
+    parser = cast(VideoCodecContext, av.CodecContext.create(parser_codec, "r"))
+    parser.parse(data)
+    #the h264 parser only finishes a frame once the next one starts. None flushes it
+    parser.parse(None)
+    return parser.width, parser.height
+
+
+class _PassthroughInput:
+    def __init__(self, kind: str):
+        self.kind = kind
+        self.mime_type: Optional[str] = None
+        self.clock_rate = 0
+        self.width = 0
+        self.height = 0
+        #set once the first usable frame (keyframe for video) arrived
+        self.ready = False
+        #aiortc already unwraps the RTP timestamps and starts them at 0
+        self.first_timestamp = 0
+        self.last_dts = -1
+        self.stream: Optional[Stream] = None
+
+
+class PassthroughRecorder:
+    """
+    Records the encoded frames of RTCRtpReceivers without decoding them.
+    Supported are VP8, H264 and Opus. Use .mkv to support any combination,
+    .webm for VP8 + Opus or .mp4 for H264 + Opus.
+
+    The container header can only be written once all streams are known. Frames are buffered
+    until every receiver delivered its first usable frame or STREAM_SETUP_TIMEOUT passed.
+    """
+
+    STREAM_SETUP_TIMEOUT = 2.0
+
+    def __init__(self, file, container_format: Optional[str] = None, decode: bool = False):
+        self.__container: Optional[OutputContainer] = av.open(file=file, format=container_format, mode="w")
+        #if True the received frames are still decoded for other users of the tracks
+        self.__decode = decode
+        self.__inputs: List[_PassthroughInput] = []
+        self.__pending: List[Tuple[_PassthroughInput, JitterFrame]] = []
+        self.__header_ready = False
+        self.__first_ready_time: Optional[float] = None
+        self.__running = False
+        self.muxed_frames = 0
+        self.dropped_frames = 0
+
+    def addReceiver(self, receiver: RTCRtpReceiver) -> None:
+        """
+        Add the receiver of an incoming track to be recorded.
+        """
+        kind = receiver.track.kind if receiver.track is not None else "video"
+        inp = _PassthroughInput(kind)
+        self.__inputs.append(inp)
+        install_encoded_frame_tap(receiver, lambda codec, frame: self.__on_frame(inp, codec, frame), self.__decode)
+
+    async def start(self) -> None:
+        self.__running = True
+
+    async def stop(self) -> None:
+        self.__running = False
+        if self.__container is None:
+            return
+        if not self.__header_ready and self.__pending:
+            self.__setup_streams()
+        self.__container.close()
+        self.__container = None
+        logger.info(f"PassthroughRecorder stopped. muxed {self.muxed_frames} dropped {self.dropped_frames}")
+
+    def __on_frame(self, inp: _PassthroughInput, codec: RTCRtpCodecParameters, frame: JitterFrame) -> None:
+        if not self.__running or self.__container is None:
+            return
+        if inp.mime_type is None:
+            inp.mime_type = codec.mimeType.lower()
+            inp.clock_rate = codec.clockRate
+            if inp.mime_type not in PASSTHROUGH_CODECS:
+                logger.warning(f"PassthroughRecorder can not record {codec.mimeType}")
+        if inp.mime_type not in PASSTHROUGH_CODECS:
+            return
+
+        if not inp.ready:
+            if not is_keyframe(inp.mime_type, frame.data):
+                #recording can only start with a keyframe
+                self.dropped_frames += 1
+                return
+            if not self.__header_ready:
+                self.__prepare_input(inp, frame)
+                if not inp.ready:
+                    self.dropped_frames += 1
+                    return
+            else:
+                #streams can't be added once the header was written
+                return
+
+        if self.__header_ready:
+            self.__mux(inp, frame)
+            return
+
+        self.__pending.append((inp, frame))
+        if self.__first_ready_time is None:
+            self.__first_ready_time = time.monotonic()
+        all_ready = all(i.ready for i in self.__inputs)
+        if all_ready or time.monotonic() - self.__first_ready_time > PassthroughRecorder.STREAM_SETUP_TIMEOUT:
+            self.__setup_streams()
+
+    def __prepare_input(self, inp: _PassthroughInput, frame: JitterFrame) -> None:
+        if inp.mime_type is None:
+            return
+        if inp.kind == "video":
+            inp.width, inp.height = parse_frame_size(inp.mime_type, frame.data)
+            if inp.width == 0 or inp.height == 0:
+                logger.warning("PassthroughRecorder could not read the frame size of the keyframe")
+                return
+        inp.first_timestamp = frame.timestamp
+        inp.ready = True
+
+    def __setup_streams(self) -> None:
+        if self.__container is None:
+            return
+        for inp in self.__inputs:
+            if not inp.ready or inp.mime_type is None:
+                continue
+            stream = self.__container.add_stream(PASSTHROUGH_CODECS[inp.mime_type])
+            if inp.kind == "video":
+                video_stream = cast(VideoStream, stream)
+                video_stream.width = inp.width
+                video_stream.height = inp.height
+                video_stream.pix_fmt = "yuv420p"
+            else:
+                #the libopus encoder writes the OpusHead codec private data once the container is started
+                audio_stream = cast(AudioStream, stream)
+                audio_stream.sample_rate = inp.clock_rate
+                audio_stream.layout = AudioLayout("stereo")
+            stream.time_base = fractions.Fraction(1, inp.clock_rate)
+            inp.stream = stream
+        self.__header_ready = True
+        pending = self.__pending
+        self.__pending = []
+        for inp, frame in pending:
+            self.__mux(inp, frame)
+
+    def __mux(self, inp: _PassthroughInput, frame: JitterFrame) -> None:
+        if inp.stream is None or inp.mime_type is None or self.__container is None:
+            return
+        ts = frame.timestamp - inp.first_timestamp
+        if ts <= inp.last_dts:
+            self.dropped_frames += 1
+            return
+        packet = av.Packet(frame.data)
+        packet.pts = ts
+        packet.dts = ts
+        packet.time_base = fractions.Fraction(1, inp.clock_rate)
+        packet.is_keyframe = is_keyframe(inp.mime_type, frame.data)
+        packet.stream = inp.stream
+        try:
+            self.__container.mux(packet)
+            inp.last_dts = ts
+            self.muxed_frames += 1
+        except Exception as e:
+            self.dropped_frames += 1
+            logger.warning(f"PassthroughRecorder failed to mux a frame: {e}")
@@ -1,42 +1,195 @@
+from dataclasses import dataclass
 import logging
-from typing import Any, Optional, List
+import re
+import time
+from typing import Any, Dict, Optional, Union
 
 '''
 PrefixLogger: Enforces hierarchical logging structure.
 - Wraps logging.getLogger("name") and forwards calls to it.
-- Use get_child("suffix") to create loggers with automatic prefixing.
+- Use get_child("suffix") to create loggers with automatic prefixing. Children are cached.
 - Pass PrefixLogger instances to objects for consistent hierarchy.
 
+Hot paths should pass arguments instead of f-strings. They are only formatted if the level is
+enabled. Large payloads like SDPs or data channel messages are wrapped in LogPayload which
+redacts secrets and truncates them when the message is formatted.
+
+Messages can be given a category. Each category can be sampled and rate limited via set_log_limit.
+The limits apply per PrefixLogger e.g. every CallPeer has its own budget. Once a message passes again
+the number of suppressed messages is appended.
+
 Example:
     logger = PrefixLogger("app")
     child_logger = logger.get_child("Component")
     child_logger.info("Message")  # Logs as "app.Component: Message"
+    child_logger.debug("Received %s", LogPayload(sdp), category="signaling")
 '''
+
+
+@dataclass
+class LogLimit:
+    #only every nth message of the category is logged
+    sample_every: int = 1
+    #max messages per second after sampling. None for no limit
+    rate: Optional[float] = None
+    #messages that can be logged at once before the rate applies
+    burst: int = 10
+
+
+#category -> limit. Categories without limit and warnings or errors of any category are always logged
+_log_limits: Dict[str, LogLimit] = {
+    #one log line per data channel message would cost more than the message itself
+    "data": LogLimit(rate=10, burst=20),
+    #each peer sends a few messages during setup. Only a misbehaving peer hits this
+    "signaling": LogLimit(rate=20, burst=50),
+}
+
+
+def set_log_limit(category: str, limit: Optional[LogLimit]) -> None:
+    '''
+    Sets the limit of a category for all loggers. None removes it.
+    '''
+    if limit is None:
+        _log_limits.pop(category, None)
+    else:
+        _log_limits[category] = limit
+
+
+class _LogLimiter:
+    def __init__(self, limit: LogLimit):
+        self.limit = limit
+        self.count = 0
+        self.suppressed = 0
+        self.tokens = float(limit.burst)
+        self.last_refill = time.monotonic()
+
+    def allow(self) -> Optional[int]:
+        '''
+        Returns None if the message is suppressed, otherwise the number of messages suppressed before it.
+        '''
+        limit = self.limit
+        self.count += 1
+        if (self.count - 1) % limit.sample_every != 0:
+            self.suppressed += 1
+            return None
+        if limit.rate is not None:
+            now = time.monotonic()
+            self.tokens = min(float(limit.burst), self.tokens + (now - self.last_refill) * limit.rate)
+            self.last_refill = now
+            if self.tokens < 1:
+                self.suppressed += 1
+                return None
+            self.tokens -= 1
+        suppressed = self.suppressed
+        self.suppressed = 0
+        return suppressed
+
+
+#ICE credentials and DTLS fingerprints of an SDP. Also matches SDPs escaped within JSON
+_REDACT_PATTERN = re.compile(r"(a=(?:ice-pwd|ice-ufrag):|a=fingerprint:\S+ )[^\s\\\"]+")
+
+
+def redact(text: str) -> str:
+    return _REDACT_PATTERN.sub(r"\1<redacted>", text)
+
+
+def truncate(text: str, max_length: int) -> str:
+    if len(text) <= max_length:
+        return text
+    return f"{text[:max_length]}... ({len(text)} chars)"
+
+
+class LogPayload:
+    '''
+    Wraps a large message for logging. Redacting and truncating only happen if the message is logged.
+    '''
+
+    __slots__ = ("data", "max_length", "redact")
+
+    MAX_LENGTH = 200
+
+    def __init__(self, data: Union[str, bytes], max_length: int = MAX_LENGTH, redact: bool = True):
+        self.data = data
+        self.max_length = max_length
+        self.redact = redact
+
+    def __str__(self) -> str:
+        if isinstance(self.data, (bytes, bytearray)):
+            #repr of the first bytes only. The rest isn't formatted
+            text = f"{len(self.data)} bytes {self.data[:self.max_length]!r}"
+            return truncate(text, self.max_length)
+        text = redact(self.data) if self.redact else self.data
+        return truncate(text, self.max_length)
+
+
 class PrefixLogger:
+    #children cached per logger. Loggers with an id in the name (e.g. CallPeer1) would grow it without limit
+    MAX_CACHED_CHILDREN = 256
+
     def __init__(self, name: str):
         self.logger = logging.getLogger(name)
         self.name = name
+        self._children: Dict[str, 'PrefixLogger'] = {}
+        #category -> limiter of this logger
+        self._limiters: Dict[str, _LogLimiter] = {}
+
+    def is_enabled_for(self, level: int) -> bool:
+        '''
+        Use to skip building expensive log arguments.
+        '''
+        return self.logger.isEnabledFor(level)
+
+    def debug(self, msg: str, *args: Any, category: Optional[str] = None, **kwargs: Any) -> None:
+        self._log(logging.DEBUG, msg, args, category, kwargs)
 
-    def debug(self, msg: str, *args: Any, **kwargs: Any) -> None:
-        self.logger.debug(msg, *args, **kwargs)
+    def info(self, msg: str, *args: Any, category: Optional[str] = None, **kwargs: Any) -> None:
+        self._log(logging.INFO, msg, args, category, kwargs)
 
-    def info(self, msg: str, *args: Any, **kwargs: Any) -> None:
-        self.logger.info(msg, *args, **kwargs)
+    def warning(self, msg: str, *args: Any, category: Optional[str] = None, **kwargs: Any) -> None:
+        self._log(logging.WARNING, msg, args, category, kwargs)
 
-    def warning(self, msg: str, *args: Any, **kwargs: Any) -> None:
-        self.logger.warning(msg, *args, **kwargs)
+    def error(self, msg: str, *args: Any, category: Optional[str] = None, **kwargs: Any) -> None:
+        self._log(logging.ERROR, msg, args, category, kwargs)
 
-    def error(self, msg: str, *args: Any, **kwargs: Any) -> None:
-        self.logger.error(msg, *args, **kwargs)
+    def critical(self, msg: str, *args: Any, category: Optional[str] = None, **kwargs: Any) -> None:
+        self._log(logging.CRITICAL, msg, args, category, kwargs)
 
-    def critical(self, msg: str, *args: Any, **kwargs: Any) -> None:
-        self.logger.critical(msg, *args, **kwargs)
+    def _log(self, level: int, msg: str, args: tuple, category: Optional[str], kwargs: Dict[str, Any]) -> None:
+        if not self.logger.isEnabledFor(level):
+            return
+        #limits only thin out the routine messages. A warning might be the only sign of a problem
+        if category is not None and level < logging.WARNING:
+            limit = _log_limits.get(category)
+            if limit is not None:
+                limiter = self._limiters.get(category)
+                if limiter is None or limiter.limit is not limit:
+                    limiter = _LogLimiter(limit)
+                    self._limiters[category] = limiter
+                suppressed = limiter.allow()
+                if suppressed is None:
+                    return
+                if suppressed > 0:
+                    msg = f"{msg} [{suppressed} {category} messages suppressed]"
+        #stacklevel points the record at the caller instead of this wrapper
+        kwargs.setdefault("stacklevel", 3)
+        self.logger.log(level, msg, *args, **kwargs)
 
     def get_child(self, suffix: str) -> 'PrefixLogger':
         #ensures the child has the current name as prefix
         #as long the logger name is used as prefix
-        new_name = f"{self.name}.{suffix}"
-        return PrefixLogger(new_name)
+        child = self._children.get(suffix)
+        if child is None:
+            child = PrefixLogger(f"{self.name}.{suffix}")
+            if len(self._children) < PrefixLogger.MAX_CACHED_CHILDREN:
+                self._children[suffix] = child
+        return child
+
+
+_root_logger: Optional[PrefixLogger] = None
+
 
 def setup_logger() -> PrefixLogger:
-    return PrefixLogger("awrtc")
+    global _root_logger
+    if _root_logger is None:
+        _root_logger = PrefixLogger("awrtc")
+    return _root_logger
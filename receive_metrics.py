@@ -0,0 +1,157 @@
+import asyncio
+from dataclasses import dataclass
+import time
+from typing import Dict, List, Optional
+
+import av
+from aiortc import RTCRtpCodecParameters, RTCRtpReceiver
+from aiortc.jitterbuffer import JitterFrame
+from aiortc.mediastreams import MediaStreamError, MediaStreamTrack
+
+from passthrough import PARSER_CODECS, install_encoded_frame_tap, is_keyframe, parse_frame_size
+
+'''
+Measures received media without doing anything else with it. Used for load tests and monitoring
+where one process acts as many receivers.
+
+If the RTCRtpReceiver is known the encoded frames are measured via the passthrough tap and never
+decoded. Only keyframes are parsed (not decoded) to read the resolution. Otherwise the track is
+drained via recv: frames are decoded by aiortc but never converted to pixels.
+
+There is no sender clock to compare with. The lag is the delay of a frame compared to the
+fastest frame of the track so far: arrival time - media time - the minimum of this difference.
+It shows how far the receiver is behind, e.g. due to network queues or a stalled event loop.
+'''
+
+
+@dataclass
+class TrackMetrics:
+    kind: str
+    frames: int = 0
+    #frames received during the last full second
+    fps: float = 0
+    #RFC 3550 interarrival jitter in ms
+    jitter_ms: float = 0
+    #delay of the last frame compared to the fastest one
+    lag_ms: float = 0
+    max_lag_ms: float = 0
+    width: int = 0
+    height: int = 0
+    resolution_changes: int = 0
+    #audio only: jumps in the media time larger than 1.5 frames
+    gaps: int = 0
+    gap_ms: float = 0
+    #True if the frames were measured without decoding
+    encoded: bool = False
+
+
+class TrackMeter:
+    '''
+    Updates the TrackMetrics of one track with each received frame.
+    '''
+
+    def __init__(self, kind: str, encoded: bool = False):
+        self.metrics = TrackMetrics(kind, encoded=encoded)
+        self._fps_start = time.monotonic()
+        self._fps_frames = 0
+        self._last_transit: Optional[float] = None
+        self._min_transit: Optional[float] = None
+        self._last_media_time: Optional[float] = None
+        #shortest distance between two audio frames. Used as the expected frame duration
+        self._frame_duration: Optional[float] = None
+
+    def add_frame(self, media_time: float, width: int = 0, height: int = 0) -> None:
+        '''
+        media_time is the timestamp of the frame in seconds. width / height are 0 if unknown.
+        '''
+        now = time.monotonic()
+        m = self.metrics
+        m.frames += 1
+        self._fps_frames += 1
+        if now - self._fps_start >= 1.0:
+            m.fps = self._fps_frames / (now - self._fps_start)
+            self._fps_start = now
+            self._fps_frames = 0
+
+        transit = now - media_time
+        if self._last_transit is not None:
+            m.jitter_ms += (abs(transit - self._last_transit) * 1000 - m.jitter_ms) / 16
+        self._last_transit = transit
+        if self._min_transit is None or transit < self._min_transit:
+            self._min_transit = transit
+        m.lag_ms = (transit - self._min_transit) * 1000
+        m.max_lag_ms = max(m.max_lag_ms, m.lag_ms)
+
+        if width and height and (width != m.width or height != m.height):
+            if m.width:
+                m.resolution_changes += 1
+            m.width = width
+            m.height = height
+
+        if m.kind == "audio" and self._last_media_time is not None:
+            delta = media_time - self._last_media_time
+            if delta > 0:
+                if self._frame_duration is None or delta < self._frame_duration:
+                    self._frame_duration = delta
+                elif delta > self._frame_duration * 1.5:
+                    m.gaps += 1
+                    m.gap_ms += (delta - self._frame_duration) * 1000
+        self._last_media_time = media_time
+
+    def add_encoded_frame(self, codec: RTCRtpCodecParameters, frame: JitterFrame) -> None:
+        width = height = 0
+        mime_type = codec.mimeType.lower()
+        if mime_type in PARSER_CODECS and is_keyframe(mime_type, frame.data):
+            width, height = parse_frame_size(mime_type, frame.data)
+        #RTP timestamps wrap after 2^32. The lag and jitter only use differences so this is rare enough to ignore
+        self.add_frame(frame.timestamp / codec.clockRate, width, height)
+
+
+class ReceiveMetrics:
+    '''
+    Collects the TrackMetrics of all tracks of one connection.
+    '''
+
+    def __init__(self):
+        self.tracks: Dict[str, TrackMeter] = {}
+        self._tasks: List[asyncio.Task] = []
+
+    @property
+    def stats(self) -> Dict[str, TrackMetrics]:
+        return {track_id: meter.metrics for track_id, meter in self.tracks.items()}
+
+    def add_track(self, track: MediaStreamTrack) -> None:
+        '''
+        Drains the track via recv.
+        '''
+        meter = TrackMeter(track.kind)
+        self.tracks[track.id] = meter
+        self._tasks.append(asyncio.ensure_future(self._drain(track, meter)))
+
+    def add_receiver(self, receiver: RTCRtpReceiver) -> None:
+        '''
+        Measures the encoded frames of the receiver. They are not decoded anymore so its track
+        won't return any frames.
+        '''
+        track = receiver.track
+        meter = TrackMeter(track.kind if track is not None else "video", encoded=True)
+        self.tracks[track.id if track is not None else str(id(receiver))] = meter
+        install_encoded_frame_tap(receiver, meter.add_encoded_frame, decode=False)
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    async def _drain(self, track: MediaStreamTrack, meter: TrackMeter) -> None:
+        while True:
+            try:
+                frame = await track.recv()
+            except MediaStreamError:
+                return
+            media_time = float(frame.pts * frame.time_base) if frame.pts is not None and frame.time_base is not None else time.monotonic()
+            if isinstance(frame, av.VideoFrame):
+                meter.add_frame(media_time, frame.width, frame.height)
+            else:
+                meter.add_frame(media_time)
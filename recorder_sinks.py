@@ -0,0 +1,173 @@
+import asyncio
+import socket
+import subprocess
+from typing import IO, List, Optional, Tuple, Union
+import logging
+logger = logging.getLogger(__name__)
+
+'''
+Outputs for the CustomMediaRecorder that don't write to a file on disk.
+
+A sink is a file-like object that is passed instead of a file name. The recorder's worker thread
+calls write with the muxed bytes and close once the container is closed. None of the sinks can seek
+so the container format must support streaming e.g. fragmented mp4, webm / matroska or mpegts.
+Use CustomMediaRecorder.get_streaming_config to get a matching config.
+
+Example:
+    sink = AsyncStreamSink()
+    recorder = CustomMediaRecorder(sink, CustomMediaRecorder.get_streaming_config("mp4"))
+    recorder.addTrack(track)
+    await recorder.start()
+    async for chunk in sink:
+        await websocket.send(chunk)
+'''
+
+
+class RecorderSink:
+    '''
+    Base class of all sinks. write and close are called from the recorder's worker thread.
+    '''
+
+    def __init__(self):
+        self.bytes_written = 0
+        self.closed = False
+
+    def write(self, data: bytes) -> int:
+        if self.closed:
+            raise IOError(f"{type(self).__name__} is closed")
+        self._write(bytes(data))
+        self.bytes_written += len(data)
+        return len(data)
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        self._close()
+
+    def _write(self, data: bytes) -> None:
+        raise NotImplementedError()
+
+    def _close(self) -> None:
+        pass
+
+
+class AsyncStreamSink(RecorderSink):
+    '''
+    Hands the muxed bytes to asyncio code. Read them via read() or async for.
+
+    If the consumer falls behind by more than max_chunks the recorder's worker thread waits.
+    Frames then queue up and are dropped by the recorder's DropPolicy instead of growing memory.
+    If the consumer doesn't read at all for WRITE_TIMEOUT the recording fails.
+    Must be created on the event loop the consumer runs on.
+    '''
+
+    WRITE_TIMEOUT = 10.0
+
+    def __init__(self, max_chunks: int = 256):
+        super().__init__()
+        self._loop = asyncio.get_running_loop()
+        self._queue: asyncio.Queue[Optional[bytes]] = asyncio.Queue(max_chunks)
+
+    def _write(self, data: bytes) -> None:
+        future = asyncio.run_coroutine_threadsafe(self._queue.put(data), self._loop)
+        try:
+            future.result(AsyncStreamSink.WRITE_TIMEOUT)
+        except TimeoutError:
+            future.cancel()
+            raise IOError("AsyncStreamSink consumer stopped reading")
+
+    def _close(self) -> None:
+        #None marks the end of the stream for the reader
+        try:
+            self._loop.call_soon_threadsafe(self._put_end)
+        except RuntimeError:
+            logger.warning("AsyncStreamSink closed after its event loop")
+
+    def _put_end(self) -> None:
+        try:
+            self._queue.put_nowait(None)
+        except asyncio.QueueFull:
+            #the reader is behind. Retry once it made space
+            self._loop.call_later(0.01, self._put_end)
+
+    async def read(self) -> Optional[bytes]:
+        '''
+        Returns the next chunk of muxed bytes or None once the recording stopped.
+        '''
+        chunk = await self._queue.get()
+        if chunk is None:
+            #keep returning None to any further reads
+            self._queue.put_nowait(None)
+        return chunk
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> bytes:
+        chunk = await self.read()
+        if chunk is None:
+            raise StopAsyncIteration
+        return chunk
+
+
+class PipeSink(RecorderSink):
+    '''
+    Writes the muxed bytes to the stdin of a child process e.g.
+    PipeSink(["ffmpeg", "-i", "pipe:0", "-c", "copy", "-f", "flv", "rtmp://..."])
+    '''
+
+    #time given to the process to exit after its stdin was closed
+    CLOSE_TIMEOUT = 5.0
+
+    def __init__(self, args: List[str]):
+        super().__init__()
+        #PyAV already buffers the output. Unbuffered writes pass it on immediately
+        self.process = subprocess.Popen(args, stdin=subprocess.PIPE, bufsize=0)
+        assert self.process.stdin is not None
+        self._stdin: IO[bytes] = self.process.stdin
+
+    def _write(self, data: bytes) -> None:
+        try:
+            self._stdin.write(data)
+        except BrokenPipeError:
+            raise IOError(f"Process {self.process.args!r} closed its input. Exit code: {self.process.poll()}")
+
+    def _close(self) -> None:
+        try:
+            self._stdin.close()
+        except BrokenPipeError:
+            pass
+        try:
+            self.process.wait(PipeSink.CLOSE_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            logger.warning(f"Process {self.process.args!r} did not exit in time. Terminating")
+            self.process.terminate()
+
+
+class SocketSink(RecorderSink):
+    '''
+    Sends the muxed bytes via a stream socket. The address is either a path of a unix socket or
+    a (host, port) tuple for TCP. The connection is made when the sink is created.
+    '''
+
+    def __init__(self, address: Union[str, Tuple[str, int]], timeout: Optional[float] = 10.0):
+        super().__init__()
+        if isinstance(address, str):
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        #timeout also applies to sendall. A stalled receiver fails the recording instead of blocking it forever
+        self._socket.settimeout(timeout)
+        self._socket.connect(address)
+
+    def _write(self, data: bytes) -> None:
+        self._socket.sendall(data)
+
+    def _close(self) -> None:
+        try:
+            self._socket.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+        self._socket.close()
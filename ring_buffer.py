@@ -0,0 +1,151 @@
+from dataclasses import dataclass
+
+import numpy as np
+
+'''
+Preallocated ring buffer for audio samples shared between two threads.
+
+The producer only moves the write position and the consumer only moves the read position.
+Both positions only grow and are read by the other side to know how much data / space there is.
+As each position has a single writer no lock is needed between producer and consumer.
+Several producers (or consumers) must still synchronize among themselves.
+'''
+
+
+class RingBuffer:
+    '''
+    Fixed size ring of interleaved samples. Data is written and read in shape (samples, channels).
+    '''
+
+    def __init__(self, capacity: int, channels: int = 1, dtype=np.int16):
+        self.capacity = capacity
+        self.channels = channels
+        self.buffer = np.zeros((capacity, channels), dtype=dtype)
+        self._write_pos = 0
+        self._read_pos = 0
+
+    @property
+    def available(self) -> int:
+        '''
+        Samples that can be read.
+        '''
+        return self._write_pos - self._read_pos
+
+    @property
+    def free(self) -> int:
+        '''
+        Samples that can be written.
+        '''
+        return self.capacity - self.available
+
+    def write(self, data: np.ndarray) -> int:
+        '''
+        Producer side. Copies as many samples of data as fit and returns their number.
+        data can be 1D for a single channel.
+        '''
+        data = data.reshape(-1, self.channels)
+        count = min(len(data), self.free)
+        start = self._write_pos % self.capacity
+        first = min(count, self.capacity - start)
+        self.buffer[start:start + first] = data[:first]
+        if first < count:
+            self.buffer[:count - first] = data[first:count]
+        #publish the data only after it was copied
+        self._write_pos += count
+        return count
+
+    def read(self, out: np.ndarray) -> int:
+        '''
+        Consumer side. Copies up to len(out) samples into out and returns their number.
+        The rest of out is left unchanged.
+        '''
+        out = out.reshape(-1, self.channels)
+        count = min(len(out), self.available)
+        start = self._read_pos % self.capacity
+        first = min(count, self.capacity - start)
+        out[:first] = self.buffer[start:start + first]
+        if first < count:
+            out[first:count] = self.buffer[:count - first]
+        self._read_pos += count
+        return count
+
+    def skip(self, count: int) -> int:
+        '''
+        Consumer side. Drops up to count samples without reading them.
+        '''
+        count = min(count, self.available)
+        self._read_pos += count
+        return count
+
+    def clear(self) -> None:
+        '''
+        Consumer side. Drops everything written so far.
+        '''
+        self._read_pos = self._write_pos
+
+
+@dataclass
+class JitterBufferStats:
+    #samples per channel accepted by write
+    written_samples: int = 0
+    #reads that had to be filled with silence (fully or partially)
+    underruns: int = 0
+    #samples that didn't fit into the buffer
+    overrun_samples: int = 0
+    #samples dropped to get back to the target latency
+    trimmed_samples: int = 0
+
+
+class JitterBuffer:
+    '''
+    RingBuffer for audio that is written and read at different, irregular times.
+    read always fills its output and never waits: missing audio is replaced with silence.
+
+    target is the number of samples buffered before reading starts (and restarts after an underrun).
+    It absorbs the jitter of the producer. If more than max_fill samples are buffered the oldest
+    samples are dropped down to target. Same threading rules as the RingBuffer.
+    '''
+
+    def __init__(self, capacity: int, channels: int, target: int, max_fill: int):
+        self.ring = RingBuffer(capacity, channels)
+        self.target = min(target, capacity)
+        self.max_fill = min(max(max_fill, target), capacity)
+        self.stats = JitterBufferStats()
+        #True while waiting for target samples to be buffered. Only used by the consumer
+        self._buffering = True
+
+    @property
+    def available(self) -> int:
+        return self.ring.available
+
+    def write(self, samples: np.ndarray) -> int:
+        '''
+        Producer side.
+        '''
+        samples = samples.reshape(-1, self.ring.channels)
+        written = self.ring.write(samples)
+        self.stats.written_samples += written
+        self.stats.overrun_samples += len(samples) - written
+        return written
+
+    def read(self, out: np.ndarray) -> None:
+        '''
+        Consumer side. Fills out with audio or silence.
+        '''
+        out = out.reshape(-1, self.ring.channels)
+        available = self.ring.available
+        if available > self.max_fill:
+            self.stats.trimmed_samples += self.ring.skip(available - self.target)
+        if self._buffering and self.ring.available >= self.target:
+            self._buffering = False
+
+        if self._buffering:
+            out[:] = 0
+            self.stats.underruns += 1
+            return
+        count = self.ring.read(out)
+        if count < len(out):
+            #producer fell behind. Fill up with silence and buffer again
+            out[count:] = 0
+            self.stats.underruns += 1
+            self._buffering = True
@@ -0,0 +1,293 @@
+import asyncio
+import multiprocessing
+import os
+import queue
+import socket
+import threading
+import traceback
+from multiprocessing.connection import Connection
+from typing import Callable, Dict, List, Optional
+
+from call import Call
+from prefix_logger import PrefixLogger, setup_logger
+from websocket_network import ConnectionId, NetEventType, NetworkEvent, WebsocketNetwork
+
+'''
+ShardedCallHost: Spreads the peers of a single Call across several worker processes.
+
+All CallPeers of a Call share one asyncio loop and the GIL. Encoding / decoding media
+quickly saturates a single core. The ShardedCallHost keeps the only signaling connection
+in the supervisor process and forwards the events of each ConnectionId to one worker
+process via a local pipe. Each worker runs a normal Call (created by a user supplied factory)
+with a WorkerNetwork instead of a WebsocketNetwork so the CallEventHandler surface remains the same.
+
+Example:
+    #must be a top level function so it can be used by the worker processes
+    def create_call(network: WebsocketNetwork) -> Call:
+        call = Call(None, CallAppEventHandler(), True, network=network)
+        call.attach_track(TestVideoStreamTrack())
+        return call
+
+    host = ShardedCallHost(uri, create_call, worker_count=4)
+    await host.listen("myaddress")
+'''
+
+#returns the index of the worker that handles the given connection
+ShardFunction = Callable[[ConnectionId, int], int]
+#creates the Call used within a worker process. Must be picklable (top level function)
+CallFactory = Callable[[WebsocketNetwork], Call]
+
+
+def shard_by_connection_id(connection_id: ConnectionId, worker_count: int) -> int:
+    return hash(connection_id) % worker_count
+
+
+class PipeChannel:
+    '''
+    Moves messages between a multiprocessing Connection and the asyncio loop. recv_bytes and send_bytes
+    block so each pipe gets a dedicated reader and writer thread. Using the default executor instead would
+    keep one of its threads busy per pipe for as long as the pipe is open.
+    Must be created on the loop that uses it.
+    '''
+
+    #time given to the writer thread to send the queued messages on close
+    CLOSE_TIMEOUT = 5.0
+
+    def __init__(self, conn: Connection, name: str, logger: PrefixLogger):
+        self.logger = logger
+        self._conn = conn
+        self._loop = asyncio.get_running_loop()
+        #None marks the end of the pipe
+        self._received: asyncio.Queue[Optional[bytes]] = asyncio.Queue()
+        self._outgoing: queue.SimpleQueue[Optional[bytes]] = queue.SimpleQueue()
+        self._reader = threading.Thread(target=self._read, name=f"{name}-reader", daemon=True)
+        self._writer = threading.Thread(target=self._write, name=f"{name}-writer", daemon=True)
+        self._reader.start()
+        self._writer.start()
+
+    def _read(self):
+        try:
+            while True:
+                msg = self._conn.recv_bytes()
+                self._loop.call_soon_threadsafe(self._received.put_nowait, msg)
+        except (EOFError, OSError):
+            pass
+        try:
+            self._loop.call_soon_threadsafe(self._received.put_nowait, None)
+        except RuntimeError:
+            #the loop is already closed
+            pass
+
+    def _write(self):
+        failed = False
+        while True:
+            msg = self._outgoing.get()
+            if msg is None:
+                return
+            if failed:
+                #the other side is gone. Queued messages are discarded
+                continue
+            try:
+                self._conn.send_bytes(msg)
+            except (EOFError, OSError) as e:
+                self.logger.warning(f"Sending through the pipe failed: {e}")
+                failed = True
+
+    async def recv(self) -> Optional[bytes]:
+        '''
+        Returns the next message or None once the other side closed the pipe.
+        '''
+        return await self._received.get()
+
+    def send(self, msg: bytes) -> None:
+        '''
+        Queues the message for the writer thread. Never blocks.
+        '''
+        self._outgoing.put(msg)
+
+    async def close(self) -> None:
+        '''
+        Sends the queued messages and closes the pipe. The other side receives None.
+        '''
+        self._outgoing.put(None)
+        await asyncio.to_thread(self._writer.join, PipeChannel.CLOSE_TIMEOUT)
+        #closing the descriptor doesn't wake a recv_bytes that blocks on it and the number could be
+        #reused while the reader still uses it. The reader is stopped first
+        self._shutdown_socket()
+        await asyncio.to_thread(self._reader.join, PipeChannel.CLOSE_TIMEOUT)
+        if self._reader.is_alive():
+            self.logger.warning("The pipe reader didn't stop. The pipe is left open")
+            return
+        self._conn.close()
+
+    def _shutdown_socket(self) -> None:
+        #pipes are socket pairs on unix. Shutting the socket down ends a blocking recv_bytes with EOF.
+        #Other pipes end once the other side closed them
+        try:
+            sock = socket.socket(fileno=os.dup(self._conn.fileno()))
+        except OSError:
+            return
+        with sock:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+class WorkerNetwork(WebsocketNetwork):
+    '''
+    Network used within a worker process. Receives the serialized NetworkEvents from the
+    supervisor via a pipe and sends all outgoing events back to it.
+    '''
+
+    def __init__(self, conn: Connection, logger: PrefixLogger):
+        super().__init__(logger)
+        self._channel = PipeChannel(conn, "SupervisorPipe", logger)
+
+    async def start(self, uri):
+        #the supervisor owns the signaling connection
+        self.logger.info("Using the signaling connection of the supervisor process")
+
+    async def process_messages(self):
+        try:
+            while True:
+                msg = await self._channel.recv()
+                if msg is None:
+                    self.logger.info("Supervisor pipe closed")
+                    break
+                if len(msg) == 0:
+                    #shutdown request from the supervisor
+                    break
+                await self.process_message(msg)
+        except Exception as e:
+            self.logger.error(f"process_messages triggered an exception:  {str(e)}\n{traceback.format_exc()}")
+
+        self.logger.info("process_messages stopped")
+
+    async def _internal_send(self, msg):
+        self._channel.send(msg)
+
+    async def shutdown(self):
+        await self._channel.close()
+
+
+def _worker_main(index: int, conn: Connection, call_factory: CallFactory):
+    asyncio.run(_run_worker(index, conn, call_factory))
+
+
+async def _run_worker(index: int, conn: Connection, call_factory: CallFactory):
+    logger = setup_logger().get_child(f"Worker{index}")
+    network = WorkerNetwork(conn, logger)
+    call = call_factory(network)
+    try:
+        await call.serve()
+    except asyncio.CancelledError:
+        logger.info("Worker cancelled")
+    finally:
+        await call.dispose()
+        logger.info("Worker shut down")
+
+
+class ShardedCallHost:
+    '''
+    Supervisor that owns the signaling connection and forwards events to worker processes.
+    '''
+
+    #time given to the workers to dispose their calls before they are terminated
+    WORKER_SHUTDOWN_TIMEOUT = 10.0
+
+    def __init__(self, uri: str, call_factory: CallFactory, worker_count: Optional[int] = None,
+                 shard: ShardFunction = shard_by_connection_id):
+        self.logger = setup_logger().get_child("ShardedCallHost")
+        self.uri = uri
+        self.call_factory = call_factory
+        self.worker_count = worker_count if worker_count is not None else (os.cpu_count() or 1)
+        self.shard = shard
+        self.network = WebsocketNetwork(self.logger)
+        self.network.register_event_handler(self.signaling_event_handler)
+
+        #connection id -> worker index
+        self._routes: Dict[ConnectionId, int] = {}
+        self._processes: List[multiprocessing.Process] = []
+        self._channels: List[PipeChannel] = []
+        self._reader_tasks: List[asyncio.Task] = []
+
+    def start_workers(self):
+        #spawn avoids forking an already running event loop and its threads
+        ctx = multiprocessing.get_context("spawn")
+        for i in range(self.worker_count):
+            parent_conn, child_conn = ctx.Pipe()
+            process = ctx.Process(target=_worker_main, args=(i, child_conn, self.call_factory),
+                                  name=f"awrtc-worker-{i}", daemon=True)
+            process.start()
+            #the child owns its end now
+            child_conn.close()
+            self._processes.append(process)
+            self._channels.append(PipeChannel(parent_conn, f"Worker{i}Pipe", self.logger))
+            self._reader_tasks.append(asyncio.create_task(self._read_worker(i)))
+        self.logger.info(f"Started {self.worker_count} worker processes")
+
+    async def listen(self, address: str):
+        self.start_workers()
+        await self.network.start(self.uri)
+        await self.network.listen(address)
+        self.logger.info(f"Listening on {address}")
+        await self.network.process_messages()
+
+    def _send_to_worker(self, index: int, evt: NetworkEvent):
+        self._channels[index].send(NetworkEvent.to_byte_array(evt))
+
+    async def signaling_event_handler(self, evt: NetworkEvent):
+        if evt.type in (NetEventType.ServerInitialized, NetEventType.ServerInitFailed, NetEventType.ServerClosed):
+            #all workers need to know about the listening state
+            for i in range(len(self._channels)):
+                self._send_to_worker(i, evt)
+            return
+
+        if evt.type == NetEventType.NewConnection:
+            assigned = self.shard(evt.connection_id, self.worker_count)
+            self._routes[evt.connection_id] = assigned
+            self.logger.info(f"Connection {evt.connection_id} assigned to worker {assigned}")
+
+        index = self._routes.get(evt.connection_id)
+        if index is None:
+            self.logger.warning(f"Event {evt.type} for unknown connection {evt.connection_id}")
+            return
+        self._send_to_worker(index, evt)
+
+        if evt.type in (NetEventType.Disconnected, NetEventType.ConnectionFailed):
+            del self._routes[evt.connection_id]
+
+    async def _read_worker(self, index: int):
+        channel = self._channels[index]
+        try:
+            while True:
+                msg = await channel.recv()
+                if msg is None:
+                    self.logger.info(f"Worker {index} pipe closed")
+                    break
+                evt = NetworkEvent.from_byte_array(msg)
+                if evt.type == NetEventType.Disconnected:
+                    #worker closed the connection itself
+                    self._routes.pop(evt.connection_id, None)
+                await self.network.send_network_event(evt)
+        except Exception as e:
+            self.logger.error(f"Forwarding messages of worker {index} failed: {str(e)}\n{traceback.format_exc()}")
+
+    async def dispose(self):
+        #an empty message ends process_messages in the workers which then dispose their calls
+        for channel in self._channels:
+            channel.send(b"")
+        loop = asyncio.get_running_loop()
+        for process in self._processes:
+            await loop.run_in_executor(None, process.join, ShardedCallHost.WORKER_SHUTDOWN_TIMEOUT)
+            if process.is_alive():
+                self.logger.warning(f"{process.name} did not shut down in time. Terminating")
+                process.terminate()
+        #readers stop on their own once the worker closed its end of the pipe
+        for task in self._reader_tasks:
+            task.cancel()
+        for channel in self._channels:
+            await channel.close()
+        await self.network.dispose()
+        self.logger.info("ShardedCallHost disposed")
@@ -0,0 +1,45 @@
+import asyncio
+import os
+from dotenv import load_dotenv
+from app_common import CallAppEventHandler, setup_signal_handling
+from call import Call
+from sharded_call import ShardedCallHost
+from tracks import TestVideoStreamTrack
+from websocket_network import WebsocketNetwork
+import logging
+logging.basicConfig(level=logging.INFO)
+
+load_dotenv()
+
+'''
+Same as conference_app.py but the peers are spread across one worker process per CPU core.
+'''
+
+#called within each worker process. Must be a top level function
+def create_call(network: WebsocketNetwork) -> Call:
+    logging.basicConfig(level=logging.INFO)
+    call = Call(None, CallAppEventHandler(), True, network=network)
+    call.attach_track(TestVideoStreamTrack())
+    return call
+
+
+async def main():
+    uri = os.getenv('SIGNALING_CONFERENCE_URI', 'ws://192.168.1.3:12776')
+    address = os.getenv('ADDRESS', "abc123")
+
+    host = ShardedCallHost(uri, create_call)
+    try:
+        main_loop = asyncio.create_task(host.listen(address))
+        setup_signal_handling(main_loop)
+        await main_loop
+        print("Main loop exited")
+    except asyncio.CancelledError:
+        #This should trigger when our exit signal (e.g. ctrl+c) is triggered
+        print("CancelledError triggered. Starting controlled shutdown")
+    finally:
+        await host.dispose()
+        print("shutdown complete.")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
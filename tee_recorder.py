@@ -0,0 +1,327 @@
+import asyncio
+from collections import deque
+import fractions
+import threading
+import time
+import traceback
+from typing import Any, List, Optional, cast
+
+import av
+from av import VideoFrame
+from av.codec.context import CodecContext
+from av.frame import Frame
+from av.video.frame import PictureType
+from aiortc.mediastreams import VIDEO_TIME_BASE, MediaStreamError, MediaStreamTrack
+
+from recorder_sinks import RecorderSink
+from tracks import FrameQueue, RecorderConfig, RecorderStats
+import logging
+logger = logging.getLogger(__name__)
+
+'''
+TeeMediaRecorder: Encodes each track once and writes the packets into any number of outputs.
+
+E.g. a local mp4 archive and a fragmented mp4 live stream share the same encoders.
+Outputs can be added and removed while recording. A new output starts with the next keyframe
+which is requested from the video encoder once the output is opened.
+
+All outputs use the same codecs. Video uses RecorderConfig.video_stream_codec (default libx264),
+audio uses libopus for vp8 / vp9 and aac for anything else. Make sure all containers support them
+(e.g. mp4 + mkv for h264 / aac or webm + mkv for vp8 / opus).
+'''
+
+
+def packet_time(packet: av.Packet) -> Optional[float]:
+    '''
+    Time of the packet in seconds. None if it has no pts or time base.
+    '''
+    if packet.pts is None or packet.time_base is None:
+        return None
+    return float(packet.pts * packet.time_base)
+
+
+class TeeOutput:
+    '''
+    One container written by the TeeMediaRecorder. Created via TeeMediaRecorder.addOutput.
+    '''
+
+    #max audio packets kept while waiting for the first video keyframe
+    PENDING_AUDIO_LIMIT = 500
+
+    def __init__(self, file, container_format: Optional[str] = None, container_options: Optional[dict] = None):
+        self.file = file
+        self.container_format = container_format
+        self.container_options = container_options
+        self.container: Any = None
+        #one stream for each track of the recorder. Same order as the recorder's tracks
+        self.streams: list = []
+        #muxing starts with a video keyframe so the output can be decoded from its start
+        self.waiting_for_keyframe = True
+        #audio received while waiting for the first keyframe
+        self.pending_audio: deque[av.Packet] = deque(maxlen=TeeOutput.PENDING_AUDIO_LIMIT)
+        self.closed = False
+        self.muxed_packets = 0
+
+
+class TeeTrackContext:
+    def __init__(self, track: MediaStreamTrack, index: int) -> None:
+        self.track = track
+        self.index = index
+        #av.CodecContext. Any as the stubs lack the video / audio attributes
+        self.encoder: Any = None
+        self.task: asyncio.Task[None] | None = None
+
+
+class TeeMediaRecorder:
+    """
+    Records tracks like the CustomMediaRecorder but shares each encoder between several outputs.
+    Encoding and muxing run on a worker thread. Frames are dropped via the FrameQueue if it falls behind.
+    """
+
+    def __init__(self, config: RecorderConfig = RecorderConfig()):
+        self._config = config
+        self.stats = RecorderStats()
+        self.__tracks: List[TeeTrackContext] = []
+        self.__outputs: List[TeeOutput] = []
+        self.__queue = FrameQueue(config.queue_size, config.drop_policy, self.stats)
+        self.__worker: threading.Thread | None = None
+        #guards the outputs. Held by the worker while encoding and muxing
+        self.__lock = threading.Lock()
+        self.__keyframe_requested = False
+        self.__video_codec = config.video_stream_codec if config.video_stream_codec is not None else "libx264"
+        self.__audio_codec = "libopus" if self.__video_codec in ("vp8", "vp9", "libvpx", "libvpx-vp9") else "aac"
+
+    def addTrack(self, track: MediaStreamTrack) -> None:
+        """
+        Add a track to be recorded. All tracks must be added before start is called.
+        """
+        self.__tracks.append(TeeTrackContext(track, len(self.__tracks)))
+
+    def addOutput(self, file, container_format: Optional[str] = None, container_options: Optional[dict] = None) -> TeeOutput:
+        """
+        Add a file or RecorderSink to write to. Can be called at any time. The output is opened
+        by the worker once every track delivered its first frame and starts with the next keyframe.
+        """
+        if isinstance(file, RecorderSink) and container_format is None:
+            raise ValueError("Writing to a sink needs a container_format")
+        output = TeeOutput(file, container_format, container_options)
+        with self.__lock:
+            self.__outputs.append(output)
+        return output
+
+    async def removeOutput(self, output: TeeOutput) -> None:
+        """
+        Stops writing to the output and closes it. The other outputs continue.
+        """
+        await asyncio.get_running_loop().run_in_executor(None, self.__remove_output, output)
+
+    async def start(self) -> None:
+        """
+        Start recording.
+        """
+        if self.__worker is None:
+            self.__worker = threading.Thread(target=self.__run_worker, name="TeeMediaRecorder", daemon=True)
+            self.__worker.start()
+        for context in self.__tracks:
+            if context.task is None:
+                context.task = asyncio.ensure_future(self.__run_track(context))
+
+    async def stop(self) -> None:
+        """
+        Stop recording and close all outputs.
+        """
+        for context in self.__tracks:
+            if context.task is not None:
+                context.task.cancel()
+                context.task = None
+        self.__queue.close()
+        if self.__worker is not None:
+            await asyncio.get_running_loop().run_in_executor(None, self.__worker.join)
+            self.__worker = None
+        else:
+            with self.__lock:
+                for output in list(self.__outputs):
+                    self.__close_output(output)
+
+    async def __run_track(self, context: TeeTrackContext) -> None:
+        while True:
+            try:
+                frame = await context.track.recv()
+            except MediaStreamError:
+                return
+            self.__queue.put(context, frame)  # type: ignore
+
+    def __run_worker(self) -> None:
+        try:
+            while True:
+                item = self.__queue.get()
+                if item is None:
+                    break
+                context = cast(TeeTrackContext, item[0])
+                start = time.perf_counter()
+                with self.__lock:
+                    self.__encode(context, item[1])
+                duration = time.perf_counter() - start
+                self.stats.encoded_frames += 1
+                self.stats.encode_time += duration
+                self.stats.last_encode_time = duration
+
+            with self.__lock:
+                for track_context in self.__tracks:
+                    if track_context.encoder is not None:
+                        for packet in track_context.encoder.encode(None):
+                            self.__mux(track_context, packet)
+        except Exception as e:
+            logger.error(f"TeeMediaRecorder worker failed: {e}\n{traceback.format_exc()}")
+        finally:
+            with self.__lock:
+                for output in list(self.__outputs):
+                    self.__close_output(output)
+
+    def __create_encoder(self, frame: Frame) -> Any:
+        if isinstance(frame, VideoFrame):
+            encoder: Any = CodecContext.create(self.__video_codec, "w")
+            encoder.width = self._config.width if self._config.width is not None else frame.width
+            encoder.height = self._config.height if self._config.height is not None else frame.height
+            encoder.pix_fmt = "yuv420p"
+            encoder.time_base = VIDEO_TIME_BASE
+            encoder.framerate = fractions.Fraction(self._config.rate, 1)
+            options: dict[str, str] = {}
+            profile = self._config.encoder
+            if profile is not None:
+                if profile.gop is not None:
+                    encoder.gop_size = profile.gop
+                if profile.threads is not None:
+                    encoder.thread_count = profile.threads
+                options = profile.get_options(encoder.name)
+            if encoder.name == "libx264":
+                #outputs can start at any keyframe and need the SPS / PPS there
+                x264_params = options.get("x264-params")
+                options["x264-params"] = "repeat-headers=1" if not x264_params else f"{x264_params}:repeat-headers=1"
+            encoder.options = options
+            crf_mode = profile is not None and profile.crf is not None
+            if self._config.video_bit_rate is not None and not (crf_mode and encoder.name == "libx264"):
+                encoder.bit_rate = self._config.video_bit_rate
+        else:
+            encoder = CodecContext.create(self.__audio_codec, "w")
+            encoder.sample_rate = frame.sample_rate  # type: ignore
+            encoder.layout = "stereo"
+            encoder.format = encoder.codec.audio_formats[0].name
+            encoder.time_base = fractions.Fraction(1, frame.sample_rate)  # type: ignore
+        return encoder
+
+    def __encode(self, context: TeeTrackContext, frame: Frame) -> None:
+        if context.encoder is None:
+            context.encoder = self.__create_encoder(frame)
+            if all(c.encoder is not None for c in self.__tracks):
+                #outputs added before now wait for their first keyframe
+                self.__keyframe_requested = True
+
+        if not all(c.encoder is not None for c in self.__tracks):
+            #the outputs can't be opened until every encoder is configured
+            return
+
+        opened = False
+        for output in list(self.__outputs):
+            if output.container is None and not output.closed:
+                self.__open_output(output)
+                opened = True
+        if opened:
+            self.__keyframe_requested = True
+
+        if isinstance(frame, VideoFrame) and self.__keyframe_requested:
+            frame.pict_type = PictureType.I
+            self.__keyframe_requested = False
+
+        for packet in context.encoder.encode(frame):
+            self.__mux(context, packet)
+
+    def __open_output(self, output: TeeOutput) -> None:
+        try:
+            output.container = av.open(file=output.file, format=output.container_format, mode="w", options=output.container_options)
+            for context in self.__tracks:
+                encoder = context.encoder
+                assert encoder is not None
+                #the stream's own encoder is only opened to write the container header (e.g. the codec private data).
+                #It is configured like the shared encoder but never encodes frames
+                if encoder.type == "video":
+                    stream = output.container.add_stream(encoder.name, rate=self._config.rate)
+                    stream.width = encoder.width
+                    stream.height = encoder.height
+                    stream.pix_fmt = encoder.pix_fmt
+                    if encoder.bit_rate is not None:
+                        stream.bit_rate = encoder.bit_rate
+                    if encoder.gop_size:
+                        stream.codec_context.gop_size = encoder.gop_size
+                    stream.time_base = encoder.time_base
+                else:
+                    stream = output.container.add_stream(encoder.name, rate=encoder.sample_rate)
+                    stream.layout = encoder.layout.name
+                stream.codec_context.options = encoder.options
+                output.streams.append(stream)
+            output.waiting_for_keyframe = any(c.encoder is not None and c.encoder.type == "video" for c in self.__tracks)
+            logger.info(f"TeeMediaRecorder opened output {output.file}")
+        except Exception as e:
+            logger.error(f"TeeMediaRecorder failed to open output {output.file}: {e}")
+            self.__close_output(output)
+
+    def __mux(self, context: TeeTrackContext, packet: av.Packet) -> None:
+        is_video = context.encoder is not None and context.encoder.type == "video"
+        for output in list(self.__outputs):
+            if output.container is None or output.closed:
+                continue
+            #muxing takes ownership of the packet data. Each output needs its own packet
+            copy = av.Packet(bytes(packet))
+            copy.pts = packet.pts
+            copy.dts = packet.dts
+            copy.time_base = packet.time_base
+            copy.is_keyframe = packet.is_keyframe
+            copy.stream = output.streams[context.index]
+            if output.waiting_for_keyframe:
+                if not is_video:
+                    #the video encoder's delay means the keyframe arrives after audio of the same time
+                    output.pending_audio.append(copy)
+                    continue
+                if not packet.is_keyframe:
+                    continue
+                output.waiting_for_keyframe = False
+                self.__mux_output(output, copy)
+                start = packet_time(packet)
+                for pending in output.pending_audio:
+                    pending_time = packet_time(pending)
+                    #audio from before the keyframe is dropped. If the keyframe has no timestamp all of it is kept
+                    if start is None or (pending_time is not None and pending_time >= start):
+                        self.__mux_output(output, pending)
+                output.pending_audio.clear()
+                continue
+            self.__mux_output(output, copy)
+
+    def __mux_output(self, output: TeeOutput, packet: av.Packet) -> None:
+        if output.container is None:
+            return
+        try:
+            output.container.mux(packet)
+            output.muxed_packets += 1
+        except Exception as e:
+            #one failing output (e.g. a disconnected sink) doesn't stop the others
+            logger.error(f"TeeMediaRecorder output {output.file} failed: {e}")
+            self.__close_output(output)
+
+    def __remove_output(self, output: TeeOutput) -> None:
+        with self.__lock:
+            self.__close_output(output)
+
+    def __close_output(self, output: TeeOutput) -> None:
+        output.closed = True
+        if output in self.__outputs:
+            self.__outputs.remove(output)
+        if output.container is not None:
+            try:
+                output.container.close()
+            except Exception as e:
+                logger.warning(f"TeeMediaRecorder failed to close output {output.file}: {e}")
+            output.container = None
+        #PyAV doesn't close file objects
+        if isinstance(output.file, RecorderSink):
+            output.file.close()
+        logger.info(f"TeeMediaRecorder closed output {output.file}. {output.muxed_packets} packets written")
@@ -0,0 +1,105 @@
+import fractions
+
+import numpy as np
+from av import AudioFrame
+
+from audio_output import AudioOutput
+from prefix_logger import PrefixLogger
+
+
+class FakeStream:
+    def __init__(self, callback, **kwargs):
+        self.callback = callback
+        self.kwargs = kwargs
+        self.closed = False
+
+    def stop_stream(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class FakePyAudio:
+    def __init__(self):
+        self.streams = []
+
+    def get_format_from_width(self, width):
+        return width
+
+    def open(self, stream_callback=None, **kwargs):
+        stream = FakeStream(stream_callback, **kwargs)
+        self.streams.append(stream)
+        return stream
+
+
+def make_frame(value, samples=960, sample_rate=48000, layout="stereo"):
+    channels = 2 if layout == "stereo" else 1
+    frame = AudioFrame.from_ndarray(np.full((1, samples * channels), value, dtype=np.int16), format="s16", layout=layout)
+    frame.sample_rate = sample_rate
+    return frame
+
+
+def pull(stream, frame_count=480):
+    data, flag = stream.callback(None, frame_count, {}, 0)
+    return np.frombuffer(data, dtype=np.int16).reshape(frame_count, -1)
+
+
+def test_plays_frames_after_target_latency():
+    audio = FakePyAudio()
+    output = AudioOutput(audio, PrefixLogger("test"), target_latency=0.04)
+    output.write(make_frame(100))
+    stream = audio.streams[0]
+    assert stream.kwargs["rate"] == 48000 and stream.kwargs["channels"] == 2
+    #20ms buffered, 40ms needed
+    assert not pull(stream).any()
+    output.write(make_frame(100))
+    assert (pull(stream) == 100).all()
+    assert output.stats.underruns == 1
+
+
+def test_underrun_plays_silence():
+    audio = FakePyAudio()
+    output = AudioOutput(audio, PrefixLogger("test"), target_latency=0.01)
+    output.write(make_frame(7, samples=480))
+    stream = audio.streams[0]
+    assert (pull(stream) == 7).all()
+    assert not pull(stream).any()
+    assert output.stats.underruns == 1
+
+
+def test_overrun_and_trim():
+    audio = FakePyAudio()
+    output = AudioOutput(audio, PrefixLogger("test"), target_latency=0.02, max_latency=0.1, buffer_duration=0.2)
+    for _ in range(15):
+        output.write(make_frame(1))
+    assert output.stats.overrun_samples == 15 * 960 - 9600
+    pull(audio.streams[0])
+    assert output.stats.trimmed_samples == 9600 - 960
+    assert output.jitter is not None and output.jitter.available == 960 - 480
+
+
+def test_format_change_does_not_reopen():
+    audio = FakePyAudio()
+    output = AudioOutput(audio, PrefixLogger("test"), target_latency=0.0)
+    output.write(make_frame(1000))
+    output.write(make_frame(1000, samples=441, sample_rate=44100, layout="mono"))
+    assert len(audio.streams) == 1
+    stream = audio.streams[0]
+    pull(stream, 960)
+    #resampled mono audio arrives in the stereo output
+    assert pull(stream, 400).any()
+    output.close()
+    assert stream.closed
+
+
+def test_resampled_frames_keep_their_pts():
+    audio = FakePyAudio()
+    output = AudioOutput(audio, PrefixLogger("test"), target_latency=0.0)
+    output.write(make_frame(1000))
+    frame = make_frame(1000, samples=441, sample_rate=44100, layout="mono")
+    frame.pts = 441
+    frame.time_base = fractions.Fraction(1, 44100)
+    output.write(frame)
+    assert frame.pts == 441
+    output.close()
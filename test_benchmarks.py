@@ -0,0 +1,28 @@
+import asyncio
+import logging
+
+from benchmarks import BenchmarkResult, compare, run_benchmarks, to_json
+
+
+def test_quick_run_produces_results():
+    results = asyncio.run(run_benchmarks(quick=True, only=["network_event", "track"]))
+    names = {r.name for r in results}
+    assert {"network_event.encode", "network_event.decode", "track.test_video", "track.beep"} <= names
+    assert all(r.value > 0 for r in results)
+    assert set(to_json(results)["results"]) == names
+
+
+def test_compare_with_baseline():
+    baseline = to_json([BenchmarkResult("fast", 100, "ops/s"), BenchmarkResult("setup", 50, "ms", False)])
+    assert compare([BenchmarkResult("fast", 80, "ops/s"), BenchmarkResult("setup", 60, "ms", False)], baseline) == []
+    regressions = compare([BenchmarkResult("fast", 70, "ops/s"), BenchmarkResult("setup", 70, "ms", False),
+                           BenchmarkResult("new", 1, "ops/s")], baseline)
+    assert len(regressions) == 2
+    assert regressions[0].startswith("fast")
+
+
+def test_call_benchmarks_dispose_cleanly(caplog):
+    with caplog.at_level(logging.WARNING):
+        results = asyncio.run(run_benchmarks(quick=True, only=["call_setup"]))
+    assert [r.name for r in results] == ["call_setup.loopback"]
+    assert not [r.getMessage() for r in caplog.records if r.levelno >= logging.ERROR]
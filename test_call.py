@@ -0,0 +1,104 @@
+import asyncio
+import logging
+
+from call import Call, PeerLimits
+from call_peer import CallEventHandler
+from websocket_network import ConnectionId, NetEventType, NetworkEvent
+
+
+class FakeNetwork:
+    def __init__(self):
+        self.disconnected = []
+
+    def register_event_handler(self, handler):
+        self.handler = handler
+
+    async def disconnect(self, connection_id):
+        self.disconnected.append(connection_id.id)
+
+    async def send_text(self, msg, connection_id=None):
+        pass
+
+    async def dispose(self):
+        pass
+
+
+class NullHandler(CallEventHandler):
+    async def on_call_event(self, args):
+        pass
+
+
+def message_event(connection_id: int, text: str) -> NetworkEvent:
+    return NetworkEvent(NetEventType.ReliableMessageReceived, ConnectionId(connection_id), text.encode("utf-16-le"))
+
+
+def test_dispose_closes_peers_in_parallel():
+    async def run():
+        call = Call(None, NullHandler(), network=FakeNetwork(), is_conference=True)  # type: ignore
+        for connection_id in (1, 2, 3):
+            await call.signaling_event_handler(NetworkEvent(NetEventType.NewConnection, ConnectionId(connection_id), None))
+
+        async def hang():
+            await asyncio.Event().wait()
+        #e.g. a stuck DTLS transport
+        for connection_id in (2, 3):
+            call.peers[connection_id].peer.close = hang  # type: ignore
+        timings = await call.dispose(0.2)
+        #the hung peers time out at the same time instead of one after the other
+        assert 0.2 <= timings["peers"] < 0.4
+        assert not call.peers
+
+    asyncio.run(run())
+
+
+def test_half_open_peer_is_only_closed_with_limits():
+    async def run():
+        for limits in (None, PeerLimits(max_half_open=10)):
+            call = Call(None, NullHandler(), network=FakeNetwork(), limits=limits)  # type: ignore
+            await call.signaling_event_handler(NetworkEvent(NetEventType.NewConnection, ConnectionId(1), None))
+            await call.signaling_event_handler(NetworkEvent(NetEventType.Disconnected, ConnectionId(1), None))
+            assert (1 in call.peers) == (limits is None)
+            await call.dispose(1)
+
+    asyncio.run(run())
+
+
+def test_signaling_of_evicted_connection_is_ignored(caplog):
+    async def run():
+        network = FakeNetwork()
+        call = Call(None, NullHandler(), network=network, limits=PeerLimits(max_peers=1), is_conference=True)  # type: ignore
+        for connection_id in (1, 2):
+            await call.signaling_event_handler(NetworkEvent(NetEventType.NewConnection, ConnectionId(connection_id), None))
+        #the first peer didn't connect yet and makes room for the second
+        assert list(call.peers) == [2]
+        assert network.disconnected == [1]
+        assert call.admission_stats.evicted == 1
+        caplog.clear()
+        with caplog.at_level(logging.DEBUG):
+            await call.signaling_event_handler(message_event(1, "12345"))
+            await call.signaling_event_handler(NetworkEvent(NetEventType.Disconnected, ConnectionId(1), None))
+        assert not [r for r in caplog.records if r.levelno >= logging.WARNING]
+        assert any("dropped connection" in r.getMessage() for r in caplog.records)
+        await call.dispose(1)
+
+    asyncio.run(run())
+
+
+def test_idle_peer_is_evicted():
+    async def run():
+        network = FakeNetwork()
+        call = Call(None, NullHandler(), network=network, limits=PeerLimits(idle_timeout=0.2), is_conference=True)  # type: ignore
+        for connection_id in (1, 2):
+            await call.signaling_event_handler(NetworkEvent(NetEventType.NewConnection, ConnectionId(connection_id), None))
+            #connecting needs a remote side. Only the state matters here
+            call.peers[connection_id].peer._RTCPeerConnection__connectionState = "connected"  # type: ignore
+        #only the second peer keeps sending
+        for _ in range(25):
+            await call.signaling_event_handler(message_event(2, "12345"))
+            await asyncio.sleep(0.02)
+        assert list(call.peers) == [2]
+        assert network.disconnected == [1]
+        assert call.admission_stats.idle == 1
+        await call.dispose(1)
+
+    asyncio.run(run())
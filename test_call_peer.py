@@ -0,0 +1,150 @@
+import asyncio
+
+from call import id_role_rule
+from call_events import CallEventType
+from call_peer import CallEventHandler, CallPeer, RecoveryConfig
+from prefix_logger import PrefixLogger
+from websocket_network import ConnectionId
+
+
+class RecordingHandler(CallEventHandler):
+    def __init__(self):
+        self.types = []
+        #like Call the peer is closed once the call ended
+        self.peer: CallPeer | None = None
+
+    async def on_call_event(self, args):
+        self.types.append(args.type)
+        if args.type == CallEventType.CALL_ENDED and self.peer is not None:
+            await self.peer.close(5)
+
+
+def connect(sender: CallPeer, receiver: CallPeer):
+    async def forward(peer, message):
+        #tasks keep the order of the messages without nesting the handlers of both sides
+        asyncio.create_task(receiver.forward_message(message))
+    sender.on_signaling_message(forward)
+
+
+async def fail(peer: CallPeer):
+    #aiortc only reports failed after its ICE consent checks time out
+    peer.peer._RTCPeerConnection__connectionState = "failed"  # type: ignore
+    await peer.on_connectionstatechange()
+
+
+async def wait_until(condition, timeout=10):
+    async def poll():
+        while not condition():
+            await asyncio.sleep(0.05)
+    await asyncio.wait_for(poll(), timeout)
+
+
+def test_id_role_rule():
+    remote_ids = {1: 5, 2: 20}
+    rule = id_role_rule(10, lambda connection_id: remote_ids.get(connection_id.id))
+    assert rule(ConnectionId(1)) is True
+    assert rule(ConnectionId(2)) is False
+    assert rule(ConnectionId(3)) is None
+    #the remote side comes to the opposite result
+    assert id_role_rule(5, lambda connection_id: 10)(ConnectionId(1)) is False
+
+
+def test_role_rule_falls_back_for_older_clients():
+    async def run():
+        logger = PrefixLogger("test")
+        for rule_offers in (True, False):
+            handlers = RecordingHandler(), RecordingHandler()
+            #the first peer decided its role via a RoleRule. The second one only knows the random numbers
+            with_rule = CallPeer(ConnectionId(1), handlers[0], logger)
+            without_rule = CallPeer(ConnectionId(2), handlers[1], logger)
+            connect(with_rule, without_rule)
+            connect(without_rule, with_rule)
+            if rule_offers:
+                await with_rule.create_offer()
+            else:
+                with_rule.wait_for_offer(CallPeer.ROLE_FALLBACK_TIMEOUT)
+            await without_rule.negotiate_role()
+            await wait_until(lambda: with_rule.is_established and without_rule.is_established)
+            assert with_rule.is_offerer != without_rule.is_offerer
+            if rule_offers:
+                assert with_rule.random_number is None
+            await with_rule.close(1)
+            await without_rule.close(1)
+
+    asyncio.run(run())
+
+
+def test_role_rule_times_out_without_offer():
+    async def run():
+        logger = PrefixLogger("test")
+        #rules that contradict each other. Both sides wait
+        peers = CallPeer(ConnectionId(1), RecordingHandler(), logger), CallPeer(ConnectionId(2), RecordingHandler(), logger)
+        connect(peers[0], peers[1])
+        connect(peers[1], peers[0])
+        for peer in peers:
+            peer.wait_for_offer(0.1)
+        await wait_until(lambda: peers[0].is_established and peers[1].is_established)
+        assert peers[0].is_offerer != peers[1].is_offerer
+        for peer in peers:
+            await peer.close(1)
+
+    asyncio.run(run())
+
+
+def test_failed_connection_recovers():
+    async def run():
+        logger = PrefixLogger("test")
+        recovery = RecoveryConfig(timeout=10)
+        handlers = RecordingHandler(), RecordingHandler()
+        offerer = CallPeer(ConnectionId(1), handlers[0], logger, recovery)
+        answerer = CallPeer(ConnectionId(2), handlers[1], logger, recovery)
+        connect(offerer, answerer)
+        connect(answerer, offerer)
+        await offerer.create_offer()
+        await wait_until(lambda: offerer.is_established and answerer.is_established)
+        first_peers = offerer.peer, answerer.peer
+
+        await fail(answerer)
+        #a second failed while the recovery is pending doesn't end the call
+        await fail(answerer)
+        await fail(offerer)
+        await wait_until(lambda: offerer._recovery_task is None and answerer._recovery_task is None, 15)
+
+        for peer, first_peer, handler in zip((offerer, answerer), first_peers, handlers):
+            assert peer.peer is not first_peer
+            assert peer.is_established
+            assert not peer.has_ended
+            assert peer.recovery_attempts == 1
+            assert handler.types.count(CallEventType.CALL_ACCEPTED) == 1
+            assert CallEventType.CALL_ENDED not in handler.types
+        await offerer.close(1)
+        await answerer.close(1)
+        for first_peer in first_peers:
+            await first_peer.close()
+
+    asyncio.run(run())
+
+
+def test_failed_recovery_closes_the_peer(caplog):
+    async def run():
+        logger = PrefixLogger("test")
+        handlers = RecordingHandler(), RecordingHandler()
+        offerer = CallPeer(ConnectionId(1), handlers[0], logger)
+        answerer = CallPeer(ConnectionId(2), handlers[1], logger, RecoveryConfig(timeout=0.2))
+        handlers[1].peer = answerer
+        connect(offerer, answerer)
+        connect(answerer, offerer)
+        await offerer.create_offer()
+        await wait_until(lambda: offerer.is_established and answerer.is_established)
+
+        #the offerer doesn't recover so no new offer arrives
+        await fail(answerer)
+        #the recovery task ends the call and closes the peer before it finishes
+        await wait_until(lambda: answerer.recovery_attempts == 1 and answerer._recovery_task is None)
+        assert answerer.peer.connectionState == "closed"
+        assert answerer.has_ended
+        assert handlers[1].types.count(CallEventType.CALL_ENDED) == 1
+        await offerer.close(1)
+
+    asyncio.run(run())
+    assert not [r for r in caplog.records if "CancelledError" in r.getMessage()]
@@ -0,0 +1,21 @@
+import asyncio
+
+from benchmarks import _Unpaced
+from latency_probe import AudioLatencyAnalyzer
+from tracks import BeepTrack
+
+
+def test_audio_analyzer_keeps_the_frames():
+    async def run():
+        track = BeepTrack(chirp=True, interval=0.2)
+        track.pacer = _Unpaced(track.samples_per_frame)  # type: ignore
+        analyzer = AudioLatencyAnalyzer(track)
+        for _ in range(30):
+            frame = await track.recv()
+            pts = frame.pts
+            analyzer.add_frame(frame)
+            assert frame.pts == pts
+        assert analyzer.detections > 0
+        track.stop()
+
+    asyncio.run(run())
@@ -0,0 +1,30 @@
+import asyncio
+import time
+
+from loop_monitor import LoopMonitor
+from prefix_logger import PrefixLogger
+
+
+class BlockingComponent:
+    def __init__(self):
+        self.logger = PrefixLogger("test").get_child("Blocking")
+
+    def work(self, duration):
+        time.sleep(duration)
+
+
+def test_stall_is_attributed_to_component():
+    async def run():
+        monitor = LoopMonitor(PrefixLogger("test"), threshold=0.05, interval=0.01, log_stalls=False)
+        monitor.start()
+        await asyncio.sleep(0.05)
+        BlockingComponent().work(0.2)
+        await asyncio.sleep(0.05)
+        await monitor.stop()
+        return monitor
+
+    monitor = asyncio.run(run())
+    assert monitor.stats.stalls == 1
+    assert monitor.stats.max_lag_ms >= 150
+    total = monitor.totals["test.Blocking"]
+    assert total.count == 1 and "work" in total.stack
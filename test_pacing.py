@@ -0,0 +1,50 @@
+import asyncio
+from fractions import Fraction
+import time
+
+from pacing import Pacer, PacingClock
+
+
+def test_pacers_share_one_timer():
+    async def run():
+        clock = PacingClock.get()
+        pacers = [Pacer(Fraction(1, 100)) for _ in range(50)]
+        timer_counts = []
+
+        async def track(pacer: Pacer):
+            for _ in range(10):
+                await pacer.next_frame()
+                timer_counts.append(clock.timer_count)
+        start = time.monotonic()
+        await asyncio.gather(*[track(pacer) for pacer in pacers])
+        #the first frame is returned right away. The other 9 are paced
+        assert time.monotonic() - start >= 0.08
+        assert max(timer_counts) == 1
+        for pacer in pacers:
+            assert pacer.index == 9
+            assert pacer.pts(90000) == 9 * 900
+            assert pacer.stats.frames == 10
+
+    asyncio.run(run())
+
+
+def test_missed_frames():
+    async def run():
+        audio = Pacer(Fraction(960, 48000))
+        video = Pacer(Fraction(1, 50), skip_missed=True)
+        for pacer in (audio, video):
+            await pacer.next_frame()
+        #the loop was blocked for 5 frames
+        time.sleep(0.1)
+        #audio returns the missed frames without waiting
+        start = time.monotonic()
+        assert [await audio.next_frame() for _ in range(4)] == [1, 2, 3, 4]
+        assert time.monotonic() - start < 0.01
+        assert audio.pts(48000) == 4 * 960
+        assert audio.stats.late_frames >= 3
+        #video continues with the current frame
+        index = await video.next_frame()
+        assert index >= 5
+        assert video.stats.skipped_frames == index - 1
+
+    asyncio.run(run())
@@ -0,0 +1,64 @@
+import asyncio
+import fractions
+import queue
+
+import av
+import numpy as np
+from aiortc import RTCRtpCodecParameters
+from aiortc.jitterbuffer import JitterFrame
+
+from passthrough import PassthroughRecorder, parse_frame_size
+
+
+def encode_frames(codec_name, count=3, width=320, height=240):
+    encoder = av.CodecContext.create(codec_name, "w")
+    encoder.width = width
+    encoder.height = height
+    encoder.pix_fmt = "yuv420p"
+    encoder.time_base = fractions.Fraction(1, 30)
+    packets = []
+    for i in range(count):
+        frame = av.VideoFrame.from_ndarray(np.full((height, width, 3), i * 40, dtype=np.uint8), format="bgr24")
+        frame = frame.reformat(format="yuv420p")
+        frame.pts = i
+        packets.extend(encoder.encode(frame))
+    packets.extend(encoder.encode(None))
+    return [bytes(p) for p in packets]
+
+
+class FakeTrack:
+    kind = "video"
+
+
+class FakeReceiver:
+    def __init__(self):
+        self.track = FakeTrack()
+        self._RTCRtpReceiver__decoder_queue = queue.Queue()
+
+
+def test_parse_frame_size():
+    assert parse_frame_size("video/H264", encode_frames("libx264", 1)[0]) == (320, 240)
+    assert parse_frame_size("video/VP8", encode_frames("libvpx", 1)[0]) == (320, 240)
+    assert parse_frame_size("audio/opus", b"\x00") == (0, 0)
+
+
+def test_records_h264_keyframe(tmp_path):
+    path = str(tmp_path / "out.mkv")
+    receiver = FakeReceiver()
+    recorder = PassthroughRecorder(path)
+    recorder.addReceiver(receiver)  # type: ignore
+    codec = RTCRtpCodecParameters(mimeType="video/H264", clockRate=90000, payloadType=102)
+    tap = receiver._RTCRtpReceiver__decoder_queue
+
+    async def run():
+        await recorder.start()
+        for i, data in enumerate(encode_frames("libx264")):
+            tap.put((codec, JitterFrame(data, i * 3000)))
+        await recorder.stop()
+    asyncio.run(run())
+
+    assert recorder.muxed_frames == 3
+    with av.open(path) as container:
+        stream = container.streams.video[0]
+        assert (stream.codec_context.width, stream.codec_context.height) == (320, 240)
+        assert sum(1 for packet in container.demux(stream) if packet.size) == 3
@@ -0,0 +1,60 @@
+import json
+import logging
+
+from prefix_logger import LogLimit, LogPayload, PrefixLogger, set_log_limit
+
+
+def test_children_are_cached():
+    logger = PrefixLogger("test")
+    assert logger.get_child("A") is logger.get_child("A")
+    assert logger.get_child("A").name == "test.A"
+
+
+def test_payload_is_redacted_and_truncated():
+    sdp = "v=0\r\na=ice-ufrag:user\r\na=ice-pwd:secret\r\na=fingerprint:sha-256 AB:CD\r\n" + "a=x\r\n" * 100
+    text = str(LogPayload(json.dumps({"sdp": sdp, "type": "offer"})))
+    assert "secret" not in text and "user" not in text and "AB:CD" not in text
+    assert text.endswith(" chars)") and len(text) < LogPayload.MAX_LENGTH + 20
+
+
+def test_sampling_and_rate_limit(caplog):
+    logger = PrefixLogger("test.limits")
+    set_log_limit("sampled", LogLimit(sample_every=3))
+    set_log_limit("limited", LogLimit(rate=0.001, burst=2))
+    try:
+        with caplog.at_level(logging.INFO):
+            for i in range(7):
+                logger.info("sampled %d", i, category="sampled")
+            for i in range(5):
+                logger.info("limited %d", i, category="limited")
+    finally:
+        set_log_limit("sampled", None)
+        set_log_limit("limited", None)
+    messages = [r.getMessage() for r in caplog.records]
+    assert messages == ["sampled 0", "sampled 3 [2 sampled messages suppressed]",
+                        "sampled 6 [2 sampled messages suppressed]", "limited 0", "limited 1"]
+
+
+def test_disabled_level_does_not_format(caplog):
+    class Expensive:
+        def __str__(self):
+            raise AssertionError("formatted")
+    logger = PrefixLogger("test.lazy")
+    with caplog.at_level(logging.INFO):
+        logger.debug("value %s", Expensive())
+    assert not caplog.records
+
+
+def test_warnings_are_not_limited(caplog):
+    logger = PrefixLogger("test.warnings")
+    set_log_limit("limited", LogLimit(sample_every=2, rate=0.001, burst=1))
+    try:
+        with caplog.at_level(logging.INFO):
+            for i in range(3):
+                logger.info("info %d", i, category="limited")
+                logger.warning("warning %d", i, category="limited")
+            logger.error("error", category="limited")
+    finally:
+        set_log_limit("limited", None)
+    messages = [r.getMessage() for r in caplog.records]
+    assert messages == ["info 0", "warning 0", "warning 1", "warning 2", "error"]
@@ -0,0 +1,15 @@
+from aiortc import RTCRtpCodecParameters
+from aiortc.jitterbuffer import JitterFrame
+
+from receive_metrics import TrackMeter
+from test_passthrough import encode_frames
+
+
+def test_encoded_frames_report_resolution():
+    for mime_type, codec_name in (("video/H264", "libx264"), ("video/VP8", "libvpx")):
+        meter = TrackMeter("video", encoded=True)
+        codec = RTCRtpCodecParameters(mimeType=mime_type, clockRate=90000, payloadType=96)
+        for i, data in enumerate(encode_frames(codec_name, 1) + encode_frames(codec_name, 1, 640, 480)):
+            meter.add_encoded_frame(codec, JitterFrame(data, i * 3000))
+        assert (meter.metrics.width, meter.metrics.height) == (640, 480)
+        assert meter.metrics.resolution_changes == 1
@@ -0,0 +1,222 @@
+import asyncio
+import threading
+
+import av
+from av import AudioFrame, VideoFrame
+from av.frame import Frame
+from av.video.frame import PictureType
+from aiortc.mediastreams import MediaStreamError, MediaStreamTrack
+
+from benchmarks import _Unpaced
+import tracks
+from tracing import tracer
+from tracks import (CustomMediaRecorder, DropPolicy, EncoderProfile, FrameQueue, RecorderConfig, RecorderStats,
+                    SegmentConfig)
+
+
+class FrameSource(MediaStreamTrack):
+    '''
+    Returns count frames of the given track without pacing and then ends.
+    '''
+
+    def __init__(self, track: MediaStreamTrack, count: int):
+        super().__init__()
+        self.kind = track.kind
+        self._track = track
+        self._track.pacer = _Unpaced(getattr(track, "samples_per_frame", 3000))  # type: ignore
+        self._count = count
+
+    async def recv(self):
+        if self._count == 0:
+            raise MediaStreamError
+        self._count -= 1
+        #yield so the recorder's other tasks run like with a real track
+        await asyncio.sleep(0)
+        return await self._track.recv()
+
+
+class SilentTrack(MediaStreamTrack):
+    #e.g. a negotiated audio track the remote side never sends anything on
+    kind = "audio"
+
+    async def recv(self):
+        await asyncio.Event().wait()
+
+
+class SilentVideoTrack(SilentTrack):
+    kind = "video"
+
+
+def video_source(count: int) -> FrameSource:
+    return FrameSource(tracks.TestVideoStreamTrack(width=320, height=240), count)
+
+
+async def record(recorder: CustomMediaRecorder, sources: list, frames: int) -> None:
+    for source in sources:
+        recorder.addTrack(source)
+    await recorder.start()
+    while recorder.stats.encoded_frames + recorder.stats.dropped_frames < frames:
+        await asyncio.sleep(0.01)
+    await recorder.stop()
+
+
+def test_track_without_frames_does_not_discard_the_recording(tmp_path):
+    path = str(tmp_path / "out.mp4")
+    asyncio.run(record(CustomMediaRecorder(path, RecorderConfig(queue_size=100)), [video_source(30), SilentTrack()], 30))
+    with av.open(path) as container:
+        video = container.streams.video[0]
+        assert (video.width, video.height) == (320, 240)
+        assert sum(1 for _ in container.demux(video) if _.size > 0) == 30
+
+
+def test_streams_start_after_the_setup_timeout(tmp_path, monkeypatch):
+    monkeypatch.setattr(CustomMediaRecorder, "STREAM_SETUP_TIMEOUT", 0)
+    path = str(tmp_path / "out.webm")
+    #the silent video stream is started with the default size before the first packet is written
+    asyncio.run(record(CustomMediaRecorder(path, RecorderConfig(queue_size=100)),
+                       [FrameSource(tracks.SineWaveTrack(), 50), SilentVideoTrack()], 50))
+    with av.open(path) as container:
+        assert sum(1 for packet in container.demux(container.streams.audio[0]) if packet.size > 0) > 40
+
+
+def test_segments_roll_over(tmp_path):
+    segments = []
+    playlist = str(tmp_path / "out.m3u8")
+    config = RecorderConfig(queue_size=100, segment=SegmentConfig(duration=1.0, playlist=playlist))
+
+    async def run():
+        recorder = CustomMediaRecorder(str(tmp_path / "out_%03d.mp4"), config, on_segment=segments.append)
+        #3 seconds at 30 fps
+        await record(recorder, [video_source(90)], 90)
+        #on_segment is called via the event loop
+        await asyncio.sleep(0)
+    asyncio.run(run())
+
+    assert segments == [str(tmp_path / f"out_{i:03d}.mp4") for i in range(3)]
+    frames = 0
+    for path in segments:
+        with av.open(path) as container:
+            packets = [p for p in container.demux(container.streams.video[0]) if p.size > 0]
+            #each segment starts with a keyframe so it can be played on its own
+            assert packets[0].is_keyframe
+            frames += len(packets)
+    assert frames == 90
+    with open(playlist) as f:
+        assert f.read().count(".mp4") == 3
+
+
+def test_profile_steps_down():
+    profile = EncoderProfile(preset="faster", adaptive=True)
+    assert profile.step_down("libx264") and profile.preset == "veryfast"
+    assert profile.step_down("libx264") and profile.step_down("libx264")
+    #already the fastest preset
+    assert not profile.step_down("libx264") and profile.preset == "ultrafast"
+    assert profile.get_options("libx264")["preset"] == "ultrafast"
+
+    profile = EncoderProfile()
+    for cpu_used in (4, 8, 12, 16):
+        assert profile.step_down("libvpx") and profile.cpu_used == cpu_used
+    assert not profile.step_down("libvpx")
+    #codecs without speed settings
+    assert not profile.step_down("mpeg4")
+
+
+def test_adaptive_encoder_reopens_with_a_faster_preset(tmp_path, monkeypatch):
+    #every frame ends a measurement window that exceeds max_load
+    monkeypatch.setattr(CustomMediaRecorder, "LOAD_WINDOW", 1e-9)
+    path = str(tmp_path / "out.mp4")
+    config = RecorderConfig(queue_size=100, encoder=EncoderProfile(preset="superfast", adaptive=True, max_load=0))
+    recorder = CustomMediaRecorder(path, config)
+    asyncio.run(record(recorder, [video_source(30)], 30))
+    assert recorder.stats.encoder_steps == 1
+    #the profile of the config isn't changed
+    assert config.encoder is not None and config.encoder.preset == "superfast"
+    with av.open(path) as container:
+        video = container.streams.video[0]
+        assert sum(1 for frame in container.decode(video)) == 30
+
+
+def make_frame(kind: str, pts: int, keyframe: bool = False) -> Frame:
+    frame: Frame
+    if kind == "audio":
+        frame = AudioFrame(format="s16", layout="mono", samples=960)
+    else:
+        video = VideoFrame(16, 16, "yuv420p")
+        if keyframe:
+            video.pict_type = PictureType.I
+        frame = video
+    frame.pts = pts
+    return frame
+
+
+def queued(queue: FrameQueue) -> list:
+    queue.close()
+    items = []
+    while (item := queue.get()) is not None:
+        items.append(item[1].pts)
+    return items
+
+
+def test_frame_queue_drops_oldest():
+    stats = RecorderStats()
+    queue = FrameQueue(3, DropPolicy.DROP_OLDEST, stats)
+    for pts in range(5):
+        queue.put(None, make_frame("audio" if pts == 0 else "video", pts))  # type: ignore
+    assert stats.dropped_frames == 2
+    assert stats.max_queue_depth == 3
+    assert queued(queue) == [2, 3, 4]
+    assert stats.queue_depth == 0
+
+
+def test_frame_queue_drops_video_first():
+    stats = RecorderStats()
+    queue = FrameQueue(3, DropPolicy.DROP_VIDEO_FIRST, stats)
+    queue.put(None, make_frame("video", 0, keyframe=True))  # type: ignore
+    queue.put(None, make_frame("audio", 1))  # type: ignore
+    queue.put(None, make_frame("video", 2))  # type: ignore
+    #the delta frame goes first
+    queue.put(None, make_frame("video", 3))  # type: ignore
+    #then the next one. Keyframes and audio are kept
+    queue.put(None, make_frame("audio", 4))  # type: ignore
+    assert stats.dropped_frames == 2
+    assert queued(queue) == [0, 1, 4]
+
+    #falls back to the oldest frame if only keyframes and audio are queued
+    queue = FrameQueue(2, DropPolicy.DROP_VIDEO_FIRST, stats)
+    for pts in range(3):
+        queue.put(None, make_frame("audio", pts))  # type: ignore
+    assert queued(queue) == [1, 2]
+
+
+def test_frame_queue_wakes_up_the_worker():
+    queue = FrameQueue(3, DropPolicy.DROP_OLDEST, RecorderStats())
+    received = []
+
+    def worker():
+        while (item := queue.get()) is not None:
+            received.append(item[1].pts)
+
+    thread = threading.Thread(target=worker)
+    thread.start()
+    for pts in range(3):
+        queue.put(None, make_frame("audio", pts))  # type: ignore
+    queue.close()
+    thread.join(5)
+    assert not thread.is_alive()
+    assert received == [0, 1, 2]
+
+
+def test_encodes_on_the_worker_thread(tmp_path):
+    recorder = CustomMediaRecorder(str(tmp_path / "out.mp4"), RecorderConfig(queue_size=100))
+    tracer.clear()
+    tracer.enable()
+    try:
+        asyncio.run(record(recorder, [video_source(10)], 10))
+    finally:
+        tracer.disable()
+    events = tracer.to_chrome_trace()["traceEvents"]
+    tracer.clear()
+    names = {e["tid"]: e["args"]["name"] for e in events if e["ph"] == "M"}
+    assert {names[e["tid"]] for e in events if e["name"] == "encode"} == {"CustomMediaRecorder"}
+    assert recorder.stats.encoded_frames == 10
+    assert recorder.stats.encode_time > 0
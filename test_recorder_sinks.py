@@ -0,0 +1,34 @@
+import asyncio
+import io
+
+import av
+
+from recorder_sinks import AsyncStreamSink
+from test_recorder import record, video_source
+from tracks import CustomMediaRecorder
+
+
+def test_async_stream_sink_output():
+    async def run():
+        sink = AsyncStreamSink(max_chunks=4)
+        config = CustomMediaRecorder.get_streaming_config("mp4")
+        config.queue_size = 100
+        recorder = CustomMediaRecorder(sink, config)
+
+        async def consume():
+            return [chunk async for chunk in sink]
+        #the small queue makes the worker thread wait for the consumer
+        consumer = asyncio.create_task(consume())
+        await record(recorder, [video_source(60)], 60)
+        chunks = await asyncio.wait_for(consumer, 10)
+        assert sink.closed
+        assert await sink.read() is None
+        return recorder, sink, chunks
+
+    recorder, sink, chunks = asyncio.run(run())
+    assert len(chunks) > 4
+    assert sum(len(chunk) for chunk in chunks) == sink.bytes_written
+    assert recorder.stats.dropped_frames == 0
+    with av.open(io.BytesIO(b"".join(chunks))) as container:
+        video = container.streams.video[0]
+        assert sum(1 for packet in container.demux(video) if packet.size > 0) == 60
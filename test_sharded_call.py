@@ -0,0 +1,37 @@
+import asyncio
+import multiprocessing
+import threading
+
+from prefix_logger import PrefixLogger
+from sharded_call import PipeChannel
+
+
+def test_pipe_channel_keeps_the_loop_free():
+    async def run():
+        logger = PrefixLogger("test")
+        conn_a, conn_b = multiprocessing.Pipe()
+        a = PipeChannel(conn_a, "A", logger)
+        b = PipeChannel(conn_b, "B", logger)
+        threads = threading.active_count()
+        #larger than the pipe buffer. The writer thread blocks until the reader thread catches up
+        messages = [bytes([i]) * 200_000 for i in range(5)]
+        for msg in messages:
+            a.send(msg)
+        assert [await b.recv() for _ in messages] == messages
+        b.send(b"")
+        assert await a.recv() == b""
+        #no executor threads are started for waiting on the pipe
+        assert threading.active_count() == threads
+        await a.close()
+        assert await b.recv() is None
+        await b.close()
+        assert not a._reader.is_alive() and not b._reader.is_alive()
+
+        conn_c, conn_d = multiprocessing.Pipe()
+        d = PipeChannel(conn_d, "D", logger)
+        #e.g. the worker process exited
+        conn_c.close()
+        assert await d.recv() is None
+        await d.close()
+
+    asyncio.run(run())
@@ -0,0 +1,72 @@
+import asyncio
+
+import av
+from aiortc.mediastreams import MediaStreamTrack
+
+from benchmarks import _Unpaced
+from tee_recorder import TeeMediaRecorder
+import tracks
+from tracks import EncoderProfile, RecorderConfig
+
+
+class GatedSource(MediaStreamTrack):
+    '''
+    Returns a video frame each time release is called.
+    '''
+    kind = "video"
+
+    def __init__(self):
+        super().__init__()
+        self._track = tracks.TestVideoStreamTrack(width=320, height=240)
+        self._track.pacer = _Unpaced()  # type: ignore
+        self._released = asyncio.Semaphore(0)
+
+    def release(self, count: int) -> None:
+        for _ in range(count):
+            self._released.release()
+
+    async def recv(self):
+        await self._released.acquire()
+        return await self._track.recv()
+
+
+def video_packets(path: str) -> list:
+    with av.open(path) as container:
+        packets = [p for p in container.demux(container.streams.video[0]) if p.size > 0]
+    return packets
+
+
+def test_outputs_added_and_removed_mid_stream(tmp_path):
+    first_path, second_path = str(tmp_path / "first.mp4"), str(tmp_path / "second.mkv")
+    #zerolatency. Otherwise the encoder holds back the first 40 or so frames
+    recorder = TeeMediaRecorder(RecorderConfig(queue_size=100, encoder=EncoderProfile.realtime()))
+    source = GatedSource()
+    recorder.addTrack(source)
+
+    async def encode(count: int):
+        encoded = recorder.stats.encoded_frames + count
+        source.release(count)
+        while recorder.stats.encoded_frames < encoded:
+            await asyncio.sleep(0.01)
+
+    async def run():
+        first = recorder.addOutput(first_path)
+        await recorder.start()
+        await encode(20)
+        second = recorder.addOutput(second_path)
+        await encode(20)
+        await recorder.removeOutput(first)
+        assert first.closed and not second.closed
+        await encode(20)
+        await recorder.stop()
+        assert second.closed
+    asyncio.run(run())
+
+    #the first output ends where it was removed
+    first_packets = video_packets(first_path)
+    assert first_packets[0].is_keyframe
+    assert len(first_packets) == 40
+    #the second one starts with the keyframe requested when it was opened and runs to the end
+    second_packets = video_packets(second_path)
+    assert second_packets[0].is_keyframe
+    assert len(second_packets) == 40
@@ -0,0 +1,82 @@
+import asyncio
+import json
+import signal
+import threading
+
+from tracing import Tracer
+
+
+def test_disabled_tracer_records_nothing():
+    tracer = Tracer()
+    with tracer.span("work", "test"):
+        pass
+    tracer.instant("event", "test")
+    assert tracer.to_chrome_trace()["traceEvents"] == []
+
+
+def test_chrome_trace_with_tasks_and_ring_buffer(tmp_path):
+    tracer = Tracer()
+    tracer.enable(capacity=3)
+
+    @tracer.traced("test")
+    async def step():
+        with tracer.span("inner", "test", {"value": 1}):
+            await asyncio.sleep(0)
+
+    async def run():
+        await asyncio.gather(step(), step())
+    asyncio.run(run())
+    tracer.instant("done", "test")
+
+    path = tmp_path / "trace.json"
+    tracer.dump(str(path))
+    events = json.loads(path.read_text())["traceEvents"]
+    spans = [e for e in events if e["ph"] != "M"]
+    #4 spans and an instant event. Only the last 3 are kept
+    assert len(spans) == 3 and spans[-1]["ph"] == "i"
+    assert all(e["dur"] >= 0 for e in spans if e["ph"] == "X")
+    #each task and the main thread get their own track
+    names = [e["args"]["name"] for e in events if e["ph"] == "M"]
+    assert len(names) == len({e["tid"] for e in spans})
+    assert "MainThread" in names
+
+
+def test_tracks_keep_their_names():
+    tracer = Tracer()
+    tracer.enable()
+
+    async def step():
+        with tracer.span("step", "test"):
+            await asyncio.sleep(0)
+
+    async def run():
+        #the ids of finished tasks are reused by later ones
+        for i in range(3):
+            await asyncio.create_task(step(), name=f"step{i}")
+    asyncio.run(run())
+
+    events = tracer.to_chrome_trace()["traceEvents"]
+    names = {e["tid"]: e["args"]["name"] for e in events if e["ph"] == "M"}
+    assert [names[e["tid"]] for e in events if e["name"] == "step"] == ["task step0", "task step1", "task step2"]
+
+
+def test_signal_dump(tmp_path):
+    if not hasattr(signal, "SIGUSR1"):
+        return
+    tracer = Tracer()
+    tracer.enable()
+    tracer.instant("before", "test")
+    previous = signal.getsignal(signal.SIGUSR1)
+    try:
+        tracer.install_signal_dump(str(tmp_path))
+        signal.raise_signal(signal.SIGUSR1)
+        #events after the signal aren't part of the dump
+        tracer.instant("after", "test")
+        for thread in threading.enumerate():
+            if thread.name == "TraceDump":
+                thread.join(5)
+    finally:
+        signal.signal(signal.SIGUSR1, previous)
+    [path] = tmp_path.glob("trace_*.json")
+    events = json.loads(path.read_text())["traceEvents"]
+    assert [e["name"] for e in events if e["ph"] == "i"] == ["before"]
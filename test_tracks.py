@@ -0,0 +1,115 @@
+import asyncio
+import fractions
+import threading
+
+import numpy as np
+import pytest
+from av import AudioFrame
+from aiortc.mediastreams import MediaStreamError
+
+from benchmarks import _Unpaced
+import tracks
+
+
+def test_kept_frames_are_not_reused():
+    async def run():
+        for track in (tracks.TestVideoStreamTrack(width=64, height=48), tracks.ColorVideoStreamTrack(),
+                      tracks.BeepTrack(interval=0.05), tracks.SineWaveTrack()):
+            track.pacer = _Unpaced()  # type: ignore
+            frames = [await track.recv() for _ in range(10)]
+            kept = [(frame.pts, frame.to_ndarray().copy()) for frame in frames]
+            for _ in range(10):
+                await track.recv()
+            assert len({id(frame) for frame in frames}) == len(frames)
+            for frame, (pts, data) in zip(frames, kept):
+                assert frame.pts == pts
+                assert np.array_equal(frame.to_ndarray(), data)
+            track.stop()
+
+    asyncio.run(run())
+
+
+def test_pushed_frames_keep_their_pts():
+    track = tracks.PushAudioStreamTrack(sample_rate=48000, layout="mono")
+    frame = AudioFrame.from_ndarray(np.zeros((1, 441 * 2), dtype=np.int16), format="s16", layout="stereo")
+    frame.sample_rate = 44100
+    frame.pts = 441
+    frame.time_base = fractions.Fraction(1, 44100)
+    track.push(frame)
+    assert frame.pts == 441
+    track.stop()
+
+
+def test_copy_from_table_wraps_around():
+    table = np.arange(10, dtype=np.int16)
+    out = np.zeros(5, dtype=np.int16)
+    assert tracks.copy_from_table(table, 7, out) == 2
+    assert out.tolist() == [7, 8, 9, 0, 1]
+    assert tracks.copy_from_table(table, 0, out) == 5
+    assert out.tolist() == [0, 1, 2, 3, 4]
+
+
+def test_audio_tables_are_continuous():
+    async def samples(track, frames: int) -> np.ndarray:
+        return np.concatenate([(await track.recv()).to_ndarray().reshape(-1) for _ in range(frames)]).astype(np.float64)
+
+    async def run():
+        for frequency in (800, 440.5):
+            track = tracks.SineWaveTrack(frequency=frequency)
+            track.pacer = _Unpaced(track.samples_per_frame)  # type: ignore
+            #a few loops of the table
+            data = await samples(track, 250)
+            t = np.arange(len(data)) / track.sample_rate
+            assert np.abs(data - np.sin(2 * np.pi * frequency * t) * 32767).max() < 2
+
+            track.change_frequency(1000)
+            data = np.concatenate([data, await samples(track, 5)])
+            #no jump where the new table starts. A sine at 1000 Hz changes by at most this much per sample
+            max_step = 2 * np.pi * 1000 / track.sample_rate * 32767 + 2
+            assert np.abs(np.diff(data)).max() < max_step
+            track.stop()
+
+        track = tracks.BeepTrack(interval=0.1)
+        track.pacer = _Unpaced(track.samples_per_frame)  # type: ignore
+        #the table repeats every interval
+        data = await samples(track, 15)
+        interval = track.interval_samples
+        assert np.array_equal(data[:interval], data[interval:2 * interval])
+        assert np.array_equal(data[:interval], track.table)
+        track.stop()
+
+    asyncio.run(run())
+
+
+def test_push_video_track_keeps_the_latest_frame():
+    def image(value: int) -> np.ndarray:
+        return np.full((48, 64, 3), value, dtype=np.uint8)
+
+    async def run():
+        track = tracks.PushVideoStreamTrack()
+        for value in (1, 2, 3):
+            track.push(image(value))
+        frame = await track.recv()
+        assert frame.to_ndarray(format="bgr24")[0, 0, 0] == 3
+        assert (track.stats.pushed, track.stats.dropped, track.stats.sent, track.stats.copied) == (3, 2, 1, 0)
+
+        #a waiting recv is woken up by a push from another thread
+        pending = asyncio.ensure_future(track.recv())
+        await asyncio.sleep(0.01)
+        assert not pending.done()
+        thread = threading.Thread(target=track.push, args=(image(4)[:, ::2],))
+        thread.start()
+        second = await asyncio.wait_for(pending, 5)
+        thread.join()
+        assert second.to_ndarray(format="bgr24")[0, 0, 0] == 4
+        assert second.pts > frame.pts
+        #the strided view can't be wrapped
+        assert track.stats.copied == 1
+
+        pending = asyncio.ensure_future(track.recv())
+        await asyncio.sleep(0.01)
+        track.stop()
+        with pytest.raises(MediaStreamError):
+            await asyncio.wait_for(pending, 5)
+
+    asyncio.run(run())
@@ -0,0 +1,78 @@
+import threading
+import time
+
+import numpy as np
+from av import VideoFrame
+
+import video_display
+from video_display import VideoDisplay
+
+
+class FakeWindows:
+    '''
+    Records the OpenCV window calls instead of opening windows. The first imshow waits for release.
+    '''
+
+    def __init__(self):
+        self.shown = []
+        self.destroyed = []
+        self.threads = set()
+        self.release = threading.Event()
+        self.key = -1
+
+    def imshow(self, name, img):
+        self.threads.add(threading.current_thread().name)
+        self.release.wait(5)
+        self.shown.append((name, int(img[0, 0, 0])))
+
+    def waitKey(self, delay):
+        self.threads.add(threading.current_thread().name)
+        return self.key
+
+    def destroyWindow(self, name):
+        self.threads.add(threading.current_thread().name)
+        self.destroyed.append(name)
+
+
+def frame(value: int) -> VideoFrame:
+    return VideoFrame.from_ndarray(np.full((16, 16, 3), value, dtype=np.uint8), format="bgr24")
+
+
+def wait_until(condition, timeout=5):
+    end = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < end
+        time.sleep(0.01)
+
+
+def test_render_thread_shows_the_newest_frame(monkeypatch):
+    fake = FakeWindows()
+    for name in ("imshow", "waitKey", "destroyWindow"):
+        monkeypatch.setattr(video_display.cv2, name, getattr(fake, name))
+    display = VideoDisplay()
+    window = display.open_window("test")
+
+    window.show(frame(1))
+    #the render thread is busy with the first frame. The others replace each other
+    wait_until(lambda: fake.threads)
+    for value in (2, 3, 4):
+        window.show(frame(value))
+    fake.release.set()
+    wait_until(lambda: window.stats.shown == 2)
+    assert fake.shown == [("test", 1), ("test", 4)]
+    assert window.stats.skipped == 2
+
+    other = display.open_window("other")
+    other.show(frame(5))
+    wait_until(lambda: other.stats.shown == 1)
+    other.close()
+    wait_until(lambda: fake.destroyed == ["other"])
+    assert not window.closed
+
+    #q closes all windows
+    fake.key = ord("q")
+    wait_until(lambda: window.closed)
+    window.close()
+    wait_until(lambda: fake.destroyed == ["other", "test"])
+    #OpenCV is only used by the render thread
+    assert fake.threads == {"VideoDisplay"}
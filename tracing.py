@@ -0,0 +1,220 @@
+import asyncio
+from collections import deque
+import functools
+import inspect
+import json
+import logging
+import os
+import signal
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+'''
+Opt-in tracer that records spans into an in-memory ring buffer and writes them as Chrome trace
+event JSON. Open the file in https://ui.perfetto.dev or chrome://tracing to see the signaling,
+SDP / ICE steps, frame creation and encoding on a timeline.
+
+Tracing is off by default and a span costs one attribute check then. Once enabled each span
+records its start and duration. Spans of asyncio tasks are shown per task, all other spans per thread.
+Only the last capacity spans are kept.
+
+Example:
+    from tracing import tracer
+    tracer.enable()
+    tracer.install_signal_dump("traces")   #kill -USR1 <pid> writes traces/trace_<time>.json
+
+    with tracer.span("create_offer", "sdp"):
+        ...
+
+    @tracer.traced("media")
+    async def recv(self): ...
+
+    tracer.dump("trace.json")
+'''
+
+logger = logging.getLogger(__name__)
+
+#("task" or "thread", id, name shown in the timeline). The name is part of the key as ids are reused
+TrackKey = Tuple[str, int, str]
+#(name, category, start_ns, duration_ns or None for instant events, track key, args)
+TraceEvent = Tuple[str, str, int, Optional[int], TrackKey, Optional[dict]]
+
+
+class _NoSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        pass
+
+
+_NO_SPAN = _NoSpan()
+
+
+class _Span:
+    __slots__ = ("tracer", "name", "category", "args", "start")
+
+    def __init__(self, tracer: "Tracer", name: str, category: str, args: Optional[dict]):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+        self.start = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.tracer._add(self.name, self.category, self.start, time.perf_counter_ns() - self.start, self.args)
+
+
+class Tracer:
+    DEFAULT_CAPACITY = 200_000
+
+    def __init__(self):
+        self.enabled = False
+        self._events: deque[TraceEvent] = deque(maxlen=Tracer.DEFAULT_CAPACITY)
+        #reentrant so a dump from a signal handler can't deadlock with an _add on the same thread
+        self._lock = threading.RLock()
+        self._origin_ns = time.perf_counter_ns()
+
+    def enable(self, capacity: int = DEFAULT_CAPACITY) -> None:
+        with self._lock:
+            if capacity != self._events.maxlen:
+                self._events = deque(self._events, maxlen=capacity)
+            self.enabled = True
+
+    def disable(self) -> None:
+        self.enabled = False
+
+    def clear(self) -> None:
+        with self._lock:
+            self._events.clear()
+
+    def span(self, name: str, category: str, args: Optional[dict] = None):
+        '''
+        Context manager that records the time spent in it. Keep args cheap to create or check
+        tracer.enabled first as they are created even if tracing is off.
+        '''
+        if not self.enabled:
+            return _NO_SPAN
+        return _Span(self, name, category, args)
+
+    def instant(self, name: str, category: str, args: Optional[dict] = None) -> None:
+        if self.enabled:
+            self._add(name, category, time.perf_counter_ns(), None, args)
+
+    def traced(self, category: str, name: Optional[str] = None):
+        '''
+        Decorator that records each call of a function or coroutine function as span.
+        '''
+        def decorate(function: Callable):
+            span_name = name or function.__qualname__
+            if inspect.iscoroutinefunction(function):
+                @functools.wraps(function)
+                async def async_wrapper(*args, **kwargs):
+                    if not self.enabled:
+                        return await function(*args, **kwargs)
+                    with _Span(self, span_name, category, None):
+                        return await function(*args, **kwargs)
+                return async_wrapper
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                with _Span(self, span_name, category, None):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorate
+
+    def _add(self, name: str, category: str, start_ns: int, duration_ns: Optional[int], args: Optional[dict]) -> None:
+        key = self._track_key()
+        with self._lock:
+            self._events.append((name, category, start_ns, duration_ns, key, args))
+
+    def _track_key(self) -> TrackKey:
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            #no event loop in this thread e.g. the recorder's encoder thread
+            task = None
+        if task is not None:
+            return ("task", id(task), f"task {task.get_name()}")
+        return ("thread", threading.get_ident(), threading.current_thread().name)
+
+    def _snapshot(self) -> List[TraceEvent]:
+        with self._lock:
+            return list(self._events)
+
+    def to_chrome_trace(self) -> dict:
+        return self._build_chrome_trace(self._snapshot())
+
+    def _build_chrome_trace(self, events: List[TraceEvent]) -> dict:
+        pid = os.getpid()
+        tids: Dict[TrackKey, int] = {}
+        trace_events: List[Dict[str, Any]] = []
+        for name, category, start_ns, duration_ns, key, args in events:
+            tid = tids.get(key)
+            if tid is None:
+                #small ids in order of appearance. Chrome sorts the tracks by them
+                tid = len(tids) + 1
+                tids[key] = tid
+                trace_events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid,
+                                     "args": {"name": key[2]}})
+            event: Dict[str, Any] = {"name": name, "cat": category, "pid": pid, "tid": tid,
+                                     "ts": (start_ns - self._origin_ns) / 1000}
+            if duration_ns is None:
+                event["ph"] = "i"
+                event["s"] = "t"
+            else:
+                event["ph"] = "X"
+                event["dur"] = duration_ns / 1000
+            if args:
+                event["args"] = args
+            trace_events.append(event)
+        return {"traceEvents": trace_events, "displayTimeUnit": "ms"}
+
+    def dump(self, path: str) -> int:
+        '''
+        Writes the recorded spans as Chrome trace JSON. Returns the number of events written.
+        '''
+        trace = self.to_chrome_trace()
+        self._write(trace, path)
+        return len(trace["traceEvents"])
+
+    def install_signal_dump(self, folder: str = ".", sig: Optional[int] = None) -> None:
+        '''
+        Writes folder/trace_<time>.json each time the signal is received (default SIGUSR1).
+        Not available on Windows.
+        '''
+        if sig is None:
+            sig = getattr(signal, "SIGUSR1", None)
+            if sig is None:
+                logger.warning("SIGUSR1 isn't available on this platform. Trace dumps on signal are disabled")
+                return
+
+        def _signal_handler(signum, frame):
+            #only the ring buffer is copied here. Building and writing the JSON of large traces
+            #takes a while and is done on a thread so the event loop isn't blocked
+            events = self._snapshot()
+            path = os.path.join(folder, time.strftime("trace_%Y%m%d_%H%M%S.json"))
+            threading.Thread(target=self._write_on_signal, args=(events, path), name="TraceDump", daemon=True).start()
+        signal.signal(sig, _signal_handler)
+
+    def _write(self, trace: dict, path: str) -> None:
+        with open(path, "w") as f:
+            json.dump(trace, f)
+        logger.info(f"Wrote {len(trace['traceEvents'])} trace events to {path}")
+
+    def _write_on_signal(self, events: List[TraceEvent], path: str) -> None:
+        try:
+            self._write(self._build_chrome_trace(events), path)
+        except OSError as e:
+            logger.error(f"Writing trace {path} failed: {e}")
+
+
+#shared by all instrumented modules
+tracer = Tracer()
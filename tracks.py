@@ -1,7 +1,17 @@
 import asyncio
+from collections import deque
 import colorsys
-from dataclasses import dataclass
+from dataclasses import dataclass, field, replace
+from enum import Enum
 import fractions
+import os
+import threading
+import traceback
+from typing import Callable
+from pacing import Pacer
+from recorder_sinks import RecorderSink
+from tracing import tracer
+from ring_buffer import JitterBuffer, JitterBufferStats
 from aiortc.contrib.media import MediaRecorderContext
 import cv2
 import numpy as np
@@ -10,39 +20,66 @@ import av
 from av import VideoFrame
 from aiortc import VideoStreamTrack
 from aiortc.mediastreams import VIDEO_TIME_BASE, AudioStreamTrack, MediaStreamError, MediaStreamTrack
-from av import AudioFrame
+from av import AudioFrame, AudioLayout
+from av.frame import Frame
+from av.video.frame import PictureType
 import logging
 logger = logging.getLogger(__name__)
 
 #Note these tracks are just used for quick testing via claude. They might be buggy
 
+def rgb_to_yuv(rgb) -> tuple[int, int, int]:
+    """
+    Converts an rgb color (0-255) to yuv using BT.601 limited range. Same as ffmpeg's default conversion
+    """
+    r, g, b = rgb
+    y = 16 + 0.257 * r + 0.504 * g + 0.098 * b
+    u = 128 - 0.148 * r - 0.291 * g + 0.439 * b
+    v = 128 + 0.439 * r - 0.368 * g - 0.071 * b
+    return round(y), round(u), round(v)
+
+def yuv_planes(frame: VideoFrame) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Writable numpy views of the y, u and v planes of a yuv420p frame. No data is copied.
+    """
+    views = []
+    for plane in frame.planes:
+        #rows can be padded. line_size is the actual row length in memory
+        view = np.frombuffer(memoryview(plane), dtype=np.uint8).reshape(-1, plane.line_size)
+        views.append(view[:plane.height, :plane.width])
+    return views[0], views[1], views[2]
+
+
 class BaseVideoStreamTrack(VideoStreamTrack):
+    """
+    Base class of the synthetic video tracks.
+
+    Every recv returns a new VideoFrame as consumers like a recorder's queue or several peers
+    sharing the track can keep frames for a while. Subclasses avoid the costly part by drawing
+    into reused numpy planes (see TestVideoStreamTrack) or via get_cached_planes (periodic content
+    created once) and copy them into the new frame with new_frame.
+    """
     def __init__(self, fps=30):
         super().__init__()
         self.fps = fps
         self.frame_time = 1 / self.fps
         self.time_base = fractions.Fraction(1, 90000)  # Use 90kHz timebase
-        self.start_time = time.time()
-        self.last_frame_time = self.start_time
+        #shared timer for all tracks with the same fps. pts are calculated from the frame count
+        self.pacer = Pacer(fractions.Fraction(1, fps), skip_missed=True)
         self.counter = 0
+        self._plane_cache: dict = {}
 
     async def recv(self):
-        current_time = time.time()
-        elapsed = current_time - self.last_frame_time
-        
-        if elapsed < self.frame_time:
-            await asyncio.sleep(self.frame_time - elapsed)
-            current_time = time.time()
-        
-        pts = int((current_time - self.start_time) * 90000)
+        await self.pacer.next_frame()
+        pts = self.pacer.pts(90000)
 
-        frame = await self.create_frame(pts)
+        with tracer.span("create_frame", "media"):
+            frame = await self.create_frame(pts)
         frame.pts = pts
         frame.time_base = self.time_base
 
-        #print(f"Frame {self.counter}: Time since last frame: {current_time - self.last_frame_time:.6f}, PTS: {pts}")
+        #print(f"Frame {self.counter}: lag {self.pacer.stats.last_lag_ns / 1_000_000:.3f}ms, PTS: {pts}")
         
-        self.last_frame_time = current_time
         self.counter += 1
         return frame
 
@@ -52,22 +89,53 @@ class BaseVideoStreamTrack(VideoStreamTrack):
         """
         raise NotImplementedError("Subclasses must implement create_frame method")
 
+    @staticmethod
+    def new_frame(planes: tuple[np.ndarray, np.ndarray, np.ndarray]) -> VideoFrame:
+        """
+        Returns a new yuv420p frame with a copy of the y, u and v planes.
+        """
+        height, width = planes[0].shape
+        frame = VideoFrame(width, height, "yuv420p")
+        for dst, src in zip(yuv_planes(frame), planes):
+            dst[:] = src
+        return frame
+
+    def get_cached_planes(self, key, create: Callable[[], tuple[np.ndarray, np.ndarray, np.ndarray]]) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Returns the y, u and v planes cached for key. Calls create once if there are none yet.
+        The planes are shared and must not be changed.
+        """
+        planes = self._plane_cache.get(key)
+        if planes is None:
+            planes = create()
+            self._plane_cache[key] = planes
+        return planes
+
 
 class ColorVideoStreamTrack(BaseVideoStreamTrack):
+    #frames per hue cycle. Each of them is only created once
+    CYCLE = 90
+
     def __init__(self, fps=30):
         super().__init__(fps)
 
     async def create_frame(self, pts):
-        img = np.zeros((240, 320, 3), dtype=np.uint8)
-        h = (self.counter % 90) / 90.0  # Cycle hue every 3 seconds (90 frames at 30fps)
-        r, g, b = colorsys.hsv_to_rgb(h, 1.0, 1.0)
-        img[:, :, 0] = int(r * 255)
-        img[:, :, 1] = int(g * 255)
-        img[:, :, 2] = int(b * 255)
+        index = self.counter % ColorVideoStreamTrack.CYCLE
+        return self.new_frame(self.get_cached_planes(index, lambda: self._create_color_planes(index)))
 
-        return VideoFrame.from_ndarray(img, format="rgb24")
+    def _create_color_planes(self, index: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        h = index / ColorVideoStreamTrack.CYCLE  # Cycle hue every 3 seconds (90 frames at 30fps)
+        r, g, b = colorsys.hsv_to_rgb(h, 1.0, 1.0)
+        y, u, v = rgb_to_yuv((r * 255, g * 255, b * 255))
+        return (np.full((240, 320), y, dtype=np.uint8), np.full((120, 160), u, dtype=np.uint8),
+                np.full((120, 160), v, dtype=np.uint8))
     
 class TestVideoStreamTrack(BaseVideoStreamTrack):
+    BLACK = rgb_to_yuv((0, 0, 0))
+    RED = rgb_to_yuv((255, 0, 0))
+    GREEN = rgb_to_yuv((0, 255, 0))
+    BLUE = rgb_to_yuv((0, 0, 255))
+
     def __init__(self, fps=30, width=640, height=480):
         super().__init__(fps)
         self.width = width
@@ -78,9 +146,19 @@ class TestVideoStreamTrack(BaseVideoStreamTrack):
         self.red_pos = [0, 0]  # Moves diagonally
         self.green_pos = [0, height // 2]  # Moves horizontally
         self.blue_pos = [width // 2, 0]  # Moves vertically
+        #yuv420p planes the boxes are drawn into. Reused for every frame and copied into a new one
+        self._planes = (np.full((height, width), TestVideoStreamTrack.BLACK[0], dtype=np.uint8),
+                        np.full(((height + 1) // 2, (width + 1) // 2), TestVideoStreamTrack.BLACK[1], dtype=np.uint8),
+                        np.full(((height + 1) // 2, (width + 1) // 2), TestVideoStreamTrack.BLACK[2], dtype=np.uint8))
+        #positions of the boxes drawn last time
+        self._drawn: list[tuple[int, int]] = []
 
     async def create_frame(self, pts):
-        img = np.zeros((self.height, self.width, 3), dtype=np.uint8)
+        #the boxes are drawn directly in yuv420p. Only the boxes of the last frame are
+        #cleared instead of the whole frame
+        planes = self._planes
+        for pos in self._drawn:
+            self.draw_box(planes, pos, TestVideoStreamTrack.BLACK)
         
         # Update positions
         self.red_pos[0] = (self.red_pos[0] + 2) % self.width
@@ -91,48 +169,197 @@ class TestVideoStreamTrack(BaseVideoStreamTrack):
         self.blue_pos[1] = (self.blue_pos[1] + 3) % self.height
         
         # Draw boxes
-        self.draw_box(img, self.red_pos, [255, 0, 0])  # Red box
-        self.draw_box(img, self.green_pos, [0, 255, 0])  # Green box
-        self.draw_box(img, self.blue_pos, [0, 0, 255])  # Blue box
-        
-        
-        # Add frame counter as text
-        #self.draw_text(img, f"Frame: {self.counter}")
+        self.draw_box(planes, self.red_pos, TestVideoStreamTrack.RED)  # Red box
+        self.draw_box(planes, self.green_pos, TestVideoStreamTrack.GREEN)  # Green box
+        self.draw_box(planes, self.blue_pos, TestVideoStreamTrack.BLUE)  # Blue box
+        self._drawn = [(self.red_pos[0], self.red_pos[1]), (self.green_pos[0], self.green_pos[1]),
+                       (self.blue_pos[0], self.blue_pos[1])]
         
-        
-        return VideoFrame.from_ndarray(img, format="rgb24")
+        return self.new_frame(planes)
 
-    def draw_box(self, img, pos, color):
+    def draw_box(self, planes, pos, color):
         x, y = pos
-        img[y:y+self.box_size, x:x+self.box_size] = color
+        size = self.box_size
+        y_plane, u_plane, v_plane = planes
+        y_plane[y:y+size, x:x+size] = color[0]
+        #chroma planes have half the resolution
+        u_plane[y//2:(y+size+1)//2, x//2:(x+size+1)//2] = color[1]
+        v_plane[y//2:(y+size+1)//2, x//2:(x+size+1)//2] = color[2]
 
     def draw_text(self, img, text):
         font = cv2.FONT_HERSHEY_SIMPLEX
         cv2.putText(img, text, (10, 30), font, 1, (255, 255, 255), 2, cv2.LINE_AA)
 
+@dataclass
+class PushTrackStats:
+    #frames passed to push
+    pushed: int = 0
+    #frames returned by recv
+    sent: int = 0
+    #frames replaced by a newer one before they were sent
+    dropped: int = 0
+    #frames that had to be copied because the array couldn't be wrapped
+    copied: int = 0
+
+
+class PushVideoStreamTrack(VideoStreamTrack):
+    """
+    Video track fed by an external producer e.g. a render or capture loop on another thread.
+
+    push can be called from any thread. Only the newest frame is kept: a frame that wasn't sent yet
+    is replaced and counted as dropped. This way a slow consumer never causes a backlog and latency.
+
+    Arrays in a format supported by VideoFrame.from_numpy_buffer (C-contiguous rgb24, bgr24, gray,
+    yuv420p, nv12) are wrapped without a copy. The caller must not write into a pushed array afterwards.
+    """
+
+    def __init__(self, format: str = "bgr24"):
+        super().__init__()
+        self.format = format
+        self.stats = PushTrackStats()
+        self._lock = threading.Lock()
+        self._frame: VideoFrame | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._event: asyncio.Event | None = None
+        self._start_ns: int | None = None
+        self._last_pts = -1
+
+    def push(self, image: np.ndarray | VideoFrame, format: str | None = None) -> None:
+        """
+        Queues a frame replacing any frame that wasn't sent yet. Thread-safe.
+        """
+        now = time.monotonic_ns()
+        if isinstance(image, VideoFrame):
+            frame = image
+        else:
+            frame = self._wrap(image, format if format is not None else self.format)
+        with self._lock:
+            if self._start_ns is None:
+                self._start_ns = now
+            #capture time of the frame. The time spent waiting for recv doesn't change it
+            frame.pts = (now - self._start_ns) * 90000 // 1_000_000_000
+            frame.time_base = VIDEO_TIME_BASE
+            if self._frame is not None:
+                self.stats.dropped += 1
+            self._frame = frame
+            self.stats.pushed += 1
+            loop = self._loop
+            event = self._event
+        if loop is not None and event is not None:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                #loop closed. recv won't be called again
+                pass
+
+    def _wrap(self, image: np.ndarray, format: str) -> VideoFrame:
+        try:
+            return VideoFrame.from_numpy_buffer(image, format=format)
+        except ValueError:
+            #not contiguous or a format that can't be wrapped
+            with self._lock:
+                self.stats.copied += 1
+            return VideoFrame.from_ndarray(image, format=format)
+
+    async def recv(self) -> Frame:
+        if self.readyState != "live":
+            raise MediaStreamError
+        if self._event is None:
+            with self._lock:
+                self._loop = asyncio.get_running_loop()
+                self._event = asyncio.Event()
+        while True:
+            with self._lock:
+                frame = self._frame
+                self._frame = None
+                if frame is None:
+                    self._event.clear()
+            if frame is not None:
+                break
+            await self._event.wait()
+            if self.readyState != "live":
+                raise MediaStreamError
+        #pts must increase even if two frames were pushed within the same 90kHz tick
+        if frame.pts <= self._last_pts:
+            frame.pts = self._last_pts + 1
+        self._last_pts = frame.pts
+        self.stats.sent += 1
+        return frame
+
+    def stop(self) -> None:
+        super().stop()
+        #wake up a waiting recv so it can raise MediaStreamError
+        if self._event is not None:
+            self._event.set()
+
+
 AUDIO_PTIME = 0.02
 
 
+def new_audio_frame(samples: int, sample_rate: int, layout: str = "mono") -> tuple[AudioFrame, np.ndarray]:
+    """
+    Returns a new s16 AudioFrame together with a writable numpy view of its samples. The samples are
+    written straight into the frame. A new frame is used each time as consumers may keep the frames.
+    """
+    frame = AudioFrame(format="s16", layout=layout, samples=samples)
+    frame.sample_rate = sample_rate
+    frame.time_base = fractions.Fraction(1, sample_rate)
+    #the plane can be larger than needed due to alignment. s16 is interleaved so all channels are in one plane
+    view = np.frombuffer(memoryview(frame.planes[0]), dtype=np.int16)[:samples * len(frame.layout.channels)]
+    return frame, view
+
+
+def copy_from_table(table: np.ndarray, position: int, out: np.ndarray) -> int:
+    """
+    Copies len(out) samples from a looping table starting at position. Returns the next position.
+    """
+    count = len(out)
+    first = min(count, len(table) - position)
+    out[:first] = table[position:position + first]
+    if first < count:
+        #wrapped around. The tables are at least one frame long so one more copy is enough
+        out[first:] = table[:count - first]
+    return (position + count) % len(table)
+
 
 class BeepTrack(AudioStreamTrack):
-    def __init__(self, frequency=440, sample_rate=48000, beep_duration=0.1, interval=1.0):
+    """
+    Plays a beep every interval seconds.
+
+    If chirp is set the beep is a sweep from frequency to 4 * frequency instead. A sweep can be found reliably
+    in the received audio via correlation (see latency_probe.AudioLatencyAnalyzer). The monotonic time at
+    which each beep starts is then kept in marker_times.
+    """
+    def __init__(self, frequency=440, sample_rate=48000, beep_duration=0.1, interval=1.0, chirp=False):
         super().__init__()
         self.frequency = frequency
+        self.chirp = chirp
+        #start time of the last beeps. Only recorded in chirp mode
+        self.marker_times: deque[float] = deque(maxlen=64)
         self.sample_rate = sample_rate
         self.samples_per_frame = int(self.sample_rate * AUDIO_PTIME)
         self.beep_duration = beep_duration
         self.interval = interval
         self.beep_samples = int(self.beep_duration * self.sample_rate)
-        self.interval_samples = int(self.interval * self.sample_rate)
+        self.interval_samples = max(int(self.interval * self.sample_rate), self.samples_per_frame)
+        #audio doesn't skip frames. If it falls behind the missed frames are returned right away
+        self.pacer = Pacer(fractions.Fraction(self.samples_per_frame, self.sample_rate))
         
-        # Pre-generate the beep
-        self.beep = self._generate_beep()
+        # Pre-generate one full interval: the beep followed by silence
+        self.table = self._generate_table()
+        #table used after change_frequency once the current beep ended
+        self._next_table: np.ndarray | None = None
         
         self.sample_index = 0
 
     def _generate_beep(self):
         t = np.linspace(0, self.beep_duration, self.beep_samples, False)
-        beep = np.sin(2 * np.pi * self.frequency * t)
+        if self.chirp:
+            #linear sweep. The phase is the integral of the frequency
+            sweep_rate = 3 * self.frequency / self.beep_duration
+            beep = np.sin(2 * np.pi * (self.frequency * t + sweep_rate / 2 * t * t))
+        else:
+            beep = np.sin(2 * np.pi * self.frequency * t)
         
         # Apply envelope
         envelope = np.ones_like(beep)
@@ -144,36 +371,32 @@ class BeepTrack(AudioStreamTrack):
         
         return beep
 
+    def _generate_table(self) -> np.ndarray:
+        table = np.zeros(self.interval_samples, dtype=np.int16)
+        beep = self._generate_beep()[:self.interval_samples]
+        # Convert to 16-bit PCM
+        table[:len(beep)] = (beep * 32767).astype(np.int16)
+        return table
+
     async def recv(self):
-        if not hasattr(self, "_timestamp"):
-            self._start = time.time()
-            self._timestamp = 0
-        else:
-            self._timestamp += self.samples_per_frame
-            wait = self._start + (self._timestamp / self.sample_rate) - time.time()
-            await asyncio.sleep(max(0, wait))
+        await self.pacer.next_frame()
 
-        # Generate audio
-        start_sample = self.sample_index % self.interval_samples
-        end_sample = start_sample + self.samples_per_frame
-        
-        if start_sample < self.beep_samples:
-            # We're in a beep
-            beep_portion = self.beep[start_sample:min(end_sample, self.beep_samples)]
-            audio = np.zeros(self.samples_per_frame)
-            audio[:len(beep_portion)] = beep_portion
-        else:
-            # We're in silence
-            audio = np.zeros(self.samples_per_frame)
+        position = self.sample_index % self.interval_samples
+        if self._next_table is not None and position >= self.beep_samples:
+            #switch during silence so the beep that is playing isn't cut
+            self.table = self._next_table
+            self._next_table = None
 
-        # Convert to 16-bit PCM
-        audio = (audio * 32767).astype(np.int16)
+        with tracer.span("create_audio_frame", "media"):
+            frame, samples = new_audio_frame(self.samples_per_frame, self.sample_rate)
+            copy_from_table(self.table, position, samples)
+        frame.pts = self.pacer.pts(self.sample_rate)
 
-        frame = AudioFrame(format="s16", layout="mono", samples=self.samples_per_frame)
-        frame.planes[0].update(audio.tobytes())
-        frame.pts = self._timestamp
-        frame.sample_rate = self.sample_rate
-        frame.time_base = fractions.Fraction(1, self.sample_rate)
+        if self.chirp:
+            #the beep starts at the beginning of the table
+            offset = 0 if position == 0 else self.interval_samples - position
+            if offset < self.samples_per_frame:
+                self.marker_times.append(time.monotonic() + offset / self.sample_rate)
 
         self.sample_index += self.samples_per_frame
 
@@ -182,38 +405,50 @@ class BeepTrack(AudioStreamTrack):
     def change_frequency(self, new_frequency):
         """Allow dynamic change of frequency for testing"""
         self.frequency = new_frequency
-        self.beep = self._generate_beep()  # Regenerate the beep with the new frequency
+        self._next_table = self._generate_table()  # Regenerate the beep with the new frequency
         logger.info(f"Changed frequency to {new_frequency} Hz")
 
 class SineWaveTrack(AudioStreamTrack):
+    #longest table used. Frequencies that don't fit are rounded to full Hz
+    MAX_TABLE_SECONDS = 2
+
     def __init__(self, frequency=800, sample_rate=48000):
         super().__init__()
         self.frequency = frequency
         self.sample_rate = sample_rate
         self.samples_per_frame = int(self.sample_rate * AUDIO_PTIME)
+        self.pacer = Pacer(fractions.Fraction(self.samples_per_frame, self.sample_rate))
         self.sample_index = 0
+        self._position = 0
+        self.table = self._generate_table(frequency, 0.0)
 
-    async def recv(self):
-        if not hasattr(self, "_timestamp"):
-            self._start = time.time()
-            self._timestamp = 0
-        else:
-            self._timestamp += self.samples_per_frame
-            wait = self._start + (self._timestamp / self.sample_rate) - time.time()
-            await asyncio.sleep(wait)
-
-        # Generate sine wave
-        t = np.arange(self.sample_index, self.sample_index + self.samples_per_frame) / self.sample_rate
-        audio = np.sin(2 * np.pi * self.frequency * t)
-
+    def _generate_table(self, frequency, phase: float) -> np.ndarray:
+        """
+        Table of an integer number of sine cycles starting at the given phase.
+        """
+        freq = fractions.Fraction(frequency).limit_denominator(100)
+        #smallest length that contains a whole number of cycles: length * freq / sample_rate is an integer
+        length = freq.denominator * self.sample_rate // np.gcd(freq.numerator, freq.denominator * self.sample_rate)
+        if length > self.sample_rate * SineWaveTrack.MAX_TABLE_SECONDS:
+            freq = fractions.Fraction(round(frequency))
+            length = self.sample_rate // np.gcd(freq.numerator, self.sample_rate)
+        #repeat to at least one frame so a frame never wraps around more than once
+        length *= -(-self.samples_per_frame // length)
+        #frequency and start phase actually used by the table
+        self._table_frequency = float(freq)
+        self._table_phase = phase
+        t = np.arange(length) / self.sample_rate
+        audio = np.sin(2 * np.pi * self._table_frequency * t + phase)
         # Convert to 16-bit PCM
-        audio = (audio * 32767).astype(np.int16)
+        return (audio * 32767).astype(np.int16)
+
+    async def recv(self):
+        await self.pacer.next_frame()
 
-        frame = AudioFrame(format="s16", layout="mono", samples=self.samples_per_frame)
-        frame.planes[0].update(audio.tobytes())
-        frame.pts = self._timestamp
-        frame.sample_rate = self.sample_rate
-        frame.time_base = fractions.Fraction(1, self.sample_rate)
+        with tracer.span("create_audio_frame", "media"):
+            frame, samples = new_audio_frame(self.samples_per_frame, self.sample_rate)
+            self._position = copy_from_table(self.table, self._position, samples)
+        frame.pts = self.pacer.pts(self.sample_rate)
 
         self.sample_index += self.samples_per_frame
 
@@ -221,9 +456,105 @@ class SineWaveTrack(AudioStreamTrack):
 
     def change_frequency(self, new_frequency):
         """Allow dynamic change of frequency for testing"""
+        #the new table starts with the phase the old one reached so the wave stays continuous
+        phase = self._table_phase + 2 * np.pi * self._table_frequency * self._position / self.sample_rate
+        phase %= 2 * np.pi
         self.frequency = new_frequency
+        self.table = self._generate_table(new_frequency, phase)
+        self._position = 0
         logger.info(f"Changed frequency to {new_frequency} Hz")
 
+
+class PushAudioStreamTrack(AudioStreamTrack):
+    """
+    Audio track fed by an external producer e.g. a TTS engine or the audio thread of a game.
+
+    push accepts any chunk size, sample rate and layout from any thread. Audio that doesn't match
+    the track's format is converted once by an av.AudioResampler. One resampler is kept for each
+    input format. The samples are kept in a JitterBuffer and recv takes 20ms frames out of it paced by
+    the shared clock. recv never waits for the producer: if there isn't enough audio it returns silence.
+
+    target_latency is the audio buffered before playback starts (and restarts after an underrun).
+    It absorbs the jitter of the producer. If more than max_latency is buffered (e.g. the producer
+    runs faster than real time) the oldest audio is dropped down to target_latency.
+    """
+
+    def __init__(self, sample_rate: int = 48000, layout: str = "mono", target_latency: float = 0.06,
+                 max_latency: float = 0.5, buffer_duration: float = 2.0):
+        super().__init__()
+        self.sample_rate = sample_rate
+        self.layout = layout
+        self.samples_per_frame = int(self.sample_rate * AUDIO_PTIME)
+        self.channels = len(AudioLayout(layout).channels)
+        self.jitter = JitterBuffer(int(buffer_duration * sample_rate), self.channels,
+                                   int(target_latency * sample_rate), int(max_latency * sample_rate))
+        self.pacer = Pacer(fractions.Fraction(self.samples_per_frame, self.sample_rate))
+        #(format, layout, sample rate) of the input -> resampler
+        self._resamplers: dict[tuple[str, str, int], av.AudioResampler] = {}
+        #producers only synchronize among themselves. recv never takes this lock
+        self._push_lock = threading.Lock()
+
+    @property
+    def stats(self) -> JitterBufferStats:
+        return self.jitter.stats
+
+    @property
+    def buffered(self) -> float:
+        """
+        Seconds of audio waiting to be sent.
+        """
+        return self.jitter.available / self.sample_rate
+
+    def push(self, data: np.ndarray | AudioFrame, sample_rate: int | None = None, layout: str = "mono") -> None:
+        """
+        Adds audio. Thread-safe.
+        data is either an AudioFrame or an int16 / float32 array of shape (samples,) or (samples, channels)
+        with interleaved channels. sample_rate and layout describe the array and default to the track's rate and mono.
+        """
+        with self._push_lock:
+            if isinstance(data, AudioFrame):
+                self._write_frame(data)
+                return
+            rate = sample_rate if sample_rate is not None else self.sample_rate
+            if rate == self.sample_rate and layout == self.layout and data.dtype == np.int16:
+                #already in the track's format. Copied straight into the ring
+                self.jitter.write(data)
+                return
+            if data.dtype == np.int16:
+                frame = AudioFrame.from_ndarray(np.ascontiguousarray(data).reshape(1, -1), format="s16", layout=layout)
+            else:
+                frame = AudioFrame.from_ndarray(np.ascontiguousarray(data, dtype=np.float32).reshape(1, -1), format="flt", layout=layout)
+            frame.sample_rate = rate
+            self._write_frame(frame)
+
+    def _write_frame(self, frame: AudioFrame) -> None:
+        key = (frame.format.name, frame.layout.name, frame.sample_rate)
+        if key == ("s16", self.layout, self.sample_rate):
+            self.jitter.write(frame.to_ndarray())
+            return
+        resampler = self._resamplers.get(key)
+        if resampler is None:
+            resampler = av.AudioResampler(format="s16", layout=self.layout, rate=self.sample_rate)
+            self._resamplers[key] = resampler
+        #the resampler keeps its own timestamps. The track's pts come from the pacer. Pushed frames
+        #with a pts are copied as the caller may still use them e.g. to record the received audio
+        if frame.pts is not None:
+            copy = AudioFrame.from_ndarray(frame.to_ndarray(), format=frame.format.name, layout=frame.layout.name)
+            copy.sample_rate = frame.sample_rate
+            frame = copy
+        for resampled in resampler.resample(frame):
+            self.jitter.write(resampled.to_ndarray())
+
+    async def recv(self) -> Frame:
+        if self.readyState != "live":
+            raise MediaStreamError
+        await self.pacer.next_frame()
+
+        frame, samples = new_audio_frame(self.samples_per_frame, self.sample_rate, self.layout)
+        self.jitter.read(samples)
+        frame.pts = self.pacer.pts(self.sample_rate)
+        return frame
+
 class MediaSourceNotFoundException(Exception):
     """Exception raised when a media source is not found."""
     
@@ -241,6 +572,124 @@ class CustomMediaRecorderContext:
         self.started = False
         self.stream = stream
         self.task : asyncio.Task[None] | None= None
+        #only used when recording segments
+        self.first_pts : int | None = None
+        self.next_keyframe_time = 0.0
+
+class DropPolicy(Enum):
+    #drop the oldest queued frame
+    DROP_OLDEST = 0
+    #drop the oldest queued video frame that isn't a keyframe (e.g. forced at a segment boundary).
+    #Audio gaps are more noticeable than a lower frame rate. Falls back to DROP_OLDEST if there is none
+    DROP_VIDEO_FIRST = 1
+
+#file extension -> segment_format
+SEGMENT_FORMATS = {
+    ".mp4": "mp4",
+    ".webm": "webm",
+    ".ts": "mpegts",
+}
+
+@dataclass
+class SegmentConfig:
+    #target length of a segment in seconds. Keyframes are forced at this interval
+    #so the segments are cut close to it
+    duration: float = 6.0
+    #"mp4" (fragmented), "webm" or "mpegts". Each segment can be played on its own
+    segment_format: str = "mp4"
+    #optional path of a HLS playlist (m3u8) that is updated after each segment
+    playlist: str | None = None
+    #number of segments kept in the playlist. 0 keeps all
+    playlist_size: int = 0
+
+    def get_options(self) -> dict[str, str]:
+        options = {
+            "segment_time": str(self.duration),
+            #recommended by ffmpeg if keyframes are forced at the segment time
+            "segment_time_delta": "0.05",
+            "segment_format": self.segment_format,
+        }
+        if self.segment_format == "mp4":
+            #fragmented mp4 is readable while it is written and doesn't need a moov atom at the end
+            options["segment_format_options"] = "movflags=+frag_keyframe+empty_moov+default_base_moof"
+        if self.playlist is not None:
+            options["segment_list"] = self.playlist
+            options["segment_list_type"] = "m3u8"
+            options["segment_list_size"] = str(self.playlist_size)
+        return options
+
+#libx264 presets from slowest to fastest
+X264_PRESETS = ["veryslow", "slower", "slow", "medium", "fast", "faster", "veryfast", "superfast", "ultrafast"]
+#highest cpu-used value supported by libvpx for vp8
+VPX_MAX_CPU_USED = 16
+
+@dataclass
+class EncoderProfile:
+    #libx264 preset e.g. "veryfast". Defaults to medium
+    preset: str | None = None
+    #libvpx (vp8 / vp9) speed. Higher is faster
+    cpu_used: int | None = None
+    #libx264 tune e.g. "zerolatency"
+    tune: str | None = None
+    #keyframe interval in frames
+    gop: int | None = None
+    #encoder threads. 0 lets the encoder decide
+    threads: int | None = None
+    #constant quality mode. libx264 then ignores video_bit_rate. libvpx uses it as upper limit
+    crf: int | None = None
+    #lowers the preset / raises cpu_used if the encoder thread can't keep up with real time
+    adaptive: bool = False
+    #fraction of wall time the encoder thread may be busy before the adaptive mode steps down
+    max_load: float = 0.8
+    #additional codec options. These override the values above
+    options: dict[str, str] = field(default_factory=dict)
+
+    def get_options(self, codec_name: str) -> dict[str, str]:
+        options: dict[str, str] = {}
+        if codec_name == "libx264":
+            if self.preset is not None:
+                options["preset"] = self.preset
+            if self.tune is not None:
+                options["tune"] = self.tune
+            if self.crf is not None:
+                options["crf"] = str(self.crf)
+            if self.adaptive:
+                #the adaptive mode reopens the encoder. Repeating SPS / PPS at every keyframe
+                #lets decoders pick up the new settings
+                options["x264-params"] = "repeat-headers=1"
+        elif codec_name.startswith("libvpx"):
+            if self.cpu_used is not None:
+                options["cpu-used"] = str(self.cpu_used)
+            if self.crf is not None:
+                options["crf"] = str(self.crf)
+        options.update(self.options)
+        return options
+
+    def step_down(self, codec_name: str) -> bool:
+        """
+        Switches to a faster setting. Returns False if there is none.
+        """
+        if codec_name == "libx264":
+            index = X264_PRESETS.index(self.preset if self.preset is not None else "medium")
+            if index + 1 >= len(X264_PRESETS):
+                return False
+            self.preset = X264_PRESETS[index + 1]
+            return True
+        if codec_name.startswith("libvpx"):
+            cpu_used = self.cpu_used if self.cpu_used is not None else 0
+            if cpu_used >= VPX_MAX_CPU_USED:
+                return False
+            self.cpu_used = min(cpu_used + 4, VPX_MAX_CPU_USED)
+            return True
+        return False
+
+    @staticmethod
+    def realtime() -> "EncoderProfile":
+        """
+        Fast profile for live recording / streaming of many streams.
+        """
+        return EncoderProfile(preset="veryfast", cpu_used=8, tune="zerolatency", gop=60, adaptive=True)
+
 @dataclass
 class RecorderConfig:
     #recording width. If not defaults to the width of the first frame
@@ -257,6 +706,91 @@ class RecorderConfig:
     video_stream_codec:str| None = None
     container_format: str | None = None
     container_options = None
+    #max number of frames waiting for the encoder thread. If full frames are dropped
+    #based on drop_policy instead of blocking the event loop
+    queue_size: int = 30
+    drop_policy: DropPolicy = DropPolicy.DROP_OLDEST
+    #if set the recording is split into segments. The file name must contain
+    #a pattern for the segment number e.g. "out_%05d.mp4"
+    segment: SegmentConfig | None = None
+    #video encoder settings. If not set the encoder defaults are used
+    encoder: EncoderProfile | None = None
+
+@dataclass
+class RecorderStats:
+    queue_depth: int = 0
+    max_queue_depth: int = 0
+    #frames dropped from the queue before encoding
+    dropped_frames: int = 0
+    encoded_frames: int = 0
+    #encoded packets discarded as more than PENDING_PACKET_LIMIT were held back while
+    #waiting for the first frame of the other tracks
+    dropped_packets: int = 0
+    #total time in seconds spent encoding and muxing
+    encode_time: float = 0
+    #encode + mux time of the last frame
+    last_encode_time: float = 0
+    #fraction of wall time the encoder thread was busy during the last measurement window
+    encoder_load: float = 0
+    #number of times the adaptive mode switched to a faster setting
+    encoder_steps: int = 0
+
+    @property
+    def average_encode_time(self) -> float:
+        if self.encoded_frames == 0:
+            return 0
+        return self.encode_time / self.encoded_frames
+
+
+class FrameQueue:
+    """
+    Bounded queue between the asyncio tracks and the encoder thread.
+    put never blocks. If the queue is full a frame is dropped based on the DropPolicy.
+    """
+
+    def __init__(self, max_size: int, policy: DropPolicy, stats: RecorderStats):
+        self._items: deque[tuple[CustomMediaRecorderContext, Frame]] = deque()
+        self._max_size = max_size
+        self._policy = policy
+        self._stats = stats
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def put(self, context: CustomMediaRecorderContext, frame: Frame) -> None:
+        with self._cond:
+            if len(self._items) >= self._max_size:
+                self._drop()
+            self._items.append((context, frame))
+            self._stats.queue_depth = len(self._items)
+            self._stats.max_queue_depth = max(self._stats.max_queue_depth, len(self._items))
+            self._cond.notify()
+
+    def _drop(self):
+        self._stats.dropped_frames += 1
+        if self._policy == DropPolicy.DROP_VIDEO_FIRST:
+            for i, (_, frame) in enumerate(self._items):
+                if isinstance(frame, VideoFrame) and frame.pict_type != PictureType.I:
+                    del self._items[i]
+                    return
+        self._items.popleft()
+
+    def get(self) -> tuple[CustomMediaRecorderContext, Frame] | None:
+        """
+        Blocks until a frame is available. Returns None once closed and empty.
+        """
+        with self._cond:
+            while not self._items and not self._closed:
+                self._cond.wait()
+            if not self._items:
+                return None
+            item = self._items.popleft()
+            self._stats.queue_depth = len(self._items)
+            return item
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
 
 
 class CustomMediaRecorder:
@@ -265,12 +799,57 @@ class CustomMediaRecorder:
     https://github.com/aiortc/aiortc/blob/main/src/aiortc/contrib/media.py
     Added VP8 support (picked when webm is used as suffix)
 
+    Encoding and muxing run on a separate thread so they don't block the event loop.
+    The tracks only receive frames and hand them over via a FrameQueue.
+
+    If config.segment is set the recording is split into segments which are valid
+    on their own. on_segment is called on the event loop with the path of each finished segment.
     """
 
-    def __init__(self, file, config: RecorderConfig = RecorderConfig()):
-        self.__container = av.open(file=file, format=config.container_format, mode="w", options=config.container_options)
+    #max packets kept while waiting for the first frame of every track
+    PENDING_PACKET_LIMIT = 500
+    #seconds packets are held back for tracks that didn't deliver a frame yet. Their streams are
+    #then started without one e.g. for a remote side that negotiated audio but never sends any
+    STREAM_SETUP_TIMEOUT = 2.0
+    #size of a video stream that is started without a frame and without a configured size
+    DEFAULT_WIDTH = 640
+    DEFAULT_HEIGHT = 480
+    #seconds over which the encoder load is measured by the adaptive mode
+    LOAD_WINDOW = 2.0
+
+    def __init__(self, file, config: RecorderConfig = RecorderConfig(),
+                 on_segment: Callable[[str], None] | None = None):
+        self.__segment = config.segment
+        self.__on_segment = on_segment
+        self.__segment_index = 0
+        self.__loop : asyncio.AbstractEventLoop | None = None
+        if config.segment is not None:
+            if not isinstance(file, str) or "%" not in file:
+                raise ValueError(f"Segmented recording needs a file name pattern like out_%05d.mp4 but got {file}")
+            options = config.segment.get_options()
+            if config.container_options:
+                options.update(config.container_options)
+            self.__container = av.open(file=file, format="segment", mode="w", options=options)
+            self.__format_name = config.segment.segment_format
+        else:
+            if isinstance(file, RecorderSink) and config.container_format is None:
+                raise ValueError("Recording to a sink needs RecorderConfig.container_format. See get_streaming_config")
+            self.__container = av.open(file=file, format=config.container_format, mode="w", options=config.container_options)
+            self.__format_name = self.__container.format.name
+        self.__file = file
+        #copy as the adaptive mode changes it
+        self.__encoder_profile = replace(config.encoder) if config.encoder is not None else None
+        self.__load_window_start = 0.0
+        self.__load_window_time = 0.0
+        self.__load_window_dropped = 0
         self.__tracks : dict[MediaStreamTrack, CustomMediaRecorderContext]= {}
         self._config = config
+        self.stats = RecorderStats()
+        self.__queue = FrameQueue(config.queue_size, config.drop_policy, self.stats)
+        self.__worker : threading.Thread | None = None
+        #packets held back until all streams are configured. See __mux
+        self.__pending_packets : deque[av.Packet] | None = deque(maxlen=CustomMediaRecorder.PENDING_PACKET_LIMIT)
+        self.__pending_since : float | None = None
         #used to check the frame timing
         self.VERBOSE = False
         self._last_video_frame = 0
@@ -284,21 +863,21 @@ class CustomMediaRecorder:
         :param track: A :class:`aiortc.MediaStreamTrack`.
         """
         if track.kind == "audio":
-            if self.__container.format.name in ("wav", "alsa", "pulse"):
+            if self.__format_name in ("wav", "alsa", "pulse"):
                 codec_name = "pcm_s16le"
-            elif self.__container.format.name == "mp3":
+            elif self.__format_name == "mp3":
                 codec_name = "mp3"     
-            if self.__container.format.name in ("webm"):
+            if self.__format_name in ("webm"):
                 codec_name = "libopus"
             else:
                 codec_name = "aac"
             stream = self.__container.add_stream(codec_name)
         else:
 
-            if self.__container.format.name == "image2":
+            if self.__format_name == "image2":
                 stream = self.__container.add_stream("png", rate=self._config.rate)
                 stream.pix_fmt = "rgb24"
-            elif self.__container.format.name == "webm":
+            elif self.__format_name == "webm":
                 codec = "vp8" if self._config.video_stream_codec is None else self._config.video_stream_codec
                 stream = self.__container.add_stream(codec)
                 stream.pix_fmt = "yuv420p"
@@ -315,6 +894,10 @@ class CustomMediaRecorder:
         """
         Start recording.
         """
+        self.__loop = asyncio.get_running_loop()
+        if self.__worker is None:
+            self.__worker = threading.Thread(target=self.__run_worker, name="CustomMediaRecorder", daemon=True)
+            self.__worker.start()
         for track, context in self.__tracks.items():
             if context.task is None:
                 context.task = asyncio.ensure_future(self.__run_track(track, context))
@@ -328,13 +911,22 @@ class CustomMediaRecorder:
                 if context.task is not None:
                     context.task.cancel()
                     context.task = None
-                    for packet in context.stream.encode(None):
-                        self.__container.mux(packet)
+            self.__queue.close()
+            if self.__worker is not None:
+                #the worker encodes the remaining frames, flushes the encoders and closes the container
+                await asyncio.get_running_loop().run_in_executor(None, self.__worker.join)
+                self.__worker = None
+            else:
+                self.__close_container()
             self.__tracks = {}
 
-            if self.__container:
-                self.__container.close()
-                self.__container = None
+    def __close_container(self) -> None:
+        if self.__container:
+            self.__container.close()
+            self.__container = None
+            #PyAV doesn't close file objects. Sinks need to know the stream ended
+            if isinstance(self.__file, RecorderSink):
+                self.__file.close()
 
     async def __run_track(
         self, track: MediaStreamTrack, context: CustomMediaRecorderContext ) -> None:
@@ -343,36 +935,199 @@ class CustomMediaRecorder:
                 frame = await track.recv()
             except MediaStreamError:
                 return
+            if self.__segment is not None:
+                #before queueing so the FrameQueue sees the keyframes forced at segment boundaries
+                self.__prepare_segment_frame(context, frame)
+            self.__queue.put(context, frame)
 
-            if not context.started:
-                # set width/height and bitrate if available
-                if isinstance(frame, VideoFrame):
-                    context.stream.width = self._config.width if self._config.width is not None else frame.width
-                    context.stream.height = self._config.height if self._config.height is not None else frame.height
-                    if self._config.video_bit_rate is not None:
-                        context.stream.bit_rate = self._config.video_bit_rate 
-                context.started = True
-            
+    def __run_worker(self) -> None:
+        try:
+            while True:
+                item = self.__queue.get()
+                if item is None:
+                    break
+                context, frame = item
+                start = time.perf_counter()
+                with tracer.span("encode", "recorder"):
+                    self.__encode(context, frame)
+                duration = time.perf_counter() - start
+                self.stats.encoded_frames += 1
+                self.stats.encode_time += duration
+                self.stats.last_encode_time = duration
+                if self.__encoder_profile is not None and self.__encoder_profile.adaptive:
+                    self.__adapt(duration)
+
+            for context in self.__tracks.values():
+                if context.started:
+                    for packet in context.stream.encode(None):
+                        self.__mux(packet)
+            if self.__pending_packets:
+                #a track never delivered a frame. The others are still written
+                self.__write_pending()
+        except Exception as e:
+            logger.error(f"MediaRecorder worker failed: {e}\n{traceback.format_exc()}")
+        finally:
+            self.__close_container()
+            if self.__segment is not None:
+                #the last segment is complete once the container is closed
+                self.__report_segment()
+
+    def __segment_path(self, index: int) -> str:
+        return self.__file % index
+
+    def __report_segment(self) -> None:
+        path = self.__segment_path(self.__segment_index)
+        self.__segment_index += 1
+        if not os.path.exists(path):
+            return
+        logger.info(f"MediaRecorder finished segment {path}")
+        if self.__on_segment is not None and self.__loop is not None:
+            try:
+                self.__loop.call_soon_threadsafe(self.__on_segment, path)
+            except RuntimeError:
+                logger.warning(f"Event loop closed. Could not report segment {path}")
+
+    def __write_packet(self, packet: av.Packet) -> None:
+        with tracer.span("mux", "recorder"):
+            self.__container.mux(packet)
+        if self.__segment is not None and packet.is_keyframe:
+            #the segment muxer only starts a new file at a keyframe. Once the next
+            #file exists the previous one is complete
+            while os.path.exists(self.__segment_path(self.__segment_index + 1)):
+                self.__report_segment()
+
+    def __prepare_segment_frame(self, context: CustomMediaRecorderContext, frame: Frame) -> None:
+        assert self.__segment is not None
+        #the segment muxer cuts based on absolute timestamps but received tracks can start
+        #at any value. Each stream starts at 0 instead
+        if frame.pts is None:
+            #no timestamp to cut at. The encoder assigns one
+            return
+        if context.first_pts is None:
+            context.first_pts = frame.pts
+        pts = frame.pts - context.first_pts
+        frame.pts = pts
+        if isinstance(frame, VideoFrame) and frame.time_base is not None:
+            frame_time = float(pts * frame.time_base)
+            if frame_time >= context.next_keyframe_time:
+                frame.pict_type = PictureType.I
+                while context.next_keyframe_time <= frame_time:
+                    context.next_keyframe_time += self.__segment.duration
+
+    def __apply_encoder_profile(self, stream) -> None:
+        profile = self.__encoder_profile
+        if profile is None:
+            return
+        codec_context = stream.codec_context
+        if profile.gop is not None:
+            codec_context.gop_size = profile.gop
+        if profile.threads is not None:
+            codec_context.thread_count = profile.threads
+        codec_context.options = profile.get_options(codec_context.name)
+
+    def __adapt(self, duration: float) -> None:
+        now = time.perf_counter()
+        if self.__load_window_start == 0:
+            self.__load_window_start = now
+            self.__load_window_dropped = self.stats.dropped_frames
+        self.__load_window_time += duration
+        elapsed = now - self.__load_window_start
+        if elapsed < CustomMediaRecorder.LOAD_WINDOW:
+            return
+        load = self.__load_window_time / elapsed
+        dropped = self.stats.dropped_frames - self.__load_window_dropped
+        self.stats.encoder_load = load
+        self.__load_window_start = 0
+        self.__load_window_time = 0
+        assert self.__encoder_profile is not None
+        if load < self.__encoder_profile.max_load and dropped == 0:
+            return
+        for context in self.__tracks.values():
+            if context.started and context.stream.type == "video":
+                self.__step_down(context, load, dropped)
+
+    def __step_down(self, context: CustomMediaRecorderContext, load: float, dropped: int) -> None:
+        assert self.__encoder_profile is not None
+        codec_context = context.stream.codec_context
+        if not self.__encoder_profile.step_down(codec_context.name):
+            return
+        logger.warning(f"MediaRecorder can't keep up. load {load:.2f} dropped {dropped}. "
+                       + f"Reopening {codec_context.name} with {self.__encoder_profile.get_options(codec_context.name)}")
+        #flush the frames still in the encoder. The next encode call opens it again with the new options
+        for packet in context.stream.encode(None):
+            self.__mux(packet)
+        codec_context.close()
+        codec_context.options = self.__encoder_profile.get_options(codec_context.name)
+        self.stats.encoder_steps += 1
+
+    def __start_stream(self, context: CustomMediaRecorderContext, width: int, height: int) -> None:
+        # set width/height and bitrate if available
+        if context.stream.type == "video":
+            context.stream.width = self._config.width if self._config.width is not None else width
+            context.stream.height = self._config.height if self._config.height is not None else height
+            self.__apply_encoder_profile(context.stream)
+            crf_mode = self.__encoder_profile is not None and self.__encoder_profile.crf is not None
+            if self._config.video_bit_rate is not None and not (crf_mode and context.stream.codec_context.name == "libx264"):
+                context.stream.bit_rate = self._config.video_bit_rate 
+        context.started = True
+
+    def __encode(self, context: CustomMediaRecorderContext, frame: Frame) -> None:
+        if not context.started:
+            if isinstance(frame, VideoFrame):
+                self.__start_stream(context, frame.width, frame.height)
+            else:
+                self.__start_stream(context, 0, 0)
+
+        if isinstance(frame, VideoFrame):
+            diff = frame.pts - self._last_video_frame
+            self._last_video_frame = frame.pts
+            if self.VERBOSE:
+                logger.info(f"MediaRecorder video frame pts {frame.pts} diff {diff}")
+
+        for packet in context.stream.encode(frame):
             if isinstance(frame, VideoFrame):
-                diff = frame.pts - self._last_video_frame
-                self._last_video_frame = frame.pts
                 if self.VERBOSE:
-                    logger.info(f"MediaRecorder video frame pts {frame.pts} diff {diff}")
-
-            for packet in context.stream.encode(frame):
-                if isinstance(frame, VideoFrame):
-                    if self.VERBOSE:
-                        logger.info(f"MediaRecorder video packet dts {packet.dts}")
-                    #for libx264 drop packages that have the same dts. This happens when we receive 
-                    #too many frames / frames with pts too close together
-                    if self._last_video_package > 0 and self._last_video_package == packet.dts and context.stream.name == "libx264":
-                        #fallback to prevent crash of libx264
-                        logger.warning(f"MediaRecorder will drop duplicate package with dts {packet.dts}. " 
-                                       + " This can happen if libx264 receives more frames than the set framerate or the timestamp is too close together")
-                        continue
-                    self._last_video_package = packet.dts
-                    
-                self.__container.mux(packet)
+                    logger.info(f"MediaRecorder video packet dts {packet.dts}")
+                #for libx264 drop packages that have the same dts. This happens when we receive 
+                #too many frames / frames with pts too close together
+                if self._last_video_package > 0 and self._last_video_package == packet.dts and context.stream.name == "libx264":
+                    #fallback to prevent crash of libx264
+                    logger.warning(f"MediaRecorder will drop duplicate package with dts {packet.dts}. " 
+                                   + " This can happen if libx264 receives more frames than the set framerate or the timestamp is too close together")
+                    continue
+                self._last_video_package = packet.dts
+                
+            self.__mux(packet)
+
+    def __mux(self, packet: av.Packet) -> None:
+        #the first mux writes the header and opens the encoders of all streams.
+        #A video encoder opened before its first frame set the size crashes (e.g. libvpx)
+        if self.__pending_packets is not None:
+            if self.__pending_since is None:
+                self.__pending_since = time.monotonic()
+            waiting = time.monotonic() - self.__pending_since < CustomMediaRecorder.STREAM_SETUP_TIMEOUT
+            if waiting and not all(context.started for context in self.__tracks.values()):
+                if len(self.__pending_packets) == self.__pending_packets.maxlen:
+                    self.stats.dropped_packets += 1
+                self.__pending_packets.append(packet)
+                return
+            self.__write_pending()
+        self.__write_packet(packet)
+
+    def __write_pending(self) -> None:
+        assert self.__pending_packets is not None
+        #streams without a frame yet are started with the size of another video stream. Frames
+        #arriving later are scaled to it
+        sizes = [(c.stream.width, c.stream.height) for c in self.__tracks.values() if c.started and c.stream.type == "video"]
+        width, height = sizes[0] if sizes else (CustomMediaRecorder.DEFAULT_WIDTH, CustomMediaRecorder.DEFAULT_HEIGHT)
+        for context in self.__tracks.values():
+            if not context.started:
+                logger.warning(f"MediaRecorder starts the {context.stream.type} stream before its track delivered a frame")
+                self.__start_stream(context, width, height)
+        pending = self.__pending_packets
+        self.__pending_packets = None
+        for pending_packet in pending:
+            self.__write_packet(pending_packet)
     
     @staticmethod
     def get_default_config():
@@ -381,4 +1136,21 @@ class CustomMediaRecorder:
         config.width = 1280
         config.height = 720
         config.rate = 60
-        return config
\ No newline at end of file
+        return config
+
+    @staticmethod
+    def get_streaming_config(container_format: str = "mp4"):
+        """
+        Default config for sinks and other outputs that can't seek. Uses the realtime EncoderProfile.
+        container_format can be "mp4" (fragmented), "webm", "matroska" or "mpegts".
+        """
+        config = CustomMediaRecorder.get_default_config()
+        config.container_format = container_format
+        config.encoder = EncoderProfile.realtime()
+        if container_format == "mp4":
+            #write a fragment at least every second instead of a moov atom at the end of the file
+            config.container_options = {
+                "movflags": "frag_keyframe+empty_moov+default_base_moof",
+                "frag_duration": "1000000",
+            }
+        return config
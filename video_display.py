@@ -0,0 +1,166 @@
+from dataclasses import dataclass
+import threading
+import time
+import traceback
+from typing import List, Optional
+
+import cv2
+from av import VideoFrame
+import logging
+logger = logging.getLogger(__name__)
+
+'''
+Shows video frames in OpenCV windows without using the event loop.
+
+The event loop only hands each received frame to a DisplayWindow. A single render thread converts
+the newest frame of each window to BGR, shows it and runs the OpenCV event handling. Frames that
+arrive faster than they can be shown replace each other and are counted as skipped. OpenCV's
+window functions are only ever called from the render thread.
+
+Example:
+    window = VideoDisplay.get().open_window("Video 1")
+    while not window.closed:
+        window.show(await track.recv())
+    window.close()
+'''
+
+
+@dataclass
+class DisplayStats:
+    #frames converted and shown
+    shown: int = 0
+    #frames replaced by a newer one before they were shown
+    skipped: int = 0
+    #frames shown during the last second
+    fps: float = 0
+
+
+class DisplayWindow:
+    '''
+    One window. show can be called from any thread. Created via VideoDisplay.open_window.
+    '''
+
+    def __init__(self, display: "VideoDisplay", name: str):
+        self.name = name
+        self.stats = DisplayStats()
+        self._display = display
+        self._frame: Optional[VideoFrame] = None
+        #set by the user pressing q in the window or by close
+        self.closed = False
+        #True once the render thread created the OpenCV window
+        self._created = False
+        self._fps_start = time.monotonic()
+        self._fps_frames = 0
+
+    def show(self, frame: VideoFrame) -> None:
+        '''
+        Replaces the frame waiting to be shown. Never blocks on the rendering.
+        '''
+        with self._display._lock:
+            if self._frame is not None:
+                self.stats.skipped += 1
+            self._frame = frame
+        self._display._wake.set()
+
+    def close(self) -> None:
+        '''
+        Closes the window. It is destroyed by the render thread.
+        '''
+        with self._display._lock:
+            self.closed = True
+            self._frame = None
+        self._display._wake.set()
+
+    def _take(self) -> Optional[VideoFrame]:
+        frame = self._frame
+        self._frame = None
+        return frame
+
+    def _count_shown(self) -> None:
+        self.stats.shown += 1
+        self._fps_frames += 1
+        now = time.monotonic()
+        if now - self._fps_start >= 1.0:
+            self.stats.fps = self._fps_frames / (now - self._fps_start)
+            self._fps_start = now
+            self._fps_frames = 0
+
+
+class VideoDisplay:
+    '''
+    Owns the render thread. Use VideoDisplay.get() to share it between all windows of the process.
+    The thread is started with the first window and sleeps while no window is open.
+    '''
+
+    #max time between two OpenCV event handling calls. Keeps the windows responsive without new frames
+    IDLE_INTERVAL = 0.02
+
+    _instance: Optional["VideoDisplay"] = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._windows: List[DisplayWindow] = []
+        self._thread: Optional[threading.Thread] = None
+
+    @staticmethod
+    def get() -> "VideoDisplay":
+        if VideoDisplay._instance is None:
+            VideoDisplay._instance = VideoDisplay()
+        return VideoDisplay._instance
+
+    def open_window(self, name: str) -> DisplayWindow:
+        window = DisplayWindow(self, name)
+        with self._lock:
+            self._windows.append(window)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="VideoDisplay", daemon=True)
+                self._thread.start()
+        self._wake.set()
+        return window
+
+    def _run(self) -> None:
+        try:
+            while True:
+                with self._lock:
+                    idle = not self._windows
+                #without windows there is nothing to keep responsive. Sleep until the next window opens
+                self._wake.wait(None if idle else VideoDisplay.IDLE_INTERVAL)
+                self._wake.clear()
+                with self._lock:
+                    windows = list(self._windows)
+                    frames = [window._take() for window in windows]
+                    for window in windows:
+                        if window.closed:
+                            self._windows.remove(window)
+
+                for window, frame in zip(windows, frames):
+                    if window.closed:
+                        self._destroy(window)
+                    elif frame is not None:
+                        #converted once per shown frame. Skipped frames are never converted
+                        img = frame.to_ndarray(format="bgr24")
+                        cv2.imshow(window.name, img)
+                        window._created = True
+                        window._count_shown()
+
+                if any(window._created and not window.closed for window in windows):
+                    if cv2.waitKey(1) & 0xFF == ord('q'):
+                        #OpenCV doesn't tell which window had the focus. q closes all of them like before
+                        for window in windows:
+                            window.closed = True
+        except Exception as e:
+            logger.error(f"VideoDisplay render thread failed: {e}\n{traceback.format_exc()}")
+            with self._lock:
+                for window in self._windows:
+                    window.closed = True
+                self._windows.clear()
+                self._thread = None
+
+    def _destroy(self, window: DisplayWindow) -> None:
+        if window._created:
+            try:
+                cv2.destroyWindow(window.name)
+            except cv2.error:
+                pass
+        logger.info(f"Window {window.name} closed. shown {window.stats.shown} skipped {window.stats.skipped} last fps {window.stats.fps:.1f}")
@@ -9,6 +9,7 @@ from websockets.sync.client import ClientConnection
 from websockets.exceptions import ConnectionClosed
 from typing import Awaitable, Callable, Final, Optional
 from prefix_logger import PrefixLogger
+from tracing import tracer
 
 class NetEventType(Enum):
     Invalid = 0
@@ -206,6 +207,11 @@ class WebsocketNetwork:
         evt = NetworkEvent(NetEventType.NewConnection, ConnectionId(1), address)
         await self.send_network_event(evt)
 
+    async def disconnect(self, connection_id: ConnectionId):
+        #asks the server to close the connection to the remote side
+        evt = NetworkEvent(NetEventType.Disconnected, connection_id, None)
+        await self.send_network_event(evt)
+
     async def listen(self, address: str):
         evt = NetworkEvent(NetEventType.ServerInitialized, ConnectionId(-1), address)
         await self.send_network_event(evt)
@@ -267,11 +273,14 @@ class WebsocketNetwork:
         elif msg[0] == NetEventType.MetaHeartbeat.value:
             self.mHeartbeatReceived = True
         else:
-            evt = NetworkEvent.from_byte_array(msg)
-            await self.handle_incoming_event(evt)
+            with tracer.span("process_message", "signaling"):
+                evt = NetworkEvent.from_byte_array(msg)
+                #the handlers process the event right away e.g. SDP / ICE steps of the CallPeer
+                with tracer.span(evt.type.name, "signaling", {"connection_id": evt.connection_id.id}):
+                    await self.handle_incoming_event(evt)
 
     async def handle_incoming_event(self, evt: NetworkEvent):
-        self.logger.debug(f"Signaling event {evt}")
+        self.logger.debug("Signaling event %s for connection %s", evt.type, evt.connection_id)
         for handler in self.event_handlers:
             await handler(evt)
     